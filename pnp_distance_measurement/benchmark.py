@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+from pnp import Point, Quadrilateral, QuadrilateralBatch, solve_pnp
+from json_stream import iter_records, RecordWriter
+import evaluation
+import pnp_batch
+import profiles
+import render
+import synthetic
+
+SIZES = [1000, 100000, 1000000]
+STAGES = ['corner_ordering', 'corner_ordering_batch', 'pose_solve', 'pose_solve_batch', 'horizontal_distance',
+          'reprojection', 'json_write', 'json_read', 'rendering']
+# Rendering decodes and encodes one image per sign, so only this many signs are rendered
+RENDER_SAMPLE = 100
+# A stage is reported as a regression when it is this much slower than the baseline
+REGRESSION_THRESHOLD = 0.10
+
+def order_corners(corners):
+  """
+  Stage: put the corners of every sign in A B C D order one Quadrilateral at a time,
+  like the service does for every sign it parses
+  """
+  return np.array([[[p.x, p.y] for p in Quadrilateral.rearrange_pts([Point(x, y) for x, y in quad])]
+                   for quad in corners.tolist()]).reshape(-1, 4, 2)
+
+def solve_poses(corners, profile):
+  """
+  Stage: cv2.solvePnP of every sign one at a time, like Quadrilateral.find_R_t in
+  Processing (with or without --workers)
+  """
+  return [solve_pnp(pts, profile) for pts in corners]
+
+def render_sample(batch, tmp_dir):
+  """
+  Stage: annotate RENDER_SAMPLE signs on blank images of the profile's size
+  """
+  n = min(len(batch), RENDER_SAMPLE)
+  img_path = os.path.join(tmp_dir, 'imgs') + os.sep
+  output_path = os.path.join(tmp_dir, 'arrows') + os.sep
+  for path in (img_path, output_path):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+  w, h = batch.profile.IMG_SIZE
+  blank = np.full((h, w, 3), 128, np.uint8)
+  for id in batch.ids[:n]:
+    cv2.imwrite(img_path + str(id), blank)
+
+  start = time.perf_counter()
+  render.render_batch(batch.ids[:n], batch.vertices_2D[:n], batch.R_vecs[:n], batch.T_vecs[:n],
+                      batch.distances[:n], img_path=img_path, output_path=output_path, profile=batch.profile)
+  return time.perf_counter() - start, n
+
+def run_profile(data, tmp_dir):
+  """
+  Time every stage on the synthetic signs of one profile
+  Returns {stage: (seconds, number of signs)}
+  """
+  timings = {}
+  n = len(data['corners'])
+  profile = data['profile']
+
+  def timed(stage, f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    timings[stage] = (time.perf_counter() - start, n)
+    return result
+
+  timed('corner_ordering', order_corners, data['corners'])
+  # Processing orders all the corners of a file at once
+  ordered = timed('corner_ordering_batch', pnp_batch.rearrange_pts_batch, data['corners'])
+  timed('pose_solve', solve_poses, ordered, profile)
+  # The service solves its micro-batches at once
+  R_vecs, T_vecs = timed('pose_solve_batch', pnp_batch.find_R_t_batch, ordered, profile.K, profile.DIST_COEFFS,
+                         profile.DEFAULT_VERTICES_3D)
+  distances = timed('horizontal_distance', pnp_batch.find_horizontal_distance_batch, R_vecs, T_vecs)
+  timed('reprojection', evaluation.projection_residuals, ordered, R_vecs, T_vecs, profile.K, profile.DIST_COEFFS,
+        profile.DEFAULT_VERTICES_3D)
+
+  batch = QuadrilateralBatch(data['ids'], ordered, profile=profile).set_results(R_vecs, T_vecs, distances)
+  json_file = os.path.join(tmp_dir, 'results.json')
+
+  def write_json():
+    with RecordWriter(json_file) as writer:
+      writer.write_all(batch)
+
+  timed('json_write', write_json)
+  timed('json_read', lambda: sum(1 for _ in iter_records(json_file)))
+  os.remove(json_file)
+  timings['rendering'] = render_sample(batch, tmp_dir)
+  return timings
+
+def run(sizes, profile_names, noise=0.5, seed=0, repeat=1):
+  """
+  Run every stage at every size. Each size is split evenly between the profiles and the
+  stage times of the profiles are added up. With repeat > 1 the fastest run is kept
+  Returns {stage: {size: {'seconds', 'signs', 'per_sign_us', 'signs_per_s'}}}
+  """
+  results = {stage: {} for stage in STAGES}
+  tmp_dir = tempfile.mkdtemp(prefix='pnp_benchmark_')
+  try:
+    for size in sizes:
+      counts = [size//len(profile_names) + (k < size % len(profile_names)) for k in range(len(profile_names))]
+      datasets = [synthetic.generate(count, name, noise=noise, seed=seed)
+                  for name, count in zip(profile_names, counts) if count]
+      best = {}
+      for _ in range(repeat):
+        totals = {}
+        for data in datasets:
+          for stage, (seconds, signs) in run_profile(data, tmp_dir).items():
+            s, m = totals.get(stage, (0.0, 0))
+            totals[stage] = (s + seconds, m + signs)
+        for stage, total in totals.items():
+          if stage not in best or total[0] < best[stage][0]:
+            best[stage] = total
+      for stage, (seconds, signs) in best.items():
+        results[stage][str(size)] = {'seconds': seconds, 'signs': signs,
+                                     'per_sign_us': 1e6*seconds/max(signs, 1),
+                                     'signs_per_s': signs/seconds if seconds > 0 else float('inf')}
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+  return results
+
+def environment():
+  return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+          'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+  """
+  Time per sign of every stage and size against the baseline
+  Returns a list of (stage, size, baseline us, current us, ratio, regression)
+  """
+  rows = []
+  for stage in STAGES:
+    for size, current in results.get(stage, {}).items():
+      reference = baseline.get(stage, {}).get(size)
+      if reference is None:
+        continue
+      ratio = current['per_sign_us']/reference['per_sign_us'] if reference['per_sign_us'] > 0 else float('inf')
+      rows.append((stage, size, reference['per_sign_us'], current['per_sign_us'], ratio, ratio > 1 + threshold))
+  return rows
+
+def print_results(results):
+  print('%-20s %10s %12s %14s %14s' % ('stage', 'signs', 'seconds', 'us per sign', 'signs per s'))
+  for stage in STAGES:
+    for size, r in results[stage].items():
+      print('%-20s %10d %12.4f %14.3f %14.0f' % (stage, r['signs'], r['seconds'], r['per_sign_us'], r['signs_per_s']))
+
+def print_comparison(rows):
+  print('%-20s %10s %14s %14s %8s' % ('stage', 'size', 'baseline us', 'current us', 'ratio'))
+  for stage, size, reference, current, ratio, regression in rows:
+    print('%-20s %10s %14.3f %14.3f %8.2f%s' % (stage, size, reference, current, ratio,
+                                                '  REGRESSION' if regression else ''))
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+                      help='comma separated numbers of synthetic signs')
+  parser.add_argument('--profiles', default=','.join(profiles.profile_names()),
+                      help='comma separated camera profiles the signs are split between')
+  parser.add_argument('--noise', type=float, default=0.5, help='corner noise in pixels')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=1, help='keep the fastest of N runs')
+  parser.add_argument('--output', default=None, help='write the results to this json file')
+  parser.add_argument('--save-baseline', default=None, help='write the results as a baseline json file')
+  parser.add_argument('--baseline', default=None, help='compare the results with this baseline json file')
+  parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                      help='slowdown (fraction of the baseline time per sign) reported as a regression')
+  parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on a regression')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  sizes = [int(s) for s in args.sizes.split(',')]
+  results = run(sizes, args.profiles.split(','), args.noise, args.seed, args.repeat)
+  report = {'environment': environment(), 'profiles': args.profiles.split(','), 'noise': args.noise,
+            'seed': args.seed, 'results': results}
+  print_results(results)
+  for output in (args.output, args.save_baseline):
+    if output is not None:
+      with open(output, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    if baseline.get('environment') != report['environment']:
+      print('Baseline environment differs: ' + str(baseline.get('environment')))
+    rows = compare(results, baseline['results'], args.threshold)
+    print_comparison(rows)
+    regressions = [row for row in rows if row[-1]]
+    print('Regressions: ' + str(len(regressions)))
+    if regressions and args.fail_on_regression:
+      raise SystemExit(1)
+
+if __name__ == '__main__':
+  main()
@@ -1,61 +1,293 @@
+import argparse
+import hashlib
+import os
+import re
 import numpy as np
 import cv2
 import glob
 import yaml
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 # import pathlib
 
-images = glob.glob(r'calib_imgs_4032x3024/*.jpg')
-path = './calib_results_4032x3024'
-# images = glob.glob(r'calib_imgs_1008x756/*.jpg')
-# path = './calib_results_1008x756'
-images.sort()
+IMAGES = r'calib_imgs_4032x3024/*.jpg'
+PATH = './calib_results_4032x3024'
+# IMAGES = r'calib_imgs_1008x756/*.jpg'
+# PATH = './calib_results_1008x756'
+OUTPUT = 'calibration_matrix.yaml'
+ERRORS_OUTPUT = 'calibration_errors.yaml'
+# Detected corners of every image, keyed by image content and detection settings
+CACHE_DIR = './corner_cache'
+# Image and detection behind every overlay of the results folder
+OVERLAY_INDEX = 'overlays.yaml'
+OVERLAY_NAME = re.compile(r'calibresult(\d+)\.jpg$')
 
+PATTERN_SIZE = (7, 6)
 # termination criteria
 criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-# prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-objp = np.zeros((6*7,3), np.float32)
-objp[:,:2] = np.mgrid[0:7,0:6].T.reshape(-1,2)
-# Arrays to store object points and image points from all the images.
-objpoints = [] # 3d point in real world space
-imgpoints = [] # 2d points in image plane.
-
-found = 0
-for fname in images:  # Here, 10 can be changed to whatever number you like to choose
-    img = cv2.imread(fname) # Capture frame-by-frame
-    #print(images[im_i])
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    # Find the chess board corners
-    ret, corners = cv2.findChessboardCorners(gray, (7,6), None)
-    # If found, add object points, image points (after refining them)
-    if ret == True:
-        objpoints.append(objp)   # Certainly, every loop objp is the same, in 3D.
-        corners2 = cv2.cornerSubPix(gray,corners,(11,11),(-1,-1),criteria)
-        imgpoints.append(corners2)
-        # Draw and display the corners
-        img = cv2.drawChessboardCorners(img, (7,6), corners2, ret)
-        found += 1
-        # cv2.imshow('img', img)
-        # cv2.waitKey(500)
-        # if you want to save images with detected corners 
-        # uncomment following 2 lines and lines 5, 18 and 19
-        image_name = path + '/calibresult' + str(found).zfill(2) + '.jpg'
-        cv2.imwrite(image_name, img)
-
-print("Number of images used for calibration: " + str(found))
-
-# When everything done, release the capture
-# cap.release()
-cv2.destroyAllWindows()
-
-# calibration
-ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
-
-# transform the matrix and distortion coefficients to writable lists
-data = {'camera_matrix': np.asarray(mtx).tolist(),
-        'dist_coeff': np.asarray(dist).tolist()}
-
-# and save it to a file
-with open("calibration_matrix.yaml", "w") as f:
-    yaml.dump(data, f)
-
-# done
\ No newline at end of file
+# Width (in pixels) of the downscaled copy the chessboard is searched on
+SEARCH_WIDTH = 1000
+# Chessboard detection flags used on the downscaled copy
+SEARCH_FLAGS = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE + cv2.CALIB_CB_FAST_CHECK
+
+def object_points(pattern_size=PATTERN_SIZE):
+    # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
+    objp = np.zeros((pattern_size[0]*pattern_size[1], 3), np.float32)
+    objp[:, :2] = np.mgrid[0:pattern_size[0], 0:pattern_size[1]].T.reshape(-1, 2)
+    return objp
+
+def find_corners(gray, pattern_size=PATTERN_SIZE, search_width=SEARCH_WIDTH, full_res_fallback=False):
+    """
+    Find the chessboard corners on a downscaled copy of the image, then refine them
+    with cornerSubPix at full resolution. Returns None if the board is not found
+    """
+    scale = min(1.0, float(search_width)/max(gray.shape))
+    small = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ret, corners = cv2.findChessboardCorners(small, pattern_size, flags=SEARCH_FLAGS)
+    if ret:
+        # Map pixel centers of the small image back to the full resolution image
+        corners = ((corners + 0.5)/scale - 0.5).astype(np.float32)
+    elif full_res_fallback and scale < 1.0:
+        ret, corners = cv2.findChessboardCorners(gray, pattern_size, None)
+    if not ret:
+        return None
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+
+def detect(args):
+    """
+    Worker: read one image in grayscale and find its chessboard corners
+    Returns (file name, corners or None, image size)
+    """
+    fname, pattern_size, search_width, full_res_fallback = args
+    gray = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return fname, None, None
+    corners = find_corners(gray, pattern_size, search_width, full_res_fallback)
+    return fname, corners, gray.shape[::-1]
+
+def cache_key(fname, pattern_size=PATTERN_SIZE, search_width=SEARCH_WIDTH, full_res_fallback=False):
+    """
+    Hash of the image content and of every setting that changes the detected corners
+    """
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(repr((tuple(pattern_size), search_width, full_res_fallback, SEARCH_FLAGS, criteria)).encode())
+    return h.hexdigest()
+
+def load_cached(cache_dir, key):
+    """
+    Returns (corners or None, image size) from the cache, or None if the key is not cached
+    """
+    cache_file = os.path.join(cache_dir, key + '.npz')
+    if not os.path.exists(cache_file):
+        return None
+    data = np.load(cache_file)
+    corners = data['corners'] if data['found'] else None
+    return corners, tuple(int(x) for x in data['size'])
+
+def save_cached(cache_dir, key, corners, size):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    np.savez(os.path.join(cache_dir, key + '.npz'), found=corners is not None,
+             corners=np.zeros((0, 1, 2), np.float32) if corners is None else corners, size=np.array(size))
+
+def detect_all(images, pattern_size=PATTERN_SIZE, search_width=SEARCH_WIDTH, full_res_fallback=False,
+               workers=None, cache_dir=None):
+    """
+    Find the chessboard corners of all the images on a pool of processes, in image order.
+    With a cache_dir, images whose result is cached (board found or not) are not decoded again
+    Returns the detections and the file names detected in this run
+    """
+    detections = [None]*len(images)
+    keys = [None]*len(images)
+    todo = []
+    for i, fname in enumerate(images):
+        if cache_dir is not None:
+            keys[i] = cache_key(fname, pattern_size, search_width, full_res_fallback)
+            cached = load_cached(cache_dir, keys[i])
+            if cached is not None:
+                detections[i] = (fname,) + cached
+                continue
+        todo.append(i)
+
+    if todo:
+        tasks = [(images[i], pattern_size, search_width, full_res_fallback) for i in todo]
+        pool = Pool(workers)
+        try:
+            results = pool.map(detect, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for i, detection in zip(todo, results):
+            detections[i] = detection
+            # Unreadable images are not cached, they are tried again next time
+            if cache_dir is not None and detection[2] is not None:
+                save_cached(cache_dir, keys[i], detection[1], detection[2])
+    return detections, [images[i] for i in todo]
+
+def overlay_name(path, number):
+    return path + '/calibresult' + str(number).zfill(2) + '.jpg'
+
+def overlay_numbers(path):
+    """
+    (number, file name) of the calibresultNN.jpg overlays in the results folder (other
+    files are ignored)
+    """
+    numbers = []
+    for name in os.listdir(path) if os.path.isdir(path) else []:
+        match = OVERLAY_NAME.match(name)
+        if match:
+            numbers.append((int(match.group(1)), os.path.join(path, name)))
+    return numbers
+
+def overlay_signature(detection):
+    """
+    What an overlay is drawn from: the image (name, size and modification time) and
+    its detected corners
+    """
+    fname, corners, size = detection
+    st = os.stat(fname)
+    h = hashlib.sha1(repr((fname, st.st_size, st.st_mtime_ns)).encode())
+    h.update(np.ascontiguousarray(corners).tobytes())
+    return h.hexdigest()
+
+def load_overlay_index(path):
+    index_file = os.path.join(path, OVERLAY_INDEX)
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file) as f:
+        return yaml.safe_load(f) or {}
+
+def write_overlays(detections, path, pattern_size=PATTERN_SIZE, workers=None):
+    """
+    Save the images with the detected corners drawn, numbered in image order from 1.
+    Only the overlays whose image or detection changed since the last run are drawn
+    again (an image added or removed renumbers the ones after it), and the overlays
+    numbered past the last board are removed
+    Returns the number of overlays written
+    """
+    index = load_overlay_index(path)
+    signatures = {number: overlay_signature(d) for number, d in enumerate(detections, 1)}
+    for number, name in overlay_numbers(path):
+        if number > len(detections):
+            os.remove(name)
+    todo = [number for number, signature in signatures.items()
+            if index.get(number) != signature or not os.path.exists(overlay_name(path, number))]
+
+    def write_one(number):
+        fname, corners, size = detections[number - 1]
+        img = cv2.imread(fname)
+        img = cv2.drawChessboardCorners(img, pattern_size, corners, True)
+        cv2.imwrite(overlay_name(path, number), img)
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    pool = ThreadPool(workers)
+    try:
+        pool.map(write_one, todo)
+    finally:
+        pool.close()
+        pool.join()
+    with open(os.path.join(path, OVERLAY_INDEX), 'w') as f:
+        yaml.dump(signatures, f)
+    return len(todo)
+
+def calibrate(detections, pattern_size=PATTERN_SIZE):
+    """
+    Calibrate from the detected corners. Returns the RMS reprojection error, the camera
+    matrix, the distortion coefficients and the RMS reprojection error of every image
+    """
+    objp = object_points(pattern_size)
+    objpoints = [objp]*len(detections)  # Certainly, every loop objp is the same, in 3D.
+    imgpoints = [corners for fname, corners, size in detections]
+    image_size = detections[0][2]
+    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, image_size, None, None)
+    errors = []
+    for corners, rvec, tvec in zip(imgpoints, rvecs, tvecs):
+        projected, _ = cv2.projectPoints(objp, rvec, tvec, mtx, dist)
+        residuals = projected.reshape(-1, 2) - corners.reshape(-1, 2)
+        errors.append(float(np.sqrt(np.mean(np.sum(residuals**2, axis=1)))))
+    return ret, mtx, dist, errors
+
+def calibrate_without_outliers(detections, max_view_error=None, pattern_size=PATTERN_SIZE):
+    """
+    Calibrate, then drop the image with the largest reprojection error and recalibrate
+    from the same detected corners while that error is above max_view_error
+    Returns the calibrate results, the detections kept and the file names dropped
+    """
+    dropped = []
+    while True:
+        ret, mtx, dist, errors = calibrate(detections, pattern_size)
+        if max_view_error is None or len(detections) <= 3:
+            break
+        worst = int(np.argmax(errors))
+        if errors[worst] <= max_view_error:
+            break
+        dropped.append(detections[worst][0])
+        detections = detections[:worst] + detections[worst + 1:]
+    return ret, mtx, dist, errors, detections, dropped
+
+def write_calibration(mtx, dist, output=OUTPUT):
+    # transform the matrix and distortion coefficients to writable lists
+    data = {'camera_matrix': np.asarray(mtx).tolist(),
+            'dist_coeff': np.asarray(dist).tolist()}
+
+    # and save it to a file
+    with open(output, "w") as f:
+        yaml.dump(data, f)
+
+def write_errors(ret, detections, errors, output=ERRORS_OUTPUT):
+    data = {'rms_error': float(ret),
+            'per_image_error': {fname: error for (fname, corners, size), error in zip(detections, errors)}}
+    with open(output, "w") as f:
+        yaml.dump(data, f)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default=IMAGES, help='glob of the checkerboard images')
+    parser.add_argument('--results', default=PATH, help='folder of the images with the corners drawn')
+    parser.add_argument('--output', default=OUTPUT, help='calibration_matrix yaml output')
+    parser.add_argument('--errors-output', default=ERRORS_OUTPUT, help='per-image reprojection error yaml output')
+    parser.add_argument('--workers', type=int, default=None, help='processes detecting corners (default: all cores)')
+    parser.add_argument('--search-width', type=int, default=SEARCH_WIDTH,
+                        help='size in pixels of the downscaled copy the chessboard is searched on')
+    parser.add_argument('--full-res-fallback', action='store_true',
+                        help='search at full resolution when the board is not found on the downscaled copy')
+    parser.add_argument('--no-overlays', action='store_true', help='do not save the images with the corners drawn')
+    parser.add_argument('--cache', default=CACHE_DIR, help='folder caching the detected corners of every image')
+    parser.add_argument('--no-cache', action='store_true', help='detect the corners of every image again')
+    parser.add_argument('--max-view-error', type=float, default=None,
+                        help='drop the images whose reprojection error (pixels) is above this and recalibrate')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    images = glob.glob(args.images)
+    images.sort()
+
+    cache_dir = None if args.no_cache else args.cache
+    detections, detected = detect_all(images, PATTERN_SIZE, args.search_width, args.full_res_fallback,
+                                      args.workers, cache_dir)
+    print("Images detected: " + str(len(detected)) + ", from cache: " + str(len(images) - len(detected)))
+    for fname, corners, size in detections:
+        if corners is None:
+            print("Chessboard not found: " + fname)
+    detections = [d for d in detections if d[1] is not None]
+    print("Number of images used for calibration: " + str(len(detections)))
+    if not args.no_overlays:
+        written = write_overlays(detections, args.results, PATTERN_SIZE, args.workers)
+        print("Overlays written: " + str(written))
+
+    # calibration
+    ret, mtx, dist, errors, detections, dropped = calibrate_without_outliers(detections, args.max_view_error,
+                                                                             PATTERN_SIZE)
+    for fname in dropped:
+        print("Dropped outlier image: " + fname)
+    print("RMS reprojection error: " + str(ret))
+    write_calibration(mtx, dist, args.output)
+    write_errors(ret, detections, errors, args.errors_output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import numpy as np
+import conf
+import pnp_batch
+
+def to_arrays(quadrilateral_arr):
+  """
+  (vertices_2D, R_vecs, T_vecs, distances, real_distances) arrays of a QuadrilateralBatch
+  or of a list of quadrilateral objects. real_distances is None if there are none
+  """
+  if hasattr(quadrilateral_arr, 'R_vecs'):
+    return (np.asarray(quadrilateral_arr.vertices_2D, dtype=np.float64), quadrilateral_arr.R_vecs,
+            quadrilateral_arr.T_vecs, quadrilateral_arr.distances, quadrilateral_arr.real_distances)
+  n = len(quadrilateral_arr)
+  vertices_2D = np.array([q.vertices_2D for q in quadrilateral_arr], dtype=np.float64).reshape(n, 4, 2)
+  R_vecs = np.array([q.R_vec for q in quadrilateral_arr], dtype=np.float64).reshape(n, 3)
+  T_vecs = np.array([q.T_vec for q in quadrilateral_arr], dtype=np.float64).reshape(n, 3)
+  distances = np.array([q.distance for q in quadrilateral_arr], dtype=np.float64)
+  real_distances = None
+  if n and hasattr(quadrilateral_arr[0], 'real_distance'):
+    real_distances = np.array([q.real_distance for q in quadrilateral_arr], dtype=np.float64)
+  return vertices_2D, R_vecs, T_vecs, distances, real_distances
+
+def projection_residuals(vertices_2D, R_vecs, T_vecs, K=None, dist_coeffs=None, vertices_3D=None):
+  """
+  Nx4x2 differences (in pixels, not rounded) between the projected and the labeled
+  vertices of every quadrilateral, computed in one pass
+  """
+  if vertices_3D is None:
+    vertices_3D = conf.DEFAULT_VERTICES_3D
+  projected = pnp_batch.project_2D_batch(R_vecs, T_vecs, vertices_3D, K, dist_coeffs)
+  return projected - np.asarray(vertices_2D, dtype=np.float64)
+
+def undistorted_projection_residuals(normalized, R_vecs, T_vecs, K=None, vertices_3D=None):
+  """
+  projection_residuals for corners already undistorted by pnp_batch.normalize_2D_batch,
+  measured in the pixels of a distortion-free camera with the same K
+  """
+  if vertices_3D is None:
+    vertices_3D = conf.DEFAULT_VERTICES_3D
+  projected = pnp_batch.project_2D_batch(R_vecs, T_vecs, vertices_3D, K, np.zeros(0))
+  return projected - pnp_batch.undistorted_pixels_batch(normalized, K)
+
+def projection_error_stats(residuals):
+  """
+  Summary of the projection residuals: average absolute error per axis (what
+  Processing.find_ave_proj_error reports, without rounding), RMS error per axis
+  and overall, and the RMS error of every sign
+  """
+  residuals = np.asarray(residuals, dtype=np.float64).reshape(-1, 4, 2)
+  finite = np.all(np.isfinite(residuals), axis=(1, 2))
+  valid = residuals[finite]
+  sq = valid**2
+  per_sign_rms = np.full(len(residuals), np.nan)
+  per_sign_rms[finite] = np.sqrt(np.mean(np.sum(sq, axis=2), axis=1))
+  return {
+    'count': int(len(valid)),
+    'failed': int(len(residuals) - len(valid)),
+    'ave_err': np.mean(np.abs(valid), axis=(0, 1)).tolist() if len(valid) else [np.nan, np.nan],
+    'rms_err': np.sqrt(np.mean(sq, axis=(0, 1))).tolist() if len(valid) else [np.nan, np.nan],
+    'rms': float(np.sqrt(np.mean(np.sum(sq, axis=2)))) if len(valid) else np.nan,
+    'per_sign_rms': per_sign_rms,
+  }
+
+def distance_error_by_bucket(distances, real_distances, bucket_width=1.0, lo=None, hi=None):
+  """
+  Per-bucket statistics of the calculated distance against the real distance.
+  Signs are bucketed by real distance into [lo + k*bucket_width, lo + (k+1)*bucket_width);
+  lo and hi default to the range of the real distances
+  """
+  distances = np.asarray(distances, dtype=np.float64)
+  real_distances = np.asarray(real_distances, dtype=np.float64)
+  keep = np.isfinite(distances) & np.isfinite(real_distances)
+  if lo is None:
+    lo = np.floor(np.min(real_distances[keep])/bucket_width)*bucket_width if np.any(keep) else 0.0
+  if hi is None:
+    hi = (np.floor(np.max(real_distances[keep])/bucket_width) + 1)*bucket_width if np.any(keep) else lo + bucket_width
+  n_buckets = max(int(np.ceil((hi - lo)/bucket_width - 1e-9)), 1)
+  bucket = np.floor((real_distances - lo)/bucket_width).astype(np.int64)
+  keep &= (bucket >= 0) & (bucket < n_buckets)
+  bucket, err = bucket[keep], np.abs(distances[keep] - real_distances[keep])
+  rel_err = err/np.where(real_distances[keep] == 0, np.nan, real_distances[keep])
+
+  count = np.bincount(bucket, minlength=n_buckets)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    ave_err = np.bincount(bucket, err, n_buckets)/count
+    rms_err = np.sqrt(np.bincount(bucket, err**2, n_buckets)/count)
+    err_percentage = np.bincount(bucket, rel_err, n_buckets)/count
+  max_err = np.full(n_buckets, np.nan)
+  order = np.lexsort((err, bucket))
+  last = np.flatnonzero(np.r_[bucket[order][1:] != bucket[order][:-1], True]) if len(order) else []
+  max_err[bucket[order][last]] = err[order][last]
+  return {
+    'bucket_lo': (lo + bucket_width*np.arange(n_buckets)).tolist(),
+    'bucket_width': bucket_width,
+    'count': count.tolist(),
+    'ave_err': ave_err.tolist(),
+    'rms_err': rms_err.tolist(),
+    'max_err': max_err.tolist(),
+    'err_percentage': err_percentage.tolist(),
+  }
+
+def evaluate(quadrilateral_arr, K=None, dist_coeffs=None, bucket_width=1.0):
+  """
+  Projection error statistics, plus distance error statistics when the real
+  distances are known, of a QuadrilateralBatch or a list of quadrilateral objects
+  A QuadrilateralBatch is evaluated with the camera profile it was solved with
+  """
+  vertices_2D, R_vecs, T_vecs, distances, real_distances = to_arrays(quadrilateral_arr)
+  vertices_3D = None
+  if hasattr(quadrilateral_arr, 'profile'):
+    K = quadrilateral_arr.profile.K if K is None else K
+    dist_coeffs = quadrilateral_arr.profile.DIST_COEFFS if dist_coeffs is None else dist_coeffs
+    vertices_3D = quadrilateral_arr.profile.DEFAULT_VERTICES_3D
+  elif K is None and hasattr(quadrilateral_arr, 'camera_mat'):
+    K = quadrilateral_arr.camera_mat
+  if getattr(quadrilateral_arr, 'undistort_once', False):
+    residuals = undistorted_projection_residuals(quadrilateral_arr.normalized, R_vecs, T_vecs, K, vertices_3D)
+  else:
+    residuals = projection_residuals(vertices_2D, R_vecs, T_vecs, K, dist_coeffs, vertices_3D)
+  report = {'projection': projection_error_stats(residuals)}
+  if real_distances is not None:
+    report['distance'] = distance_error_by_bucket(distances, real_distances, bucket_width)
+  return report
+
+def compare_distances(distances, reference, rel_tol=pnp_batch.UNDISTORT_DISTANCE_TOL):
+  """
+  Check the distances of one solver against the distances of a reference solver.
+  Signs without a distance in both are skipped
+  """
+  distances = np.asarray(distances, dtype=np.float64)
+  reference = np.asarray(reference, dtype=np.float64)
+  keep = np.isfinite(distances) & np.isfinite(reference)
+  diff = np.abs(distances[keep] - reference[keep])
+  rel_diff = diff/np.maximum(np.abs(reference[keep]), np.finfo(float).tiny)
+  return {
+    'count': int(np.sum(keep)),
+    'max_diff': float(np.max(diff)) if len(diff) else 0.0,
+    'max_rel_diff': float(np.max(rel_diff)) if len(diff) else 0.0,
+    'over_tol': int(np.sum(rel_diff > rel_tol)),
+    'rel_tol': rel_tol,
+    'mismatched_nan': int(np.sum(np.isfinite(distances) != np.isfinite(reference))),
+  }
+
+def print_projection_report(projection):
+  print('Average x-axis projection error: ' + str(projection['ave_err'][0]))
+  print('Average y-axis projection error: ' + str(projection['ave_err'][1]))
+  print('RMS x-axis projection error: ' + str(projection['rms_err'][0]))
+  print('RMS y-axis projection error: ' + str(projection['rms_err'][1]))
+  print('RMS projection error: ' + str(projection['rms']))
+  if projection['failed']:
+    print('Signs without a pose: ' + str(projection['failed']))
+
+def print_distance_report(distance):
+  print('Distance buckets (lower bound, width ' + str(distance['bucket_width']) + '):')
+  print(distance['bucket_lo'])
+  print('Image count per distance:')
+  print(distance['count'])
+  print('Ave error per distance:')
+  print(distance['ave_err'])
+  print('RMS error per distance:')
+  print(distance['rms_err'])
+  print('Error percentage:')
+  print(distance['err_percentage'])
+
+def print_distance_comparison(comparison):
+  print('Signs compared: ' + str(comparison['count']))
+  print('Max distance difference: ' + str(comparison['max_diff']))
+  print('Max relative distance difference: ' + str(comparison['max_rel_diff']))
+  print('Signs over the ' + str(comparison['rel_tol']) + ' tolerance: ' + str(comparison['over_tol']))
+  if comparison['mismatched_nan']:
+    print('Signs solved by only one of the two: ' + str(comparison['mismatched_nan']))
+
+def print_report(report):
+  print_projection_report(report['projection'])
+  if 'distance' in report:
+    print_distance_report(report['distance'])
@@ -0,0 +1,150 @@
+import json
+import time
+
+class Stats(object):
+  def __init__(self, cprofile=False):
+    """
+    Per-stage timers and counters of a run
+    cprofile: also capture a cProfile of the run between start() and stop()
+    """
+    self.enabled = True
+    self.stages = {}
+    self.counters = {}
+    self.profiler = None
+    if cprofile:
+      import cProfile
+      self.profiler = cProfile.Profile()
+    self.start_time = self.stop_time = None
+
+  def start(self):
+    self.start_time = time.perf_counter()
+    if self.profiler is not None:
+      self.profiler.enable()
+    return self
+
+  def stop(self):
+    if self.profiler is not None:
+      self.profiler.disable()
+    self.stop_time = time.perf_counter()
+    return self
+
+  def timer(self, stage):
+    return _Timer(self, stage)
+
+  def add_time(self, stage, seconds, calls=1):
+    total = self.stages.get(stage)
+    if total is None:
+      self.stages[stage] = [seconds, calls]
+    else:
+      total[0] += seconds
+      total[1] += calls
+
+  def count(self, counter, k=1):
+    self.counters[counter] = self.counters.get(counter, 0) + k
+
+  def iter_timed(self, stage, iterable):
+    """
+    Yield the items of iterable, adding the time spent producing each of them to stage
+    (e.g. the json parsing of json_stream.iter_records)
+    """
+    iterator = iter(iterable)
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        self.add_time(stage, time.perf_counter() - start, 0)
+        return
+      self.add_time(stage, time.perf_counter() - start)
+      yield item
+
+  def report(self):
+    """
+    Machine-readable summary: wall time, seconds and calls of every stage, counters
+    """
+    wall = None
+    if self.start_time is not None:
+      wall = (self.stop_time or time.perf_counter()) - self.start_time
+    return {
+      'wall_seconds': wall,
+      'stages': {stage: {'seconds': seconds, 'calls': calls}
+                 for stage, (seconds, calls) in sorted(self.stages.items())},
+      'counters': dict(sorted(self.counters.items())),
+    }
+
+  def write_report(self, json_file_name):
+    with open(json_file_name, 'w') as f:
+      json.dump(self.report(), f, indent=4, sort_keys=True)
+
+  def write_profile(self, file_name):
+    """
+    Save the cProfile capture, to be read with pstats or snakeviz
+    """
+    if self.profiler is not None:
+      self.profiler.dump_stats(file_name)
+
+class _Timer(object):
+  __slots__ = ('stats', 'stage', 'start')
+
+  def __init__(self, stats, stage):
+    self.stats = stats
+    self.stage = stage
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stats.add_time(self.stage, time.perf_counter() - self.start)
+
+class NullStats(object):
+  """
+  Stats that records nothing, used while instrumentation is off. Every method is a
+  constant-time no-op, so the instrumented code only pays for the calls
+  """
+  enabled = False
+
+  def timer(self, stage):
+    return _NULL_TIMER
+
+  def add_time(self, stage, seconds, calls=1):
+    pass
+
+  def count(self, counter, k=1):
+    pass
+
+  def iter_timed(self, stage, iterable):
+    return iterable
+
+class _NullTimer(object):
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+_NULL_TIMER = _NullTimer()
+
+# Stats of the current run, read by the instrumented modules at every call
+stats = NullStats()
+
+def enable(cprofile=False):
+  """
+  Start recording the stats of the run (see Stats)
+  """
+  global stats
+  stats = Stats(cprofile).start()
+  return stats
+
+def disable():
+  """
+  Stop recording and return the Stats of the run
+  """
+  global stats
+  finished = stats
+  if finished.enabled:
+    finished.stop()
+  stats = NullStats()
+  return finished
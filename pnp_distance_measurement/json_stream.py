@@ -0,0 +1,101 @@
+import json
+
+def _skip_whitespace(buf, pos):
+  while pos < len(buf) and buf[pos] in ' \t\r\n':
+    pos += 1
+  return pos
+
+def _read_more(infile, buf, pos, chunk_size):
+  """
+  Drop the consumed part of the buffer and append the next chunk of the file
+  """
+  chunk = infile.read(chunk_size)
+  return buf[pos:] + chunk, 0, chunk == ''
+
+def iter_records(json_file_name, chunk_size=1 << 16):
+  """
+  Yield the records of a json file one at a time without loading the whole file:
+  the elements of the top level array of a .json file, or the lines of a .jsonl file
+  """
+  with open(json_file_name) as infile:
+    if json_file_name.endswith('.jsonl'):
+      for line in infile:
+        if line.strip():
+          yield json.loads(line)
+      return
+
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    started = False
+    while True:
+      pos = _skip_whitespace(buf, pos)
+      if pos == len(buf):
+        if eof:
+          raise ValueError('Unexpected end of file in ' + json_file_name)
+        buf, pos, eof = _read_more(infile, buf, pos, chunk_size)
+      elif not started:
+        if buf[pos] != '[':
+          raise ValueError(json_file_name + ' does not contain a json array')
+        started, pos = True, pos + 1
+      elif buf[pos] == ']':
+        return
+      elif buf[pos] == ',':
+        pos += 1
+      else:
+        try:
+          record, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+          end = None
+        if end is None or (not eof and (end == len(buf) or buf[end] not in ' \t\r\n,]')):
+          # The record may continue in the next chunk
+          if eof:
+            raise ValueError('Invalid json record in ' + json_file_name)
+          buf, pos, eof = _read_more(infile, buf, pos, chunk_size)
+          continue
+        yield record
+        pos = end
+
+class RecordWriter(object):
+  def __init__(self, json_file_name, fmt=None, flush_every=1000):
+    """
+    Write records to a json file as they are produced
+    fmt: 'jsonl' for one record per line, 'json' for the indented array written by
+    json.dumps(arr, indent=4, sort_keys=True). By default taken from the file extension
+    Objects are written through their __dict__, like Processing.write_to_json does
+    """
+    if fmt is None:
+      fmt = 'jsonl' if json_file_name.endswith('.jsonl') else 'json'
+    if fmt not in ('json', 'jsonl'):
+      raise ValueError('Unknown output format: ' + str(fmt))
+    self.fmt = fmt
+    self.flush_every = flush_every
+    self.count = 0
+    self.outfile = open(json_file_name, 'w')
+
+  def write(self, record):
+    if self.fmt == 'jsonl':
+      self.outfile.write(json.dumps(record, default=lambda x: x.__dict__, sort_keys=True) + '\n')
+    else:
+      json_obj = json.dumps(record, default=lambda x: x.__dict__, indent=4, sort_keys=True)
+      self.outfile.write(('[\n    ' if self.count == 0 else ',\n    ') + json_obj.replace('\n', '\n    '))
+    self.count += 1
+    if self.count % self.flush_every == 0:
+      self.outfile.flush()
+
+  def write_all(self, records):
+    for record in records:
+      self.write(record)
+    return self
+
+  def close(self):
+    if self.outfile.closed:
+      return
+    if self.fmt == 'json':
+      self.outfile.write('[]' if self.count == 0 else '\n]')
+    self.outfile.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
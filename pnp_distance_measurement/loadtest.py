@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+import profiles
+import synthetic
+from service import read_headers
+
+class Client(object):
+  def __init__(self, host='127.0.0.1', port=8765, unix=None):
+    """
+    Keep-alive HTTP/1.1 connection to the distance service
+    """
+    self.host, self.port, self.unix = host, port, unix
+    self.reader = self.writer = None
+
+  async def connect(self):
+    if self.unix is not None:
+      self.reader, self.writer = await asyncio.open_unix_connection(self.unix)
+    else:
+      self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+    return self
+
+  async def request(self, method, path, payload=None):
+    """
+    Returns the HTTP status and the decoded json response
+    """
+    body = b'' if payload is None else json.dumps(payload).encode()
+    self.writer.write((method + ' ' + path + ' HTTP/1.1\r\n'
+                       'Host: ' + str(self.host) + '\r\n'
+                       'Content-Type: application/json\r\n'
+                       'Content-Length: ' + str(len(body)) + '\r\n\r\n').encode() + body)
+    await self.writer.drain()
+    status = int((await self.reader.readline()).split()[1])
+    headers = await read_headers(self.reader)
+    response = await self.reader.readexactly(int(headers.get('content-length', 0)))
+    return status, json.loads(response)
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+
+async def run(args, payloads):
+  """
+  Send the payloads on args.connections concurrent connections
+  Returns the latency of every request, the statuses, the wall time and the service stats
+  """
+  queue = asyncio.Queue()
+  for payload in payloads:
+    queue.put_nowait(payload)
+  latencies, statuses = [], {}
+
+  async def worker():
+    client = await Client(args.host, args.port, args.unix).connect()
+    try:
+      while not queue.empty():
+        payload = queue.get_nowait()
+        start = time.perf_counter()
+        status, _ = await client.request('POST', '/distance', payload)
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+    finally:
+      client.close()
+
+  start = time.perf_counter()
+  await asyncio.gather(*[worker() for _ in range(args.connections)])
+  wall = time.perf_counter() - start
+  client = await Client(args.host, args.port, args.unix).connect()
+  try:
+    _, stats = await client.request('GET', '/stats')
+  finally:
+    client.close()
+  return latencies, statuses, wall, stats
+
+def make_payloads(n, profile_names, signs_per_request=1, seed=0):
+  """
+  n requests of synthetic signs, spread over the profiles
+  """
+  rng = np.random.RandomState(seed)
+  corners = {name: synthetic.generate(n*signs_per_request, name, seed=seed)['corners'].tolist()
+             for name in profile_names}
+  payloads = []
+  for i in range(n):
+    name = profile_names[rng.randint(len(profile_names))]
+    signs = [{'id': i, 'profile': name, 'corners': corners[name][i*signs_per_request + k]}
+             for k in range(signs_per_request)]
+    payloads.append(signs[0] if signs_per_request == 1 else {'signs': signs})
+  return payloads
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--unix', default=None, help='Unix socket of the service')
+  parser.add_argument('--requests', type=int, default=10000)
+  parser.add_argument('--connections', type=int, default=32, help='concurrent connections')
+  parser.add_argument('--signs-per-request', type=int, default=1)
+  parser.add_argument('--profiles', default=','.join(profiles.profile_names()),
+                      help='comma separated camera profiles of the synthetic signs')
+  parser.add_argument('--seed', type=int, default=0)
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  payloads = make_payloads(args.requests, args.profiles.split(','), args.signs_per_request, args.seed)
+  latencies, statuses, wall, stats = asyncio.run(run(args, payloads))
+  latencies = np.array(latencies)*1000
+  print('Requests: ' + str(len(latencies)) + ' in %.3f s (%.0f requests/s, %.0f signs/s)' %
+        (wall, len(latencies)/wall, len(latencies)*args.signs_per_request/wall))
+  print('Statuses: ' + str(statuses))
+  print('Latency (ms): mean %.3f, p50 %.3f, p95 %.3f, p99 %.3f, max %.3f' %
+        (np.mean(latencies), np.percentile(latencies, 50), np.percentile(latencies, 95),
+         np.percentile(latencies, 99), np.max(latencies)))
+  print('Service: ' + json.dumps(stats, sort_keys=True))
+
+if __name__ == '__main__':
+  main()
@@ -1,43 +1,195 @@
-import json, cv2
+import argparse, cv2
 import numpy as np
+from multiprocessing import Pool
 from matplotlib import pyplot as plt
-from pnp import Point, Quadrilateral
+from pnp import Point, Quadrilateral, QuadrilateralBatch, solve_quadrilaterals, solve_chunk, count_solved
+from json_stream import iter_records, RecordWriter
+import evaluation
+import pnp_batch
+import render
+import refine
+import profiles
+import instrumentation
+import result_store
 import conf 
 
 class Processing(object):
-  def create_quadrilateral_arr(self, data, json_flag):
+  def iter_quadrilaterals(self, data, json_flag, solve=True):
     """
-    Create an array of quadrilateral objects from the input data json object
+    Yield a quadrilateral object for each usable record of the input data, in input order
+    data: any iterable of records, e.g. the list from json.load or json_stream.iter_records
     """
-    quadrilateral_arr = []
+    stats = instrumentation.stats
+    data = stats.iter_timed('json_parse', data)
     if json_flag == 'from labelbox':
-      for i in range(len(data)):
-        id = data[i]['External ID']
+      for record in data:
+        stats.count('records_parsed')
+        id = record['External ID']
         try:
-          pts = data[i]['Label'][conf.LABEL][0]['geometry']
-          p1 = Point(int(pts[0]['x']), int(pts[0]['y']))
-          p2 = Point(int(pts[1]['x']), int(pts[1]['y']))
-          p3 = Point(int(pts[2]['x']), int(pts[2]['y']))
-          p4 = Point(int(pts[3]['x']), int(pts[3]['y']))
-          quadrilateral_arr.append(Quadrilateral(id, (p1, p2, p3, p4)))
+          geometries = self.label_geometries(record, conf.LABEL)
         except:
+          stats.count('records_skipped')
           continue
-      quadrilateral_arr.sort(key=lambda x : x.id, reverse = False)
+        for sign, pts in enumerate(geometries):
+          try:
+            p1 = Point(int(pts[0]['x']), int(pts[0]['y']))
+            p2 = Point(int(pts[1]['x']), int(pts[1]['y']))
+            p3 = Point(int(pts[2]['x']), int(pts[2]['y']))
+            p4 = Point(int(pts[3]['x']), int(pts[3]['y']))
+            obj = Quadrilateral(id, (p1, p2, p3, p4), solve=solve)
+          except:
+            stats.count('signs_skipped')
+            continue
+          if len(geometries) > 1:
+            obj.sign = sign
+          yield obj
 
     elif json_flag == 'from reading imgs':
-      for i in range(len(data)):
-        id = data[i]['img_id']
-        pts = data[i]['vertices_2D']
+      for record in data:
+        stats.count('records_parsed')
+        id = record['img_id']
+        pts = record['vertices_2D']
         p1 = Point(pts[0][0], pts[0][1])
         p2 = Point(pts[1][0], pts[1][1])
         p3 = Point(pts[2][0], pts[2][1])
         p4 = Point(pts[3][0], pts[3][1])
-        obj = Quadrilateral(id, (p1, p2, p3, p4))
-        obj.real_distance = int(data[i]['img_id'][0])
-        quadrilateral_arr.append(obj)
+        obj = Quadrilateral(id, (p1, p2, p3, p4), solve=solve)
+        obj.real_distance = int(record['img_id'][0])
+        yield obj
+
+  @staticmethod
+  def label_geometries(record, label):
+    """
+    Corner geometries of all the signs labeled in one labelbox record (one image)
+    """
+    geometries = [sign['geometry'] for sign in record['Label'][label]]
+    if not geometries:
+      raise KeyError('no ' + label + ' in the record')
+    return geometries
 
+  def create_quadrilateral_arr(self, data, json_flag, batch=False):
+    """
+    Create an array of quadrilateral objects from the input data json object
+    batch: solve all the poses in one vectorized pass instead of one cv2.solvePnP per object
+    """
+    quadrilateral_arr = list(self.iter_quadrilaterals(data, json_flag, solve=not batch))
+    if json_flag == 'from labelbox':
+      quadrilateral_arr.sort(key=lambda x : x.id, reverse = False)
+
+    if batch:
+      solve_quadrilaterals(quadrilateral_arr)
     return quadrilateral_arr
 
+  def create_quadrilateral_batch(self, data, json_flag, profile=None, timed=True):
+    """
+    Same as create_quadrilateral_arr, but return a QuadrilateralBatch whose poses
+    are only computed when they are first read
+    profile: camera profile of all the records, conf.PROFILE by default
+    timed: add the time spent reading data to json_parse. False for records that were
+    already parsed (and timed) by the caller
+    """
+    if profile is None:
+      profile = conf.PROFILE
+    stats = instrumentation.stats
+    if timed:
+      data = stats.iter_timed('json_parse', data)
+    ids, vertices_2D, real_distances, signs = [], [], [], []
+    if json_flag == 'from labelbox':
+      for record in data:
+        stats.count('records_parsed')
+        try:
+          geometries = self.label_geometries(record, profile.LABEL)
+        except:
+          stats.count('records_skipped')
+          continue
+        # All the signs of the image, in label order
+        for sign, pts in enumerate(geometries):
+          try:
+            pts = [[int(pts[k]['x']), int(pts[k]['y'])] for k in range(4)]
+          except:
+            stats.count('signs_skipped')
+            continue
+          ids.append(record['External ID'])
+          vertices_2D.append(pts)
+          signs.append(sign if len(geometries) > 1 else -1)
+      order = sorted(range(len(ids)), key=lambda k : ids[k])
+      ids = [ids[k] for k in order]
+      vertices_2D = [vertices_2D[k] for k in order]
+      signs = [signs[k] for k in order]
+      real_distances = None
+
+    elif json_flag == 'from reading imgs':
+      for record in data:
+        stats.count('records_parsed')
+        pts = record['vertices_2D']
+        ids.append(record['img_id'])
+        vertices_2D.append([[pts[k][0], pts[k][1]] for k in range(4)])
+        real_distances.append(int(record['img_id'][0]))
+
+    # Order the corners of all the signs at once
+    vertices_2D = pnp_batch.rearrange_pts_batch(np.array(vertices_2D).reshape(-1, 4, 2))
+    return QuadrilateralBatch(ids, vertices_2D, real_distances, profile,
+                              signs=signs if any(sign >= 0 for sign in signs) else None)
+
+  def create_quadrilateral_batches(self, data, default_profile):
+    """
+    One QuadrilateralBatch per camera profile, in order of first appearance. A record
+    goes to the profile named by its 'profile' key, or to default_profile
+    """
+    groups = {}
+    # The records are parsed here, while they are grouped, not when the groups are read
+    for record in instrumentation.stats.iter_timed('json_parse', data):
+      profile = profiles.select_profile(record, default_profile)
+      groups.setdefault(profile.name, (profile, []))[1].append(record)
+    return [self.create_quadrilateral_batch(records, profile.JSON_FLAG, profile, timed=False)
+            for profile, records in groups.values()]
+
+  def reject_invalid(self, batch):
+    """
+    Drop the signs of a QuadrilateralBatch whose corners cannot give a pose (see
+    pnp_batch.quad_reasons_batch) before it is solved, and print how many were dropped
+    for each reason
+    """
+    counts = pnp_batch.count_reasons(batch.reasons)
+    for name, n in counts.items():
+      instrumentation.stats.count('rejected_' + name, n)
+    print('Rejected quadrilaterals, profile ' + batch.profile.name + ': ' + str(counts))
+    return batch.select(batch.reasons == pnp_batch.QUAD_OK)
+
+  def refine_corners(self, batch, workers=4):
+    """
+    QuadrilateralBatch with the corners refined on its images (see refine.py)
+    """
+    batch, report = refine.refine_batch(batch, workers)
+    refine.print_report(report, batch.profile.name)
+    return batch
+
+  def solve_in_pool(self, batch, workers, chunk_size=4096, batch_solver=False):
+    """
+    Solve a QuadrilateralBatch in chunks on a pool of worker processes. Each object is
+    solved on its own with cv2.solvePnP, like create_quadrilateral_arr does, so the results
+    are those of a serial run for any number of workers
+    batch_solver: solve the chunks with the vectorized solver of QuadrilateralBatch instead
+    (always the case with batch.undistort_once)
+    """
+    chunks = [(batch.vertices_2D[i:i + chunk_size], batch.profile.name, batch.undistort_once, batch_solver)
+              for i in range(0, len(batch), chunk_size)]
+    if len(chunks) == 0:
+      return batch.set_results(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0), np.zeros((0, 2)))
+    with instrumentation.stats.timer('pose_solve_pool'):
+      if workers <= 1 or len(chunks) <= 1:
+        results = [solve_chunk(*chunk) for chunk in chunks]
+      else:
+        pool = Pool(workers)
+        try:
+          results = pool.starmap(solve_chunk, chunks)
+        finally:
+          pool.close()
+          pool.join()
+    results = [np.concatenate(arrays) for arrays in zip(*results)]
+    count_solved(results[2])
+    return batch.set_results(*results)
+
   def find_distance_error(self, quadrilateral_arr):
     """
     (Applicable for the groundtruth dataset containing 830 exit sign images only)
@@ -63,66 +215,148 @@ class Processing(object):
     Calulate the average pixel differences in x and y directions between
     the labels and the projected images
     """
+    if hasattr(quadrilateral_arr, 'proj_errors'):
+      # A QuadrilateralBatch solved by solve_in_pool holds the same errors per object
+      proj_errors = quadrilateral_arr.proj_errors.tolist()
+    else:
+      proj_errors = [q.find_projection_err(q.vertices_2D) for q in quadrilateral_arr]
     err_x, err_y = 0, 0
-    for quadrilateral in quadrilateral_arr:
-      x_err, y_err = quadrilateral.find_projection_err(quadrilateral.vertices_2D)
+    for x_err, y_err in proj_errors:
       err_x += x_err
       err_y += y_err
     return (err_x/len(quadrilateral_arr), err_y/len(quadrilateral_arr))
 
-  def display_image(self, quadrilateral):
+  def iter_images(self, quadrilateral_arr):
+    """
+    Yield the quadrilaterals of each image together, for arrays sorted by id
+    """
+    group = []
+    for quadrilateral in quadrilateral_arr:
+      if group and quadrilateral.id != group[0].id:
+        yield group
+        group = []
+      group.append(quadrilateral)
+    if group:
+      yield group
+
+  def display_image(self, quadrilaterals):
     """
     Display the image, the exit sign label boundaries and the normal Oxyz at the center of the exit sign
+    quadrilaterals: one quadrilateral, or all the ones of an image (see iter_images),
+    drawn on the image read once
     """
-    img = cv2.imread(conf.IMG_PATH + quadrilateral.id)
+    if isinstance(quadrilaterals, Quadrilateral):
+      quadrilaterals = [quadrilaterals]
+    quadrilateral = quadrilaterals[0]
+    with instrumentation.stats.timer('image_read'):
+      img = cv2.imread(conf.IMG_PATH + quadrilateral.id)
     window_name = 'Image ' + quadrilateral.id + ', Distance: ' + str(quadrilateral.distance)
 
-    projected_orthogonals = quadrilateral.project_2D(quadrilateral.R_vec, quadrilateral.T_vec,\
-                                                     conf.DEFAULT_ORTHOGONALS_3D).tolist()
-    # Draw the projected vertices
-    img = cv2.polylines(img, np.int32([quadrilateral.vertices_2D]),  
-                      isClosed=True, color=(0, 255, 255), thickness=3)
-
-    # Draw the normal vector at the center of the quadrilateral
-    start_point = tuple(projected_orthogonals[0])
-    end_point = tuple(projected_orthogonals[1])
-    img = cv2.arrowedLine(img, start_point, end_point,  
-                      color=(255, 0, 0), thickness=3, tipLength=0.25)
-
-    start_point = tuple(projected_orthogonals[0])
-    end_point = tuple(projected_orthogonals[2])
-    img = cv2.arrowedLine(img, start_point, end_point,  
-                      color=(0, 0, 255), thickness=3, tipLength=0.25)
-
-    start_point = tuple(projected_orthogonals[0])
-    end_point = tuple(projected_orthogonals[3])
-    img = cv2.arrowedLine(img, start_point, end_point,  
-                      color=(255, 0, 255), thickness=3, tipLength=0.25)   
+    for q in quadrilaterals:
+      projected_orthogonals = q.project_2D(q.R_vec, q.T_vec, conf.DEFAULT_ORTHOGONALS_3D).tolist()
+      # Draw the projected vertices and the normal vector at the center of the quadrilateral
+      img = render.draw_quadrilateral(img, q.vertices_2D, projected_orthogonals)
 
     # img = cv2.resize(img, (672, 504))
     # cv2.imshow(window_name, img)
     # cv2.waitKey(1000)
     # cv2.destroyWindow(window_name)
     img_name = conf.ARROW_IMG_PATH + 'arrow_' + str(quadrilateral.distance)[:4] + '_' + quadrilateral.id
-    cv2.imwrite(img_name, img)    
+    with instrumentation.stats.timer('image_write'):
+      cv2.imwrite(img_name, img)
 
   def write_to_json(self, arr, json_file_name):
     """
-    Write the quadrilateral array to a json output file
+    Write the quadrilateral array to a json output file, one object at a time
+    (a json array, or JSON Lines if the file name ends with .jsonl)
     """
-    with open(json_file_name, "w") as outfile: 
-      json_obj = json.dumps(arr, default=lambda x: x.__dict__, indent=4, sort_keys=True)
-      outfile.write(json_obj)
+    with instrumentation.stats.timer('json_write'), RecordWriter(json_file_name) as writer:
+      writer.write_all(arr)
 
-def main():
-  with open(conf.JSON_INPUT) as f:
-    data = json.load(f)
-  P = Processing()
-  quadrilateral_arr = P.create_quadrilateral_arr(data, conf.JSON_FLAG)
-  # P.write_to_json(quadrilateral_arr, conf.JSON_OUTPUT)
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--workers', type=int, default=0,
+                      help='solve the dataset as a QuadrilateralBatch on N processes '
+                           '(default: one Quadrilateral at a time). Results and statistics '
+                           'are the same as without --workers')
+  parser.add_argument('--chunk-size', type=int, default=4096,
+                      help='number of signs per worker task with --workers')
+  parser.add_argument('--output', default=None,
+                      help='write the results to this .json (array) or .jsonl (JSON Lines) file')
+  parser.add_argument('--render', action='store_true',
+                      help='write the annotated images to conf.ARROW_IMG_PATH')
+  parser.add_argument('--render-scale', type=float, default=1.0,
+                      help='scale of the annotated images. 0.5, 0.25 and 0.125 are decoded '
+                           'directly at reduced resolution')
+  parser.add_argument('--render-workers', type=int, default=4,
+                      help='threads decoding and encoding the annotated images')
+  parser.add_argument('--skip-existing', action='store_true',
+                      help='do not render the images whose output already exists')
+  parser.add_argument('--profile', action='append', default=None, choices=profiles.profile_names(),
+                      help='camera profile whose JSON_INPUT is processed (default: conf.model). '
+                           'Repeat it to process several datasets in one run with --workers; '
+                           'records with a "profile" key are solved with that profile')
+  parser.add_argument('--undistort-once', action='store_true',
+                      help='with --workers, undistort all the corners in one call and solve them with '
+                           'distortion-free math (only changes the results of the street profiles)')
+  parser.add_argument('--check-undistort', action='store_true',
+                      help='with --workers, also solve every sign the other way (with or without '
+                           '--undistort-once) and fail if the distances differ by more than '
+                           'pnp_batch.UNDISTORT_DISTANCE_TOL')
+  parser.add_argument('--reject-invalid', action='store_true',
+                      help='with --workers, drop the signs whose corners are not finite, cover less than '
+                           'pnp_batch.MIN_QUAD_AREA pixels, are collinear, cross or are not convex, '
+                           'before solving them')
+  parser.add_argument('--refine-corners', action='store_true',
+                      help='with --workers, snap the labeled corners to the sub-pixel corners of the '
+                           'images before solving them, and print how far they moved')
+  parser.add_argument('--refine-workers', type=int, default=4,
+                      help='threads reading the images with --refine-corners')
+  parser.add_argument('--stream', action='store_true',
+                      help='with --output, write every sign as soon as it is solved, in input '
+                           'order, keeping memory constant. Only the average projection error '
+                           'and the count are printed')
+  parser.add_argument('--store', default=None,
+                      help='with --workers, sqlite result store (e.g. ' + result_store.STORE + '): signs whose '
+                           'image id, corners and camera profile are already in it are not solved again')
+  parser.add_argument('--store-evict', type=int, default=None, metavar='RUNS',
+                      help='delete the stored signs not used by this run or the RUNS runs before it')
+  parser.add_argument('--store-compact', action='store_true',
+                      help='shrink the store file after the eviction')
+  parser.add_argument('--stats', default=None,
+                      help='write the time spent in every stage and the record counters (parsed, '
+                           'skipped, solved, failed) of the run to this json file')
+  parser.add_argument('--cprofile', default=None,
+                      help='capture a cProfile of the run and save it to this file (read it with pstats)')
+  return parser.parse_args()
+
+def stream_results(P, data, json_file_name):
+  """
+  Solve the records one at a time and write each result as soon as it is available
+  """
+  err_x, err_y = 0, 0
+  with instrumentation.stats.timer('stream'), RecordWriter(json_file_name) as writer:
+    for quadrilateral in P.iter_quadrilaterals(data, conf.JSON_FLAG):
+      x_err, y_err = quadrilateral.find_projection_err(quadrilateral.vertices_2D)
+      err_x += x_err
+      err_y += y_err
+      writer.write(quadrilateral)
+    count = writer.count
+  print('***********************************************************************')
+  print('Average x-axis projection error: ' + str(err_x/max(count, 1)))
+  print('Average y-axis projection error: ' + str(err_y/max(count, 1)))
+  print('***********************************************************************')
+  print(count)
 
+def print_results(P, args, quadrilateral_arr):
+  """
+  Print the projection errors, the distances and the distance errors (groundtruth only)
+  of one dataset, and render it if asked to
+  """
+  profile = getattr(quadrilateral_arr, 'profile', conf.PROFILE)
   print('***********************************************************************')
-  ave_x_err, ave_y_err = P.find_ave_proj_error(quadrilateral_arr)
+  with instrumentation.stats.timer('evaluation'):
+    ave_x_err, ave_y_err = P.find_ave_proj_error(quadrilateral_arr)
   print('Average x-axis projection error: ' + str(ave_x_err))
   print('Average y-axis projection error: ' + str(ave_y_err))
 
@@ -132,12 +366,104 @@ def main():
     quadrilateral = quadrilateral_arr[i]
     print(quadrilateral.id + ' ' + str(quadrilateral.distance))
     # img = P.display_image(quadrilateral)
+  # for quadrilaterals in P.iter_images(quadrilateral_arr):
+  #   img = P.display_image(quadrilaterals)
+
+  if args.render:
+    with instrumentation.stats.timer('render'):
+      counts = render.render_quadrilaterals(quadrilateral_arr, scale=args.render_scale,
+                                            workers=args.render_workers, skip_existing=args.skip_existing)
+    print('Annotated images: ' + str(counts))
 
   print('***********************************************************************')
   print(len(quadrilateral_arr))
   print('***********************************************************************')
-  if conf.model == 'groundtruth_1920x1440_iPhone8':
+  if profile.name == 'groundtruth_1920x1440_iPhone8':
     P.find_distance_error(quadrilateral_arr)
+
+def check_undistort(P, args, batches):
+  """
+  Solve every batch with the vectorized solver, with and without undistorting the corners
+  once, and compare the distances
+  """
+  ok = True
+  for batch in batches:
+    pair = [QuadrilateralBatch(batch.ids, batch.vertices_2D, batch.real_distances, batch.profile,
+                               undistort_once=undistort_once, signs=batch.signs)
+            for undistort_once in (batch.undistort_once, not batch.undistort_once)]
+    for solved in pair:
+      P.solve_in_pool(solved, args.workers, args.chunk_size, batch_solver=True)
+    comparison = evaluation.compare_distances(pair[0].distances, pair[1].distances)
+    print('Undistort-once check, profile ' + batch.profile.name + ':')
+    evaluation.print_distance_comparison(comparison)
+    ok = ok and comparison['over_tol'] == 0 and comparison['mismatched_nan'] == 0
+  return ok
+
+def main():
+  args = parse_args()
+  if args.stats is None and args.cprofile is None:
+    return run(args)
+  stats = instrumentation.enable(cprofile=args.cprofile is not None)
+  for counter in ('records_parsed', 'records_skipped', 'solved', 'failed'):
+    stats.count(counter, 0)
+  try:
+    return run(args)
+  finally:
+    stats = instrumentation.disable()
+    if args.stats is not None:
+      stats.write_report(args.stats)
+    if args.cprofile is not None:
+      stats.write_profile(args.cprofile)
+
+def run(args):
+  profile_names = args.profile or [conf.model]
+  if len(profile_names) > 1 and not args.workers:
+    raise SystemExit('several --profile need --workers')
+  conf.use_profile(profile_names[0])
+  data = iter_records(conf.JSON_INPUT)
+  P = Processing()
+  if args.stream:
+    if args.output is None:
+      raise SystemExit('--stream needs --output')
+    return stream_results(P, data, args.output)
+  if args.store is not None and not args.workers:
+    raise SystemExit('--store needs --workers')
+  if args.workers:
+    batches = []
+    for name in profile_names:
+      batches += P.create_quadrilateral_batches(iter_records(profiles.get_profile(name).JSON_INPUT), name)
+    if args.reject_invalid:
+      batches = [P.reject_invalid(batch) for batch in batches]
+    if args.refine_corners:
+      batches = [P.refine_corners(batch, args.refine_workers) for batch in batches]
+    store = None if args.store is None else result_store.ResultStore(args.store)
+    for batch in batches:
+      batch.undistort_once = args.undistort_once
+      if store is None:
+        P.solve_in_pool(batch, args.workers, args.chunk_size)
+      else:
+        store.fill(batch, lambda misses: P.solve_in_pool(misses, args.workers, args.chunk_size))
+    if store is not None:
+      if args.store_evict is not None:
+        store.evict(args.store_evict)
+      if args.store_compact:
+        store.compact()
+      print('Result store: ' + str(store.summary()))
+      store.close()
+    if args.check_undistort and not check_undistort(P, args, batches):
+      raise SystemExit('Distances of the undistort-once pipeline are off by more than the tolerance')
+  else:
+    batches = [P.create_quadrilateral_arr(data, conf.JSON_FLAG)]
+  # P.write_to_json(quadrilateral_arr, conf.JSON_OUTPUT)
+  if args.output is not None:
+    with instrumentation.stats.timer('json_write'), RecordWriter(args.output) as writer:
+      for quadrilateral_arr in batches:
+        writer.write_all(quadrilateral_arr)
+
+  for quadrilateral_arr in batches:
+    if len(batches) > 1:
+      print('Profile: ' + quadrilateral_arr.profile.name)
+    print_results(P, args, quadrilateral_arr)
   
 if __name__== "__main__":
   main()
@@ -1,6 +1,10 @@
 import cv2
 import numpy as np
 import conf
+import profiles
+import instrumentation
+import pnp_batch
+import evaluation
 
 class Point(object):
   def __init__(self, x, y):
@@ -8,10 +12,13 @@ class Point(object):
     self.y = y
 
 class Quadrilateral(object):
-  def __init__(self, id, pts):
+  def __init__(self, id, pts, solve=True, guess=None):
     """
     vertices_2D: in [A,B,C,D] order that maches the exit sign
     url: url to download the original image
+    solve: find the pose right away with cv2.solvePnP. Pass False to solve many
+    quadrilaterals at once with solve_quadrilaterals instead
+    guess: (R_vec, T_vec) to start the solve from, e.g. the pose of the previous video frame
     """
     (A, B, C, D) = self.rearrange_pts(pts)
     self.id = id
@@ -19,14 +26,24 @@ class Quadrilateral(object):
     self.img_size = conf.IMG_SIZE
 
     self.camera_mat = conf.K.tolist()
-    R_vec, T_vec = self.find_R_t(self.vertices_2D)
+    if solve:
+      R_vec, T_vec = self.find_R_t(self.vertices_2D, guess)
+      self.set_pose(R_vec, T_vec)
+
+  def set_pose(self, R_vec, T_vec, horizontal_distance=None):
+    """
+    Store the Extrinsic vectors (3x1) and the horizontal distance computed from them
+    """
     self.R_vec, self.T_vec = R_vec.tolist(), T_vec.tolist()
     # distance = self.find_distance(self.T_vec)
-    # self.distance = np.asscalar(distance)
-    horizontal_distance = self.find_horizontal_distance(R_vec, T_vec)
-    self.distance = np.asscalar(horizontal_distance)
+    # self.distance = distance.item()
+    if horizontal_distance is None:
+      with instrumentation.stats.timer('horizontal_distance'):
+        horizontal_distance = self.find_horizontal_distance(R_vec, T_vec)
+    self.distance = float(horizontal_distance)
 
-  def rearrange_pts(self, pts):
+  @staticmethod
+  def rearrange_pts(pts):
     """
     From 4 corner points of random order, put them in A B C D order of a quadrilateral
     A -------- B
@@ -44,10 +61,11 @@ class Quadrilateral(object):
     # A and D will have smaller x, B and C will have larger x
     (A, D) = (arr[0], arr[1]) if arr[0].y < arr[1].y else (arr[1], arr[0])
     (B, C) = (arr[2], arr[3]) if arr[2].y < arr[3].y else (arr[3], arr[2])
-    pts = self.rotate_vertical_quadrilateral(A,B,C,D)
+    pts = Quadrilateral.rotate_vertical_quadrilateral(A,B,C,D)
     return pts
 
-  def rotate_vertical_quadrilateral(self,A,B,C,D):
+  @staticmethod
+  def rotate_vertical_quadrilateral(A,B,C,D):
     """
     If the quadrilateral is vertical, then return the 90 degree rotate right order
     so that it matches the exit sign
@@ -59,14 +77,19 @@ class Quadrilateral(object):
       return (D,A,B,C)
     return (A,B,C,D)
 
-  def find_R_t(self, pts_2D):
+  def find_R_t(self, pts_2D, guess=None):
     """
     Find R vector and T vector from input 2D image points using PNP algorithm
     Solve PNP docs: 
     https://docs.opencv.org/3.0-beta/modules/calib3d/doc/camera_calibration_and_3d_reconstruction.html#solvepnp
+    guess: (R_vec, T_vec) the iterative solver starts from (useExtrinsicGuess) instead
+    of its own initial pose
     """
-    pts_2D = np.array(pts_2D, dtype=np.float32)
-    ret, R_vec, T_vec = cv2.solvePnP(conf.DEFAULT_VERTICES_3D, pts_2D, conf.K, conf.DIST_COEFFS)
+    stats = instrumentation.stats
+    with stats.timer('solve_pnp'):
+      ret, R_vec, T_vec = solve_pnp(pts_2D, conf.PROFILE, guess)
+    if stats.enabled:
+      stats.count('solved' if ret and np.all(np.isfinite(T_vec)) else 'failed')
     return R_vec, T_vec
 
   def find_distance(self, T_vec):
@@ -80,11 +103,7 @@ class Quadrilateral(object):
     Calculate the horizontal distance, which is the dot product of T_vec and 
     the unit normal vector of the sign (with respect to the camera reference system)
     """
-    R_mat, jacobian = cv2.Rodrigues(R_vec)
-    normal_vec_w = np.array([[0],[0],[1]], dtype=np.float32)
-    normal_vec_c = np.matmul(R_mat, normal_vec_w)
-    horizontal_distance = -np.dot(np.ravel(T_vec), np.ravel(normal_vec_c))
-    return horizontal_distance
+    return horizontal_distance(R_vec, T_vec)
 
   # def find_horizontal_distance(self, R_vec, T_vec):
   #   """
@@ -104,17 +123,265 @@ class Quadrilateral(object):
     """
     Project the 3D exit sign coodinates back to 2D given the computed Extrinsic vectors
     """
-    pts_2D, jacobian = cv2.projectPoints(pts_3D, np.array(R_vec), np.array(T_vec), conf.K, conf.DIST_COEFFS)
-    projected_vertices_2D = np.reshape(pts_2D, (-1,2))
-    return np.int32(projected_vertices_2D)
+    with instrumentation.stats.timer('projection'):
+      return project_2D(R_vec, T_vec, pts_3D, conf.PROFILE)
 
   def find_projection_err(self, vertices_2D):
     """
     Calculate the average error (in pixels) between the labeled vertices and the 
     projected vertices of a quadrilateral
     """
-    vertices_2D = np.array(vertices_2D)
-    projected_vertices_2D = self.project_2D(self.R_vec, self.T_vec, conf.DEFAULT_VERTICES_3D)  
-    err = np.sum(np.abs(vertices_2D - projected_vertices_2D), axis=0)/len(vertices_2D)
-    return err.tolist()
+    return projection_err(vertices_2D, self.R_vec, self.T_vec, conf.PROFILE).tolist()
+
+def solve_pnp(pts_2D, profile, guess=None):
+  """
+  cv2.solvePnP of the 4 ordered corners of one sign with the camera of a profile
+  Returns (ret, R_vec, T_vec)
+  """
+  pts_2D = np.array(pts_2D, dtype=np.float32)
+  if guess is None:
+    return cv2.solvePnP(profile.DEFAULT_VERTICES_3D, pts_2D, profile.K, profile.DIST_COEFFS)
+  R_guess = np.array(guess[0], dtype=np.float64).reshape(3, 1)
+  T_guess = np.array(guess[1], dtype=np.float64).reshape(3, 1)
+  return cv2.solvePnP(profile.DEFAULT_VERTICES_3D, pts_2D, profile.K, profile.DIST_COEFFS,
+                      R_guess, T_guess, useExtrinsicGuess=True, flags=cv2.SOLVEPNP_ITERATIVE)
+
+def horizontal_distance(R_vec, T_vec):
+  """
+  Horizontal distance of one pose, see Quadrilateral.find_horizontal_distance
+  """
+  R_mat, jacobian = cv2.Rodrigues(np.array(R_vec))
+  normal_vec_w = np.array([[0],[0],[1]], dtype=np.float32)
+  normal_vec_c = np.matmul(R_mat, normal_vec_w)
+  return -np.dot(np.ravel(T_vec), np.ravel(normal_vec_c))
+
+def project_2D(R_vec, T_vec, pts_3D, profile):
+  """
+  Projection of 3D sign points, truncated to whole pixels
+  """
+  pts_2D, jacobian = cv2.projectPoints(pts_3D, np.array(R_vec), np.array(T_vec), profile.K, profile.DIST_COEFFS)
+  return np.int32(np.reshape(pts_2D, (-1,2)))
+
+def projection_err(vertices_2D, R_vec, T_vec, profile):
+  """
+  Average error (in pixels) in x and y between the labeled vertices and the projected
+  vertices, rounded to whole pixels, of one sign
+  """
+  vertices_2D = np.array(vertices_2D)
+  projected_vertices_2D = project_2D(R_vec, T_vec, profile.DEFAULT_VERTICES_3D, profile)
+  return np.sum(np.abs(vertices_2D - projected_vertices_2D), axis=0)/len(vertices_2D)
+
+def solve_objects(vertices_2D, profile):
+  """
+  Solve an Nx4x2 array of ordered corners one sign at a time, exactly like Quadrilateral
+  objects are solved (cv2.solvePnP, rounded projection errors), so that the results are
+  those of a serial run
+  Returns (R_vecs, T_vecs, distances, proj_errors) arrays
+  """
+  n = len(vertices_2D)
+  R_vecs, T_vecs = np.zeros((n, 3)), np.zeros((n, 3))
+  distances, proj_errors = np.zeros(n), np.zeros((n, 2))
+  for i, pts in enumerate(vertices_2D):
+    ret, R_vec, T_vec = solve_pnp(pts, profile)
+    R_vecs[i], T_vecs[i] = R_vec.ravel(), T_vec.ravel()
+    distances[i] = horizontal_distance(R_vec, T_vec)
+    proj_errors[i] = projection_err(pts, R_vec.tolist(), T_vec.tolist(), profile)
+  return R_vecs, T_vecs, distances, proj_errors
+
+def count_solved(distances):
+  """
+  Add the objects with and without a distance to the solved and failed counters
+  """
+  stats = instrumentation.stats
+  if stats.enabled:
+    solved = int(np.sum(np.isfinite(distances)))
+    stats.count('solved', solved)
+    stats.count('failed', len(distances) - solved)
+
+def solve_quadrilaterals(quadrilateral_arr):
+  """
+  Find the pose and horizontal distance of every quadrilateral in one batch
+  (see pnp_batch.find_R_t_batch) instead of one cv2.solvePnP call per object
+  """
+  if len(quadrilateral_arr) == 0:
+    return quadrilateral_arr
+  corners = np.array([q.vertices_2D for q in quadrilateral_arr], dtype=np.float64)
+  with instrumentation.stats.timer('pose_solve_batch'):
+    R_vecs, T_vecs, distances = pnp_batch.solve_batch(corners)
+  count_solved(distances)
+  for quadrilateral, R_vec, T_vec, distance in zip(quadrilateral_arr, R_vecs, T_vecs, distances):
+    quadrilateral.set_pose(R_vec.reshape(3, 1), T_vec.reshape(3, 1), distance)
+  return quadrilateral_arr
+
+class QuadrilateralBatch(object):
+  def __init__(self, ids, vertices_2D, real_distances=None, profile=None, undistort_once=False, signs=None):
+    """
+    Struct-of-arrays alternative to a list of Quadrilateral objects
+    ids: N image ids
+    vertices_2D: Nx4x2 corners, already in [A,B,C,D] order
+    real_distances: N measured distances (groundtruth dataset only)
+    profile: camera profile (see profiles.py) of all the objects, conf.PROFILE by default
+    undistort_once: undistort all the corners in one call and solve and reproject them
+    with distortion-free math (see pnp_batch.solve_undistorted_batch)
+    signs: N indices of the objects among the signs of their image, -1 for the only sign of
+    an image (None when no image has several signs)
+    The camera intrinsics are kept once for the whole batch, and the poses,
+    distances and projection errors are computed together the first time
+    one of them is read
+    """
+    self.ids = np.array(ids, dtype=str).reshape(-1)
+    self.vertices_2D = np.ascontiguousarray(vertices_2D).reshape(-1, 4, 2)
+    self.real_distances = None if real_distances is None else np.asarray(real_distances)
+    self.signs = None if signs is None else np.asarray(signs, dtype=int)
+    self.profile = conf.PROFILE if profile is None else profile
+    self.img_size = self.profile.IMG_SIZE
+    self.camera_mat = self.profile.K
+    self.undistort_once = undistort_once
+    self._R_vecs = self._T_vecs = self._distances = self._proj_errors = None
+    self._normalized = None
+    self._reasons = None
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __getitem__(self, i):
+    """
+    Quadrilateral view of the i-th object, with the same attributes as one built
+    by Quadrilateral.__init__
+    """
+    quadrilateral = Quadrilateral.__new__(Quadrilateral)
+    quadrilateral.id = str(self.ids[i])
+    quadrilateral.vertices_2D = self.vertices_2D[i].tolist()
+    quadrilateral.img_size = self.img_size
+    quadrilateral.camera_mat = self.camera_mat.tolist()
+    quadrilateral.R_vec = self.R_vecs[i].reshape(3, 1).tolist()
+    quadrilateral.T_vec = self.T_vecs[i].reshape(3, 1).tolist()
+    quadrilateral.distance = float(self.distances[i])
+    if self.real_distances is not None:
+      quadrilateral.real_distance = self.real_distances[i].item()
+    if self.signs is not None and self.signs[i] >= 0:
+      quadrilateral.sign = self.signs[i].item()
+    return quadrilateral
+
+  def select(self, indices):
+    """
+    New batch with the objects at the given indices (or boolean mask), and their
+    results if they are already computed
+    """
+    batch = QuadrilateralBatch(self.ids[indices], self.vertices_2D[indices],
+                               None if self.real_distances is None else self.real_distances[indices],
+                               self.profile, self.undistort_once,
+                               None if self.signs is None else self.signs[indices])
+    if self._R_vecs is not None:
+      batch.set_results(self._R_vecs[indices], self._T_vecs[indices], self._distances[indices],
+                        None if self._proj_errors is None else self._proj_errors[indices])
+    return batch
+
+  def solve(self):
+    """
+    Find the poses and horizontal distances of all the objects in one batch
+    """
+    with instrumentation.stats.timer('pose_solve_batch'):
+      if self.undistort_once:
+        self._R_vecs, self._T_vecs, self._distances = pnp_batch.solve_undistorted_batch(
+          self.normalized, self.camera_mat, self.profile.DEFAULT_VERTICES_3D)
+      else:
+        self._R_vecs, self._T_vecs, self._distances = pnp_batch.solve_batch(
+          self.vertices_2D, self.camera_mat, self.profile.DIST_COEFFS, self.profile.DEFAULT_VERTICES_3D,
+          self.camera_mat_inv)
+    count_solved(self._distances)
+    return self
+
+  def set_results(self, R_vecs, T_vecs, distances, proj_errors=None):
+    """
+    Fill in results computed elsewhere, e.g. by solve_chunk in worker processes
+    """
+    self._R_vecs, self._T_vecs, self._distances = R_vecs, T_vecs, distances
+    self._proj_errors = proj_errors
+    return self
+
+  @property
+  def camera_mat_inv(self):
+    """
+    Inverse of camera_mat, kept by the profile (None if camera_mat was replaced)
+    """
+    return self.profile.K_INV if self.camera_mat is self.profile.K else None
+
+  @property
+  def normalized(self):
+    """
+    Nx4x2 undistorted normalized coordinates of the corners, computed once
+    """
+    if self._normalized is None:
+      self._normalized = pnp_batch.normalize_2D_batch(self.vertices_2D, self.camera_mat, self.profile.DIST_COEFFS,
+                                                      self.camera_mat_inv)
+    return self._normalized
+
+  @property
+  def reasons(self):
+    """
+    N reason codes of pnp_batch.quad_reasons_batch, QUAD_OK for the usable corners
+    """
+    if self._reasons is None:
+      self._reasons = pnp_batch.quad_reasons_batch(self.vertices_2D)
+    return self._reasons
+
+  @property
+  def R_vecs(self):
+    if self._R_vecs is None:
+      self.solve()
+    return self._R_vecs
+
+  @property
+  def T_vecs(self):
+    if self._T_vecs is None:
+      self.solve()
+    return self._T_vecs
+
+  @property
+  def distances(self):
+    if self._distances is None:
+      self.solve()
+    return self._distances
+
+  @property
+  def proj_errors(self):
+    """
+    Nx2 average error (in pixels) in x and y between the labeled vertices and the
+    projected vertices of each quadrilateral, without rounding the projections
+    (in undistorted pixels with undistort_once)
+    """
+    if self._proj_errors is None and self.undistort_once:
+      residuals = evaluation.undistorted_projection_residuals(self.normalized, self.R_vecs, self.T_vecs,
+                                                              self.camera_mat, self.profile.DEFAULT_VERTICES_3D)
+      self._proj_errors = np.mean(np.abs(residuals), axis=1)
+    elif self._proj_errors is None:
+      residuals = evaluation.projection_residuals(self.vertices_2D, self.R_vecs, self.T_vecs, self.camera_mat,
+                                                  self.profile.DIST_COEFFS, self.profile.DEFAULT_VERTICES_3D)
+      self._proj_errors = np.mean(np.abs(residuals), axis=1)
+    return self._proj_errors
 
+def solve_chunk(vertices_2D, profile_name=None, undistort_once=False, batch_solver=False):
+  """
+  Solve an Nx4x2 chunk of ordered corners and return the results as plain arrays
+  (R_vecs, T_vecs, distances, proj_errors), which are cheap to send between processes
+  profile_name: registered camera profile of the chunk, conf.PROFILE by default
+  The signs are solved like Quadrilateral objects (see solve_objects), unless
+  undistort_once or batch_solver ask for the vectorized solver of QuadrilateralBatch
+  """
+  profile = conf.PROFILE if profile_name is None else profiles.get_profile(profile_name)
+  if not (undistort_once or batch_solver):
+    return solve_objects(vertices_2D, profile)
+  batch = QuadrilateralBatch(np.zeros(len(vertices_2D), dtype=str), vertices_2D, profile=profile,
+                             undistort_once=undistort_once)
+  if undistort_once:
+    R_vecs, T_vecs, distances = pnp_batch.solve_undistorted_batch(batch.normalized, batch.camera_mat,
+                                                                 profile.DEFAULT_VERTICES_3D)
+  else:
+    R_vecs, T_vecs, distances = pnp_batch.solve_batch(batch.vertices_2D, batch.camera_mat, profile.DIST_COEFFS,
+                                                      profile.DEFAULT_VERTICES_3D, batch.camera_mat_inv)
+  return R_vecs, T_vecs, distances, batch.set_results(R_vecs, T_vecs, distances).proj_errors
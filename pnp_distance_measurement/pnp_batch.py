@@ -0,0 +1,434 @@
+import cv2
+import numpy as np
+import conf
+
+# Horizontal distances from solve_batch agree with the per-object cv2.solvePnP
+# results in data/json/*-results-*.json to within this many meters. The exceptions
+# (2 of 2647 signs) are poorly fitting labels where the two solvers stop at different
+# points of a flat cost surface; there the batch pose has the lower reprojection error
+DISTANCE_TOL = 1e-4
+# Relative difference between the horizontal distances of solve_undistorted_batch and
+# solve_batch. Both are the same problem without distortion; with the street profiles'
+# distortion they minimize the error in undistorted instead of distorted pixels, which
+# moves the distances by less than 0.04%
+UNDISTORT_DISTANCE_TOL = 1e-3
+# Reason codes of quad_reasons_batch, in the order they are checked
+QUAD_OK = 0
+QUAD_NOT_FINITE = 1
+QUAD_COLLINEAR = 2
+QUAD_SELF_INTERSECTING = 3
+QUAD_TOO_SMALL = 4
+QUAD_NON_CONVEX = 5
+QUAD_REASONS = {QUAD_OK: 'ok', QUAD_NOT_FINITE: 'not_finite', QUAD_COLLINEAR: 'collinear',
+                QUAD_SELF_INTERSECTING: 'self_intersecting', QUAD_TOO_SMALL: 'too_small',
+                QUAD_NON_CONVEX: 'non_convex'}
+# Quads with less area (in square pixels), or with a corner whose sine is smaller
+# (about 3 degrees), do not constrain a pose
+MIN_QUAD_AREA = 16.0
+MIN_CORNER_SINE = 0.05
+
+def _camera_args(K, dist_coeffs, vertices_3D):
+  """
+  Fill in the camera profile arguments that were not given from conf
+  """
+  K = np.asarray(conf.K if K is None else K, dtype=np.float64)
+  dist_coeffs = conf.DIST_COEFFS if dist_coeffs is None else dist_coeffs
+  dist_coeffs = np.ravel(np.asarray(dist_coeffs, dtype=np.float64))
+  vertices_3D = conf.DEFAULT_VERTICES_3D if vertices_3D is None else vertices_3D
+  vertices_3D = np.asarray(vertices_3D, dtype=np.float64)
+  return K, dist_coeffs, vertices_3D
+
+def _skew(v):
+  """
+  Cross product matrices of an Nx3 array of vectors
+  """
+  zero = np.zeros(len(v))
+  return np.stack([np.stack([zero, -v[:, 2], v[:, 1]], axis=-1),
+                   np.stack([v[:, 2], zero, -v[:, 0]], axis=-1),
+                   np.stack([-v[:, 1], v[:, 0], zero], axis=-1)], axis=1)
+
+def rodrigues_batch(R_vecs):
+  """
+  Convert an Nx3 array of rotation vectors to an Nx3x3 array of rotation matrices,
+  same as calling cv2.Rodrigues on each of them
+  """
+  R_vecs = np.asarray(R_vecs, dtype=np.float64).reshape(-1, 3)
+  theta2 = np.sum(R_vecs ** 2, axis=1)
+  theta = np.sqrt(theta2)
+  small = theta < 1e-6
+  safe_theta = np.where(small, 1.0, theta)
+  # Taylor expansions of sin(t)/t and (1-cos(t))/t^2 around 0
+  a = np.where(small, 1 - theta2/6, np.sin(safe_theta)/safe_theta)
+  b = np.where(small, 0.5 - theta2/24, (1 - np.cos(safe_theta))/safe_theta**2)
+  W = _skew(R_vecs)
+  return np.eye(3) + a[:, None, None]*W + b[:, None, None]*np.matmul(W, W)
+
+def rotation_to_rodrigues_batch(R_mats):
+  """
+  Convert an Nx3x3 array of rotation matrices to an Nx3 array of rotation vectors,
+  same as calling cv2.Rodrigues on each of them
+  """
+  R_mats = np.asarray(R_mats, dtype=np.float64).reshape(-1, 3, 3)
+  axis = np.stack([R_mats[:, 2, 1] - R_mats[:, 1, 2],
+                   R_mats[:, 0, 2] - R_mats[:, 2, 0],
+                   R_mats[:, 1, 0] - R_mats[:, 0, 1]], axis=-1)
+  sin_theta = np.sqrt(np.sum(axis**2, axis=1)*0.25)
+  cos_theta = np.clip((np.trace(R_mats, axis1=1, axis2=2) - 1)*0.5, -1.0, 1.0)
+  theta = np.arccos(cos_theta)
+  small = sin_theta < 1e-5
+  R_vecs = axis*(theta/(2*np.where(small, 1.0, sin_theta)))[:, None]
+  R_vecs[small & (cos_theta > 0)] = 0
+
+  # Close to 180 degrees the antisymmetric part vanishes, so the axis is read
+  # from the diagonal instead, with the signs taken from the first row
+  flipped = np.flatnonzero(small & (cos_theta <= 0))
+  if len(flipped):
+    R = R_mats[flipped]
+    k = np.sqrt(np.clip((np.diagonal(R, axis1=1, axis2=2) + 1)*0.5, 0, None))
+    k[:, 1] *= np.where(R[:, 0, 1] < 0, -1, 1)
+    k[:, 2] *= np.where(R[:, 0, 2] < 0, -1, 1)
+    swap = (np.abs(k[:, 0]) < np.abs(k[:, 1])) & (np.abs(k[:, 0]) < np.abs(k[:, 2])) & \
+           ((R[:, 1, 2] > 0) != (k[:, 1]*k[:, 2] > 0))
+    k[swap, 2] *= -1
+    R_vecs[flipped] = k*(theta[flipped]/np.linalg.norm(k, axis=1))[:, None]
+  return R_vecs
+
+def project_2D_batch(R_vecs, T_vecs, pts_3D, K=None, dist_coeffs=None, R_mats=None):
+  """
+  Project the 3D points of every object to the image given the Nx3 Extrinsic vectors,
+  same model as cv2.projectPoints (up to 5 distortion coefficients k1 k2 p1 p2 k3).
+  pts_3D is Mx3 (shared by all objects) or NxMx3. Returns an NxMx2 float array
+  """
+  K, dist_coeffs, pts_3D = _camera_args(K, dist_coeffs, pts_3D)
+  T_vecs = np.asarray(T_vecs, dtype=np.float64).reshape(-1, 3)
+  if R_mats is None:
+    R_mats = rodrigues_batch(R_vecs)
+  pts_c = np.matmul(pts_3D, np.swapaxes(R_mats, 1, 2)) + T_vecs[:, None, :]
+  x = pts_c[..., 0]/pts_c[..., 2]
+  y = pts_c[..., 1]/pts_c[..., 2]
+  coeffs = np.zeros(5)
+  coeffs[:min(len(dist_coeffs), 5)] = dist_coeffs[:5]
+  k1, k2, p1, p2, k3 = coeffs
+  if np.any(coeffs):
+    r2 = x*x + y*y
+    radial = 1 + r2*(k1 + r2*(k2 + r2*k3))
+    x, y = x*radial + 2*p1*x*y + p2*(r2 + 2*x*x), \
+           y*radial + p1*(r2 + 2*y*y) + 2*p2*x*y
+  u = K[0, 0]*x + K[0, 1]*y + K[0, 2]
+  v = K[1, 1]*y + K[1, 2]
+  return np.stack([u, v], axis=-1)
+
+def normalize_2D_batch(corners, K=None, dist_coeffs=None, K_inv=None):
+  """
+  Map an NxMx2 array of pixel coordinates to normalized (undistorted, K-free)
+  camera coordinates in a single call
+  K_inv: inverse of K if it is known, e.g. CameraProfile.K_INV (the inverse of the conf
+  K by default)
+  """
+  if K is None and K_inv is None:
+    K_inv = conf.PROFILE.K_INV
+  K, dist_coeffs, _ = _camera_args(K, dist_coeffs, None)
+  corners = np.asarray(corners, dtype=np.float64)
+  shape = corners.shape
+  if np.any(dist_coeffs):
+    pts = cv2.undistortPoints(corners.reshape(-1, 1, 2), K, dist_coeffs)
+    return pts.reshape(shape)
+  pts = np.concatenate([corners.reshape(-1, 2), np.ones((corners.size//2, 1))], axis=1)
+  return np.matmul(pts, (np.linalg.inv(K) if K_inv is None else K_inv).T)[:, :2].reshape(shape)
+
+def homography_pose_batch(normalized, vertices_3D):
+  """
+  Closed-form pose of the planar target from the homography between the target
+  plane (z = 0) and the normalized image points
+  """
+  n = len(normalized)
+  X, Y = vertices_3D[:, 0], vertices_3D[:, 1]
+  x, y = normalized[..., 0], normalized[..., 1]
+  ones, zeros = np.ones_like(x), np.zeros_like(x)
+  Xn, Yn = np.broadcast_to(X, x.shape), np.broadcast_to(Y, x.shape)
+  rows_x = np.stack([Xn, Yn, ones, zeros, zeros, zeros, -x*Xn, -x*Yn], axis=-1)
+  rows_y = np.stack([zeros, zeros, zeros, Xn, Yn, ones, -y*Xn, -y*Yn], axis=-1)
+  A = np.concatenate([rows_x, rows_y], axis=1)
+  b = np.concatenate([x, y], axis=1)
+
+  # Collinear or repeated corners make the system singular; those objects get NaN poses
+  singular = ~(np.abs(np.linalg.det(A)) > 1e-12)
+  A[singular] = np.eye(8)
+  h = np.linalg.solve(A, b[..., None])[..., 0]
+  H = np.concatenate([h, np.ones((n, 1))], axis=1).reshape(n, 3, 3)
+
+  # Same initial guess as cv2.solvePnP: normalized columns, orthogonalized with an SVD
+  h1, h2, h3 = H[:, :, 0], H[:, :, 1], H[:, :, 2]
+  h1_norm, h2_norm = np.linalg.norm(h1, axis=1), np.linalg.norm(h2, axis=1)
+  r1 = h1/np.maximum(h1_norm, np.finfo(float).eps)[:, None]
+  r2 = h2/np.maximum(h2_norm, np.finfo(float).eps)[:, None]
+  U, _, Vt = np.linalg.svd(np.stack([r1, r2, np.cross(r1, r2)], axis=-1))
+  R = np.matmul(U, Vt)
+  T = h3*(2/np.maximum(h1_norm + h2_norm, np.finfo(float).eps))[:, None]
+  R[singular] = np.nan
+  T[singular] = np.nan
+  return R, T
+
+def _solve_normal_equations(A, b):
+  """
+  Solve the damped normal equations of every object, least squares for the singular ones
+  """
+  try:
+    return np.linalg.solve(A, b[..., None])[..., 0]
+  except np.linalg.LinAlgError:
+    pass
+  singular = ~(np.abs(np.linalg.det(A)) > 1e-300)
+  x = np.empty_like(b)
+  x[~singular] = np.linalg.solve(A[~singular], b[~singular][..., None])[..., 0]
+  if np.any(singular):
+    x[singular] = np.matmul(np.linalg.pinv(A[singular]), b[singular][..., None])[..., 0]
+  return x
+
+def _rodrigues_jacobian_batch(R_vecs, R_mats):
+  """
+  Derivatives of the rotation matrices with respect to the rotation vector
+  components, Nx3x3x3 with the component on the second axis
+  """
+  theta2 = np.sum(R_vecs**2, axis=1)
+  small = theta2 < 1e-12
+  eye = np.eye(3)
+  dR = np.empty((len(R_vecs), 3, 3, 3))
+  W = _skew(R_vecs)
+  for i in range(3):
+    # dR/dv_i = (v_i [v]x + [v x (I - R) e_i]x) R / |v|^2, or [e_i]x at the identity
+    w = np.cross(R_vecs, eye[i] - R_mats[:, :, i])
+    term = (R_vecs[:, i, None, None]*W + _skew(w))/np.where(small, 1.0, theta2)[:, None, None]
+    dR[:, i] = np.where(small[:, None, None], _skew(np.tile(eye[i], (len(R_vecs), 1))),
+                        np.matmul(term, R_mats))
+  return dR
+
+def _project_with_jacobian(params, pts_3D, K, dist_coeffs):
+  """
+  Project pts_3D (Mx3) for every (R_vec, T_vec) row of params and return the
+  projections (NxMx2) together with their derivatives with respect to params (NxMx2x6)
+  """
+  R_vecs, T_vecs = params[:, :3], params[:, 3:]
+  R_mats = rodrigues_batch(R_vecs)
+  pts_c = np.matmul(pts_3D, np.swapaxes(R_mats, 1, 2)) + T_vecs[:, None, :]
+  inv_z = 1/pts_c[..., 2]
+  x, y = pts_c[..., 0]*inv_z, pts_c[..., 1]*inv_z
+  coeffs = np.zeros(5)
+  coeffs[:min(len(dist_coeffs), 5)] = dist_coeffs[:5]
+  k1, k2, p1, p2, k3 = coeffs
+  if np.any(coeffs):
+    r2 = x*x + y*y
+    radial = 1 + r2*(k1 + r2*(k2 + r2*k3))
+    d_radial = k1 + r2*(2*k2 + 3*k3*r2)
+    xd = x*radial + 2*p1*x*y + p2*(r2 + 2*x*x)
+    yd = y*radial + p1*(r2 + 2*y*y) + 2*p2*x*y
+    dxd_dx = radial + 2*x*x*d_radial + 2*p1*y + 6*p2*x
+    dxd_dy = 2*x*y*d_radial + 2*p1*x + 2*p2*y
+    dyd_dx = 2*x*y*d_radial + 2*p1*x + 2*p2*y
+    dyd_dy = radial + 2*y*y*d_radial + 6*p1*y + 2*p2*x
+  else:
+    # Distortion-free camera (e.g. corners undistorted once up front)
+    xd, yd = x, y
+    dxd_dx = dyd_dy = np.ones_like(x)
+    dxd_dy = dyd_dx = np.zeros_like(x)
+  fx, s, cx, fy, cy = K[0, 0], K[0, 1], K[0, 2], K[1, 1], K[1, 2]
+  proj = np.stack([fx*xd + s*yd + cx, fy*yd + cy], axis=-1)
+
+  # Chain rule: params -> camera coordinates -> normalized -> distorted -> pixels
+  du_dx, du_dy = fx*dxd_dx + s*dyd_dx, fx*dxd_dy + s*dyd_dy
+  dv_dx, dv_dy = fy*dyd_dx, fy*dyd_dy
+  dp_dc = np.empty(x.shape + (2, 3))
+  dp_dc[..., 0, 0], dp_dc[..., 0, 1] = du_dx*inv_z, du_dy*inv_z
+  dp_dc[..., 0, 2] = -(du_dx*x + du_dy*y)*inv_z
+  dp_dc[..., 1, 0], dp_dc[..., 1, 1] = dv_dx*inv_z, dv_dy*inv_z
+  dp_dc[..., 1, 2] = -(dv_dx*x + dv_dy*y)*inv_z
+
+  dc_dr = np.einsum('nijk,mk->nmji', _rodrigues_jacobian_batch(R_vecs, R_mats), pts_3D)
+  J = np.empty(x.shape + (2, 6))
+  J[..., :3] = np.matmul(dp_dc, dc_dr)
+  J[..., 3:] = dp_dc
+  return proj, J
+
+def _refine_pose(R_vecs, T_vecs, corners, vertices_3D, K, dist_coeffs, max_iter):
+  """
+  Levenberg-Marquardt refinement of the reprojection error in pixels, run with the
+  same parameters, damping schedule and stopping rule as cv2.solvePnP (SOLVEPNP_ITERATIVE)
+  so that both end up at the same pose. Every object keeps its own state, so the
+  result for one object does not depend on the rest of the batch
+  """
+  def residuals(params, pts):
+    return (project_2D_batch(params[:, :3], params[:, 3:], vertices_3D, K, dist_coeffs) - pts).reshape(len(params), -1)
+
+  def normal_equations(params, pts):
+    proj, J = _project_with_jacobian(params, vertices_3D, K, dist_coeffs)
+    res = (proj - pts).reshape(len(params), -1)
+    J = J.reshape(len(params), -1, 6)
+    Jt = np.swapaxes(J, 1, 2)
+    return np.matmul(Jt, J), np.matmul(Jt, res[..., None])[..., 0], np.linalg.norm(res, axis=1)
+
+  params = np.concatenate([R_vecs, T_vecs], axis=1)
+  active = np.flatnonzero(np.all(np.isfinite(params), axis=1))
+  JtJ = np.zeros((len(params), 6, 6))
+  JtErr = np.zeros((len(params), 6))
+  err_norm = np.zeros(len(params))
+  if len(active):
+    JtJ[active], JtErr[active], err_norm[active] = normal_equations(params[active], corners[active])
+  lambda_lg10 = np.full(len(params), -3)
+  iters = np.zeros(len(params), dtype=int)
+  while len(active):
+    A = JtJ[active].copy()
+    A[:, np.arange(6), np.arange(6)] *= 1 + 10.0**lambda_lg10[active][:, None]
+    step = _solve_normal_equations(A, JtErr[active])
+    candidate = params[active] - step
+    new_err_norm = np.linalg.norm(residuals(candidate, corners[active]), axis=1)
+
+    # A worse candidate is retried from the same pose with more damping, until
+    # the damping runs out
+    lambda_lg10[active] += np.where(new_err_norm > err_norm[active], 1, 0)
+    retry = (new_err_norm > err_norm[active]) & (lambda_lg10[active] <= 16)
+    taken = active[~retry]
+    candidate, new_err_norm, step = candidate[~retry], new_err_norm[~retry], step[~retry]
+    lambda_lg10[taken] = np.maximum(lambda_lg10[taken] - 1, -16)
+    iters[taken] += 1
+    change = np.linalg.norm(step, axis=1)/np.maximum(np.linalg.norm(params[taken], axis=1), np.finfo(float).tiny)
+    params[taken] = candidate
+    done = (iters[taken] >= max_iter) | (change < np.finfo(np.float32).eps)
+    again = taken[~done]
+    if len(again):
+      JtJ[again], JtErr[again], err_norm[again] = normal_equations(params[again], corners[again])
+    active = np.concatenate([active[retry], again])
+  return params[:, :3], params[:, 3:]
+
+def find_R_t_batch(corners, K=None, dist_coeffs=None, vertices_3D=None, max_iter=20, K_inv=None):
+  """
+  Find the R vectors and T vectors of N planar objects at once.
+  corners: Nx4x2 image points in the same order as vertices_3D (A B C D)
+  K, dist_coeffs, vertices_3D: camera profile, conf values by default
+  K_inv: see normalize_2D_batch
+  Returns (R_vecs, T_vecs), both Nx3. Objects with degenerate corners get NaN
+  """
+  K, dist_coeffs, vertices_3D = _camera_args(K, dist_coeffs, vertices_3D)
+  corners = np.asarray(corners, dtype=np.float64).reshape(-1, len(vertices_3D), 2)
+  if len(corners) == 0:
+    return np.zeros((0, 3)), np.zeros((0, 3))
+  normalized = normalize_2D_batch(corners, K, dist_coeffs, K_inv)
+  R_mats, T_vecs = homography_pose_batch(normalized, vertices_3D)
+  return _refine_pose(rotation_to_rodrigues_batch(R_mats), T_vecs, corners, vertices_3D,
+                      K, dist_coeffs, max_iter)
+
+def undistorted_pixels_batch(normalized, K=None):
+  """
+  Pixel coordinates of an NxMx2 array of normalized camera coordinates through a
+  distortion-free camera with the same K
+  """
+  K, _, _ = _camera_args(K, None, None)
+  normalized = np.asarray(normalized, dtype=np.float64)
+  return np.stack([K[0, 0]*normalized[..., 0] + K[0, 1]*normalized[..., 1] + K[0, 2],
+                   K[1, 1]*normalized[..., 1] + K[1, 2]], axis=-1)
+
+def find_R_t_undistorted_batch(normalized, K=None, vertices_3D=None, max_iter=20):
+  """
+  find_R_t_batch for corners that were already undistorted once by normalize_2D_batch.
+  The reprojection error is minimized in the pixels of a distortion-free camera with the
+  same K, so the refinement skips the distortion model. Without distortion this is the
+  same problem as find_R_t_batch; with it the distances agree within UNDISTORT_DISTANCE_TOL
+  """
+  K, _, vertices_3D = _camera_args(K, None, vertices_3D)
+  normalized = np.asarray(normalized, dtype=np.float64).reshape(-1, len(vertices_3D), 2)
+  if len(normalized) == 0:
+    return np.zeros((0, 3)), np.zeros((0, 3))
+  R_mats, T_vecs = homography_pose_batch(normalized, vertices_3D)
+  return _refine_pose(rotation_to_rodrigues_batch(R_mats), T_vecs, undistorted_pixels_batch(normalized, K),
+                      vertices_3D, K, np.zeros(0), max_iter)
+
+def find_horizontal_distance_batch(R_vecs, T_vecs):
+  """
+  Calculate the horizontal distances, the dot products of each T_vec and the
+  unit normal vector of its sign (with respect to the camera reference system)
+  """
+  normal_vecs_c = rodrigues_batch(R_vecs)[:, :, 2]
+  return -np.sum(np.asarray(T_vecs, dtype=np.float64).reshape(-1, 3)*normal_vecs_c, axis=1)
+
+def solve_batch(corners, K=None, dist_coeffs=None, vertices_3D=None, K_inv=None):
+  """
+  Find the R vectors, T vectors and horizontal distances of N objects in one pass
+  """
+  R_vecs, T_vecs = find_R_t_batch(corners, K, dist_coeffs, vertices_3D, K_inv=K_inv)
+  return R_vecs, T_vecs, find_horizontal_distance_batch(R_vecs, T_vecs)
+
+def solve_undistorted_batch(normalized, K=None, vertices_3D=None):
+  """
+  solve_batch for corners already undistorted by normalize_2D_batch
+  """
+  R_vecs, T_vecs = find_R_t_undistorted_batch(normalized, K, vertices_3D)
+  return R_vecs, T_vecs, find_horizontal_distance_batch(R_vecs, T_vecs)
+
+def rearrange_pts_batch(corners):
+  """
+  Put the 4 corners of each of N quadrilaterals, in random order, in A B C D order,
+  same as calling Quadrilateral.rearrange_pts on each of them (including the
+  rotation of vertical quadrilaterals)
+  """
+  corners = np.asarray(corners).reshape(-1, 4, 2)
+  order = np.lexsort((corners[:, :, 1], corners[:, :, 0]), axis=-1)
+  arr = np.take_along_axis(corners, order[:, :, None], axis=1)
+  # A and D will have smaller x, B and C will have larger x
+  swap_left = ~(arr[:, 0, 1] < arr[:, 1, 1])
+  swap_right = ~(arr[:, 2, 1] < arr[:, 3, 1])
+  A = np.where(swap_left[:, None], arr[:, 1], arr[:, 0])
+  D = np.where(swap_left[:, None], arr[:, 0], arr[:, 1])
+  B = np.where(swap_right[:, None], arr[:, 3], arr[:, 2])
+  C = np.where(swap_right[:, None], arr[:, 2], arr[:, 3])
+  ordered = np.stack([A, B, C, D], axis=1)
+  # Vertical quadrilaterals (|AB| < |AD|) are rotated to D A B C
+  AB = (A - B).astype(np.float64)
+  AD = (A - D).astype(np.float64)
+  vertical = np.sum(AB**2, axis=1)**0.5 < np.sum(AD**2, axis=1)**0.5
+  ordered[vertical] = np.roll(ordered[vertical], 1, axis=1)
+  return ordered
+
+def _cross(u, v):
+  return u[..., 0]*v[..., 1] - u[..., 1]*v[..., 0]
+
+def _segments_cross(p1, p2, p3, p4):
+  """
+  Whether the segments p1p2 and p3p4 of N pairs cross each other at a single inner point
+  """
+  return (_cross(p2 - p1, p3 - p1)*_cross(p2 - p1, p4 - p1) < 0) & \
+         (_cross(p4 - p3, p1 - p3)*_cross(p4 - p3, p2 - p3) < 0)
+
+def quad_reasons_batch(ordered, min_area=MIN_QUAD_AREA, min_sine=MIN_CORNER_SINE):
+  """
+  Reason code (QUAD_REASONS) of every quadrilateral of an Nx4x2 array of corners in
+  A B C D order: QUAD_OK, or the first of not finite corners, 3 corners on a line (a
+  corner whose sine is below min_sine, or 2 equal corners), crossing sides, less area
+  than min_area, or a reflex corner. Such labels give meaningless poses. The shape is
+  checked before the area, since the signed area of a bow-tie or of a flat quad is
+  small whatever its size
+  """
+  q = np.asarray(ordered, dtype=np.float64).reshape(-1, 4, 2)
+  reasons = np.full(len(q), QUAD_OK, dtype=np.int8)
+
+  def flag(mask, reason):
+    reasons[(reasons == QUAD_OK) & mask] = reason
+
+  flag(~np.all(np.isfinite(q), axis=(1, 2)), QUAD_NOT_FINITE)
+  q = np.where(np.isfinite(q), q, 0)
+  # Sides AB, BC, CD, DA and the turn at the corners B, C, D, A
+  sides = np.roll(q, -1, axis=1) - q
+  turns = _cross(sides, np.roll(sides, -1, axis=1))
+  lengths = np.sqrt(np.sum(sides**2, axis=2))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    sines = turns/(lengths*np.roll(lengths, -1, axis=1))
+  flag(np.any(~(np.abs(sines) >= min_sine), axis=1), QUAD_COLLINEAR)
+  A, B, C, D = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+  flag(_segments_cross(A, B, C, D) | _segments_cross(B, C, D, A), QUAD_SELF_INTERSECTING)
+  flag(np.abs(0.5*np.sum(_cross(q, np.roll(q, -1, axis=1)), axis=1)) < min_area, QUAD_TOO_SMALL)
+  flag(~(np.all(turns > 0, axis=1) | np.all(turns < 0, axis=1)), QUAD_NON_CONVEX)
+  return reasons
+
+def count_reasons(reasons):
+  """
+  {reason name: count} of the rejected quadrilaterals of quad_reasons_batch
+  """
+  codes, counts = np.unique(reasons, return_counts=True)
+  return {QUAD_REASONS[code]: int(n) for code, n in zip(codes.tolist(), counts) if code != QUAD_OK}
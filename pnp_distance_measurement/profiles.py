@@ -0,0 +1,161 @@
+import os
+import cv2
+import numpy as np
+import yaml
+
+CALIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calib')
+
+class CameraProfile(object):
+  def __init__(self, name, img_size, K, dist_coeffs, obj_width, obj_height, json_input=None,
+               json_output=None, json_flag=None, img_path=None, arrow_img_path=None, label=None):
+    """
+    Camera and dataset settings of one model. The attributes have the same names as
+    the constants of conf, so a profile can be used wherever conf is
+    Derived data (K_INV, the undistortion maps, the 3D templates) is computed the
+    first time it is read and kept for the life of the process
+    """
+    self.name = name
+    self.JSON_INPUT = json_input
+    self.JSON_OUTPUT = json_output
+    self.JSON_FLAG = json_flag
+    self.IMG_PATH = img_path
+    self.ARROW_IMG_PATH = arrow_img_path
+    self.LABEL = label
+
+    self.IMG_SIZE = list(img_size)
+    self.OBJ_WIDTH = obj_width
+    self.OBJ_HEIGHT = obj_height
+    self.K = np.array(K, dtype=np.float32).reshape(3, 3)
+    self.DIST_COEFFS = np.array(dist_coeffs, dtype=np.float32).ravel()
+    self._cache = {}
+
+  @classmethod
+  def from_yaml(cls, name, yaml_file, img_size=None, obj_width=None, obj_height=None, **kwargs):
+    """
+    Profile with the camera_matrix and dist_coeff written by calib/calib.py. img_size
+    can be left out for the yaml files written by resize/resize.py, which contain it
+    """
+    with open(yaml_file) as f:
+      data = yaml.safe_load(f)
+    if img_size is None:
+      img_size = data['img_size']
+    return cls(name, img_size, data['camera_matrix'], data['dist_coeff'], obj_width, obj_height, **kwargs)
+
+  def _cached(self, key, compute):
+    if key not in self._cache:
+      self._cache[key] = compute()
+    return self._cache[key]
+
+  @property
+  def HAS_DISTORTION(self):
+    return bool(np.any(self.DIST_COEFFS))
+
+  @property
+  def K_INV(self):
+    return self._cached('K_INV', lambda: np.linalg.inv(self.K.astype(np.float64)))
+
+  @property
+  def DEFAULT_VERTICES_3D(self):
+    w, h = self.OBJ_WIDTH, self.OBJ_HEIGHT
+    return self._cached('DEFAULT_VERTICES_3D', lambda: np.array(
+      [[-w/2, h/2, 0], [w/2, h/2, 0], [w/2, -h/2, 0], [-w/2, -h/2, 0]], dtype=np.float32))
+
+  @property
+  def DEFAULT_ORTHOGONALS_3D(self):
+    h = self.OBJ_HEIGHT
+    return self._cached('DEFAULT_ORTHOGONALS_3D', lambda: np.array(
+      [[0, 0, 0], [0, 0, h/2], [h/2, 0, 0], [0, h/2, 0]], dtype=np.float32))
+
+  def undistort_maps(self, m1type=cv2.CV_16SC2):
+    """
+    cv2.remap maps that undistort a full image of this profile (same K after undistortion)
+    """
+    return self._cached(('undistort_maps', m1type), lambda: cv2.initUndistortRectifyMap(
+      self.K, self.DIST_COEFFS, None, self.K, tuple(self.IMG_SIZE), m1type))
+
+  def undistort_image(self, img):
+    if not self.HAS_DISTORTION:
+      return img
+    map1, map2 = self.undistort_maps()
+    return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+def scale_camera_matrix(K, scale_x, scale_y):
+  """
+  Camera matrix of the same camera after resizing its images by (scale_x, scale_y).
+  The principal point is mapped like the pixel centers are by cv2.resize and by the
+  reduced JPEG decoders: (c + 0.5)*scale - 0.5. Distortion coefficients are unchanged
+  """
+  K = np.array(K, dtype=np.float64).reshape(3, 3)
+  S = np.array([[scale_x, 0, 0.5*scale_x - 0.5],
+                [0, scale_y, 0.5*scale_y - 0.5],
+                [0, 0, 1]])
+  return np.matmul(S, K)
+
+_PROFILES = {}
+
+def register(profile):
+  _PROFILES[profile.name] = profile
+  return profile
+
+def get_profile(name):
+  try:
+    return _PROFILES[name]
+  except KeyError:
+    raise KeyError('Unknown camera profile ' + repr(name) + ', known profiles: ' + ', '.join(sorted(_PROFILES)))
+
+def profile_names():
+  return sorted(_PROFILES)
+
+def select_profile(record, default):
+  """
+  Profile of one input record: the one named by its 'profile' key, else the default
+  """
+  name = record.get('profile') if isinstance(record, dict) else None
+  if name is None:
+    return default if isinstance(default, CameraProfile) else get_profile(default)
+  return get_profile(name)
+
+register(CameraProfile(
+  # Groundthruth data set, img size 1920x1440
+  'groundtruth_1920x1440_iPhone8', [1920, 1440],
+  [[1602, 0, 1920//2], [0, 1602, 1440//2], [0, 0, 1]], [0, 0, 0, 0],
+  obj_width=0.335, obj_height=0.195,  # Sign size in meters
+  json_input='../data/json/groundtruth-830.json',
+  json_output='../data/json/groundtruth-results-830.json',
+  json_flag='from reading imgs',
+  img_path='../data/groundtruth_exit_sign_cleaned_830/imgs/',
+  arrow_img_path='../results/arrow_imgs/groundtruth_exit_sign/'))
+
+register(CameraProfile(
+  # Main data set, img size 360x640
+  'main_360x640', [360, 640],
+  [[536, 0, 360//2], [0, 536, 640//2], [0, 0, 1]], [0, 0, 0, 0],
+  obj_width=0.335, obj_height=0.195,
+  json_input='../data/json/quadrilateral-raw-1807.json',
+  json_output='../data/json/quadrilateral-results-1787.json',
+  json_flag='from labelbox',
+  img_path='../data/exit_sign_1787/',
+  arrow_img_path='../results/arrow_imgs/exit_sign/',
+  label='EXIT_sign'))
+
+register(CameraProfile.from_yaml(
+  # Street data set, iPhone 8s, img size 4032x3024
+  'street_4032x3024_iPhone8s', os.path.join(CALIB_PATH, 'calibration_matrix_4032×3024.yaml'), [4032, 3024],
+  obj_width=32.0 * 0.0254, obj_height=19.0 * 0.0254,
+  json_input='../data/json/street-raw-4032x3024.json',
+  json_output='../data/json/street-results-4032x3024.json',
+  json_flag='from labelbox',
+  img_path='../data/street_4032x3024/',
+  arrow_img_path='../results/arrow_imgs/street_4032x3024/',
+  label='rectangle'))
+
+register(CameraProfile.from_yaml(
+  # Street data set, iPhone 8s, img resized 1008x756
+  'street_1008x756_iPhone8s', os.path.join(CALIB_PATH, 'calibration_matrix_1008×756.yaml'), [1008, 756],
+  obj_width=32.0 * 0.0254, obj_height=19.0 * 0.0254,
+  json_input='../data/json/street-raw-1008x756.json',
+  json_output='../data/json/street-results-1008x756.json',
+  json_flag='from labelbox',
+  img_path='../data/street_1008x756/',
+  arrow_img_path='../results/arrow_imgs/street_1008x756/',
+  label='rectangle'))
@@ -0,0 +1,113 @@
+import collections
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
+from pnp import QuadrilateralBatch
+
+# Half size in pixels of the cornerSubPix window: a quarter of the shortest side of the
+# sign, so that it never reaches the next corner, between these bounds
+MIN_WINDOW = 2
+MAX_WINDOW = 5
+# A corner that moves further than this from its label snapped to something else (the
+# text of the sign, the wall) and keeps its label
+MAX_SHIFT = 2.0
+CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.001)
+
+def window_sizes(vertices_2D):
+  """
+  Half size of the cornerSubPix window of every sign of an Nx4x2 corner array
+  """
+  sides = np.linalg.norm(np.roll(vertices_2D, -1, axis=1) - vertices_2D, axis=2)
+  return np.clip(np.floor(np.min(sides, axis=1)/4), MIN_WINDOW, MAX_WINDOW).astype(int)
+
+def refine_image(img_name, vertices_2D, windows):
+  """
+  Sub-pixel corners of the k signs (kx4x2) of one image. The image is decoded to
+  grayscale (luma only, no color conversion) and only a small region around each
+  sign is searched
+  Returns the refined kx4x2 corners, or None if the image cannot be read
+  """
+  img = cv2.imread(img_name, cv2.IMREAD_GRAYSCALE)
+  if img is None:
+    return None
+  h, w = img.shape
+  refined = np.array(vertices_2D, dtype=np.float64)
+  for j, (corners, window) in enumerate(zip(refined, windows)):
+    pad = window + int(np.ceil(MAX_SHIFT)) + 2
+    x0, y0 = np.maximum(np.floor(corners.min(axis=0)).astype(int) - pad, 0)
+    x1, y1 = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + pad + 1, (w, h))
+    if x1 <= x0 or y1 <= y0:
+      continue
+    roi = np.ascontiguousarray(img[y0:y1, x0:x1])
+    pts = np.float32(corners - (x0, y0)).reshape(-1, 1, 2)
+    pts = cv2.cornerSubPix(roi, pts, (int(window), int(window)), (-1, -1), CRITERIA)
+    refined[j] = pts.reshape(4, 2) + (x0, y0)
+  return refined
+
+def refine_corners(ids, vertices_2D, img_path, workers=4):
+  """
+  Snap the labeled corners of every sign to the sub-pixel corners of its image, one
+  image per task on a pool of threads (all the signs of an image share its decode)
+  Returns the Nx4x2 corners (the labels where the refinement failed), the Nx4
+  distance in pixels each corner moved (nan for unreadable images) and the counts
+  of refined and kept corners and of missing images
+  """
+  vertices_2D = np.asarray(vertices_2D, dtype=np.float64).reshape(-1, 4, 2)
+  windows = window_sizes(vertices_2D)
+  images = collections.OrderedDict()
+  for i, id in enumerate(ids):
+    images.setdefault(str(id), []).append(i)
+
+  def refine_one(item):
+    id, indices = item
+    return indices, refine_image(img_path + id, vertices_2D[indices], windows[indices])
+
+  corners = vertices_2D.copy()
+  shifts = np.full(vertices_2D.shape[:2], np.nan)
+  counts = {'refined': 0, 'kept': 0, 'missing': 0}
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+    for indices, refined in executor.map(refine_one, images.items()):
+      if refined is None:
+        counts['missing'] += 1
+        continue
+      shift = np.linalg.norm(refined - vertices_2D[indices], axis=2)
+      ok = np.isfinite(shift) & (shift <= MAX_SHIFT)
+      corners[indices] = np.where(ok[:, :, None], refined, vertices_2D[indices])
+      shifts[indices] = np.where(ok, shift, 0.0)
+      counts['refined'] += int(np.sum(ok))
+      counts['kept'] += int(np.sum(~ok))
+  return corners, shifts, counts
+
+def refine_batch(batch, workers=4, img_path=None):
+  """
+  refine_corners for a QuadrilateralBatch, from the images of its profile
+  Returns a new batch with the refined corners and the shift report
+  """
+  with instrumentation.stats.timer('corner_refine'):
+    corners, shifts, counts = refine_corners(batch.ids, batch.vertices_2D,
+                                             batch.profile.IMG_PATH if img_path is None else img_path, workers)
+  instrumentation.stats.count('corners_refined', counts['refined'])
+  instrumentation.stats.count('corners_kept', counts['kept'])
+  refined = QuadrilateralBatch(batch.ids, corners, batch.real_distances, batch.profile,
+                               batch.undistort_once, batch.signs)
+  return refined, shift_report(shifts, counts)
+
+def shift_report(shifts, counts):
+  """
+  Counts and distribution (in pixels) of how far the corners moved
+  """
+  shifts = shifts[np.isfinite(shifts)]
+  report = dict(counts)
+  if len(shifts):
+    report.update({'mean_shift': float(np.mean(shifts)), 'median_shift': float(np.median(shifts)),
+                   'p95_shift': float(np.percentile(shifts, 95)), 'max_shift': float(np.max(shifts))})
+  return report
+
+def print_report(report, profile_name):
+  print('Corner refinement, profile ' + profile_name + ': ' + str(report['refined']) + ' corners refined, ' +
+        str(report['kept']) + ' kept (moved more than ' + str(MAX_SHIFT) + ' px), ' +
+        str(report['missing']) + ' images missing')
+  if 'mean_shift' in report:
+    print('Corner shift (px): mean %.3f, median %.3f, p95 %.3f, max %.3f' %
+          (report['mean_shift'], report['median_shift'], report['p95_shift'], report['max_shift']))
@@ -0,0 +1,115 @@
+import collections
+import os
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import conf
+import pnp_batch
+import evaluation
+
+# JPEG decoders can produce these scales directly from the DCT coefficients
+REDUCED_READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                      4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def arrow_image_name(id, distance, output_path=None):
+  """
+  Output file name of the annotated image, same as Processing.display_image
+  """
+  if output_path is None:
+    output_path = conf.ARROW_IMG_PATH
+  return output_path + 'arrow_' + str(float(distance))[:4] + '_' + id
+
+def reduced_read_flag(scale):
+  """
+  cv2.imread flag decoding at this scale, or None if it has to be decoded in full
+  and resized
+  """
+  factor = 1.0/scale
+  if abs(factor - round(factor)) < 1e-9:
+    return REDUCED_READ_FLAGS.get(int(round(factor)))
+  return None
+
+def read_image(img_name, scale=1.0):
+  """
+  Read an image at the given scale. 1/2, 1/4 and 1/8 are decoded at reduced
+  resolution, other scales are decoded in full and resized
+  """
+  flag = reduced_read_flag(scale)
+  if flag is not None:
+    return cv2.imread(img_name, flag)
+  img = cv2.imread(img_name)
+  if img is None:
+    return img
+  size = (max(1, int(round(img.shape[1]*scale))), max(1, int(round(img.shape[0]*scale))))
+  return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+def draw_quadrilateral(img, vertices_2D, projected_orthogonals, thickness=3):
+  """
+  Draw the exit sign label boundaries and the normal Oxyz at the center of the exit sign
+  """
+  img = cv2.polylines(img, np.int32([vertices_2D]),
+                      isClosed=True, color=(0, 255, 255), thickness=thickness)
+  start_point = tuple(projected_orthogonals[0])
+  colors = [(255, 0, 0), (0, 0, 255), (255, 0, 255)]
+  for end_point, color in zip(projected_orthogonals[1:], colors):
+    img = cv2.arrowedLine(img, start_point, tuple(end_point),
+                          color=color, thickness=thickness, tipLength=0.25)
+  return img
+
+def render_batch(ids, vertices_2D, R_vecs, T_vecs, distances, scale=1.0, workers=4,
+                 skip_existing=False, img_path=None, output_path=None, profile=None):
+  """
+  Write the annotated image of every image id, decoding and encoding on a pool of
+  threads. The quadrilaterals of one image are all drawn on it, decoded and encoded once
+  and named after the distance of its first one. scale < 1 writes smaller images (the
+  corners and arrows are scaled to match)
+  skip_existing: do not redo images whose output file already exists
+  profile: camera profile of the images and of the default paths, conf.PROFILE by default
+  Returns the counts of rendered, skipped and missing (unreadable) images
+  """
+  if profile is None:
+    profile = conf.PROFILE
+  if img_path is None:
+    img_path = profile.IMG_PATH
+  if output_path is None:
+    output_path = profile.ARROW_IMG_PATH
+  vertices_2D = np.asarray(vertices_2D, dtype=np.float64).reshape(-1, 4, 2)
+  projected = pnp_batch.project_2D_batch(R_vecs, T_vecs, profile.DEFAULT_ORTHOGONALS_3D,
+                                         profile.K, profile.DIST_COEFFS)
+  corners = np.int32(vertices_2D*scale)
+  arrows = np.int32(np.nan_to_num(projected*scale))
+  thickness = max(1, int(round(3*scale)))
+
+  images = collections.OrderedDict()
+  for i, id in enumerate(ids):
+    images.setdefault(id, []).append(i)
+
+  def render_one(indices):
+    i = indices[0]
+    img_name = arrow_image_name(ids[i], distances[i], output_path)
+    if skip_existing and os.path.exists(img_name):
+      return 'skipped'
+    img = read_image(img_path + ids[i], scale)
+    if img is None:
+      return 'missing'
+    for j in indices:
+      img = draw_quadrilateral(img, corners[j], arrows[j].tolist(), thickness)
+    cv2.imwrite(img_name, img)
+    return 'rendered'
+
+  counts = {'rendered': 0, 'skipped': 0, 'missing': 0}
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+    for status in executor.map(render_one, images.values()):
+      counts[status] += 1
+  return counts
+
+def render_quadrilaterals(quadrilateral_arr, **kwargs):
+  """
+  render_batch for a QuadrilateralBatch or a list of quadrilateral objects
+  """
+  vertices_2D, R_vecs, T_vecs, distances, _ = evaluation.to_arrays(quadrilateral_arr)
+  ids = [str(id) for id in quadrilateral_arr.ids] if hasattr(quadrilateral_arr, 'ids') \
+        else [q.id for q in quadrilateral_arr]
+  if hasattr(quadrilateral_arr, 'profile'):
+    kwargs.setdefault('profile', quadrilateral_arr.profile)
+  return render_batch(ids, vertices_2D, R_vecs, T_vecs, distances, **kwargs)
@@ -1,19 +1,102 @@
+import argparse
 import cv2
 import glob
+import os
+import sys
+import yaml
+from multiprocessing import Pool
 
-images = glob.glob(r'./to_resize/*.jpg')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from profiles import CALIB_PATH, scale_camera_matrix
+from render import reduced_read_flag
+
+IMAGES = r'./to_resize/*.jpg'
 # OUTPUT_FOLDER = './resized/calib'
 OUTPUT_FOLDER = './resized/street'
 SCALE_PERCENT = 0.25
-count = 1
-
-images.sort()
-for fname in images:
-  img = cv2.imread(fname)
-  w = int(img.shape[1] * SCALE_PERCENT)
-  h = int(img.shape[0] * SCALE_PERCENT)
-  resized = cv2.resize(img, (w, h), interpolation = cv2.INTER_AREA)
-  output_name = OUTPUT_FOLDER + str(count).zfill(2) + '.jpg'
-  print(output_name)
-  cv2.imwrite(output_name, resized)
-  count += 1
+# Camera calibration of the images to resize, scaled along with them
+CALIB = os.path.join(CALIB_PATH, 'calibration_matrix_4032×3024.yaml')
+
+def resize_image(args):
+  """
+  Worker: read, resize and write one image
+  Returns (output name, (x scale, y scale), resized size), or None scales and size if
+  the image can't be read
+  """
+  fname, output_name, scale = args
+  flag = reduced_read_flag(scale)
+  img = cv2.imread(fname) if flag is None else cv2.imread(fname, flag)
+  if img is None:
+    return output_name, None, None
+  if flag is None:
+    w = int(img.shape[1] * scale)
+    h = int(img.shape[0] * scale)
+    scales = (float(w)/img.shape[1], float(h)/img.shape[0])
+    img = cv2.resize(img, (w, h), interpolation = cv2.INTER_AREA)
+  else:
+    # The reduced decoders scale the pixel grid by exactly 1/2, 1/4 or 1/8 (a partial
+    # block at the border becomes one more pixel)
+    scales = (scale, scale)
+  cv2.imwrite(output_name, img)
+  return output_name, scales, (img.shape[1], img.shape[0])
+
+def write_profile(calib_file, scales, resized_size, output):
+  """
+  Write the camera matrix (and the unchanged distortion coefficients) of the resized
+  images, in the calib.py yaml format plus img_size
+  """
+  with open(calib_file) as f:
+    data = yaml.safe_load(f)
+  K = scale_camera_matrix(data['camera_matrix'], scales[0], scales[1])
+  data = {'camera_matrix': K.tolist(),
+          'dist_coeff': data['dist_coeff'],
+          'img_size': list(resized_size)}
+  with open(output, "w") as f:
+    yaml.dump(data, f)
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--images', default=IMAGES, help='glob of the images to resize')
+  parser.add_argument('--output', default=OUTPUT_FOLDER,
+                      help='output prefix, images are written as <prefix>01.jpg, <prefix>02.jpg...')
+  parser.add_argument('--scale', type=float, default=SCALE_PERCENT,
+                      help='0.5, 0.25 and 0.125 are decoded directly at reduced resolution')
+  parser.add_argument('--calib', default=CALIB,
+                      help='calibration_matrix yaml of the original images, "" to not write a scaled one')
+  parser.add_argument('--workers', type=int, default=None, help='processes (default: all cores)')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  images = glob.glob(args.images)
+  images.sort()
+  tasks = [(fname, args.output + str(count).zfill(2) + '.jpg', args.scale)
+           for count, fname in enumerate(images, 1)]
+
+  pool = Pool(args.workers)
+  try:
+    results = pool.map(resize_image, tasks, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+  sizes = set()
+  for (fname, output_name, scale), (_, scales, resized) in zip(tasks, results):
+    if resized is None:
+      print('Could not read ' + fname)
+      continue
+    print(output_name)
+    sizes.add((scales, resized))
+
+  if args.calib and sizes:
+    if len(sizes) > 1:
+      print('Images of different sizes, no camera profile written')
+      return
+    scales, resized = sizes.pop()
+    output = os.path.join(os.path.dirname(args.output) or '.',
+                          'calibration_matrix_' + str(resized[0]) + '×' + str(resized[1]) + '.yaml')
+    write_profile(args.calib, scales, resized, output)
+    print(output)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,135 @@
+import hashlib
+import sqlite3
+import numpy as np
+import instrumentation
+from pnp import QuadrilateralBatch
+
+STORE = 'results.sqlite'
+# Bump when the solver changes its results, so that the stored ones are not reused
+SOLVER_VERSION = 2
+# R_vec (3), T_vec (3), distance, projection error (x, y) of a sign, as float64
+RESULT_SIZE = 9
+
+def profile_fingerprint(profile, undistort_once=False):
+  """
+  Hash of everything of a camera profile the results depend on: intrinsics, distortion
+  and sign dimensions (and the distortion handling of the solve)
+  """
+  h = hashlib.sha1()
+  h.update(repr((SOLVER_VERSION, profile.name, tuple(profile.IMG_SIZE), float(profile.OBJ_WIDTH),
+                 float(profile.OBJ_HEIGHT), bool(undistort_once))).encode())
+  h.update(np.ascontiguousarray(profile.K, dtype=np.float64).tobytes())
+  h.update(np.ascontiguousarray(profile.DIST_COEFFS, dtype=np.float64).tobytes())
+  return h.digest()
+
+def result_keys(batch):
+  """
+  Content address of every sign of a QuadrilateralBatch: hash of the image id, the
+  ordered corners and the profile fingerprint
+  """
+  fingerprint = profile_fingerprint(batch.profile, batch.undistort_once)
+  corners = np.ascontiguousarray(batch.vertices_2D, dtype=np.float64)
+  keys = []
+  for id, vertices_2D in zip(batch.ids, corners):
+    h = hashlib.sha1(fingerprint)
+    h.update(str(id).encode())
+    h.update(vertices_2D.tobytes())
+    keys.append(h.hexdigest())
+  return keys
+
+class ResultStore(object):
+  def __init__(self, file_name=STORE):
+    """
+    Persistent sqlite store of the solved signs, keyed by result_keys. Every open starts
+    a new run; the entries read or written by a run are stamped with it, so that the
+    entries of signs that are no longer labeled can be evicted later
+    """
+    self.db = sqlite3.connect(file_name)
+    self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                    '(key TEXT PRIMARY KEY, id TEXT, profile TEXT, result BLOB, run INTEGER)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+    row = self.db.execute("SELECT value FROM meta WHERE name = 'run'").fetchone()
+    self.run = (row[0] if row else 0) + 1
+    self.db.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (self.run,))
+    self.db.commit()
+    self.counters = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+  def lookup(self, keys):
+    """
+    {key: (R_vec, T_vec, distance, projection error)} of the keys in the store
+    """
+    found = {}
+    for i in range(0, len(keys), 500):
+      chunk = keys[i:i + 500]
+      rows = self.db.execute('SELECT key, result FROM results WHERE key IN (' + ','.join('?'*len(chunk)) + ')',
+                             chunk).fetchall()
+      for key, result in rows:
+        found[key] = np.frombuffer(result, dtype=np.float64)
+      self.db.executemany('UPDATE results SET run = ? WHERE key = ?', [(self.run, key) for key, _ in rows])
+    return found
+
+  def store(self, keys, ids, profile_name, R_vecs, T_vecs, distances, proj_errors):
+    results = np.column_stack([R_vecs, T_vecs, distances, proj_errors]).astype(np.float64)
+    self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                        [(key, str(id), profile_name, result.tobytes(), self.run)
+                         for key, id, result in zip(keys, ids, results)])
+    self.counters['stored'] += len(keys)
+
+  def fill(self, batch, solve):
+    """
+    Set the results of a QuadrilateralBatch from the store, solving only the signs
+    that are not in it
+    solve: function solving a QuadrilateralBatch in place, e.g. Processing.solve_in_pool
+    """
+    keys = result_keys(batch)
+    found = self.lookup(keys)
+    missing = np.array([k for k, key in enumerate(keys) if key not in found], dtype=int)
+    results = np.zeros((len(batch), RESULT_SIZE))
+    for k, key in enumerate(keys):
+      if key in found:
+        results[k] = found[key]
+    if len(missing):
+      misses = QuadrilateralBatch(batch.ids[missing], batch.vertices_2D[missing], profile=batch.profile,
+                                  undistort_once=batch.undistort_once)
+      solve(misses)
+      results[missing] = np.column_stack([misses.R_vecs, misses.T_vecs, misses.distances, misses.proj_errors])
+      self.store([keys[k] for k in missing], misses.ids, batch.profile.name, misses.R_vecs, misses.T_vecs,
+                 misses.distances, misses.proj_errors)
+    self.db.commit()
+    hits = len(batch) - len(missing)
+    self.counters['hits'] += hits
+    self.counters['misses'] += len(missing)
+    instrumentation.stats.count('store_hits', hits)
+    instrumentation.stats.count('store_misses', len(missing))
+    return batch.set_results(results[:, 0:3], results[:, 3:6], results[:, 6], results[:, 7:9])
+
+  def evict(self, max_age=0):
+    """
+    Delete the entries not used by the last max_age runs before this one (0: every
+    entry not used by this run), e.g. the signs whose labels changed or were removed
+    """
+    cursor = self.db.execute('DELETE FROM results WHERE run < ?', (self.run - max_age,))
+    self.db.commit()
+    self.counters['evicted'] += cursor.rowcount
+    return cursor.rowcount
+
+  def compact(self):
+    """
+    Give the space of the deleted entries back to the file system
+    """
+    self.db.execute('VACUUM')
+
+  def summary(self):
+    entries = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+    total = self.counters['hits'] + self.counters['misses']
+    return dict(self.counters, entries=entries, run=self.run,
+                hit_rate=self.counters['hits']/total if total else None)
+
+  def close(self):
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import collections
+import json
+import time
+import numpy as np
+import conf
+import pnp_batch
+import profiles
+from pnp import Point, Quadrilateral, QuadrilateralBatch
+
+# A micro-batch is solved as soon as it has MAX_BATCH signs or its first request has waited
+# MAX_WAIT seconds. The signs of a request are never split between micro-batches
+MAX_BATCH = 256
+MAX_WAIT = 0.002
+# Latencies kept for the percentiles of /stats
+LATENCY_WINDOW = 10000
+MAX_BODY = 1 << 24
+
+class RequestError(ValueError):
+  pass
+
+def parse_sign(sign, default_profile):
+  """
+  Camera profile and ordered 4x2 corners of a requested sign
+  {"corners": 4 [x, y] in any order, optional "profile" and "id"}
+  """
+  if not isinstance(sign, dict):
+    raise RequestError('every sign must be a json object')
+  try:
+    profile = profiles.get_profile(sign.get('profile') or default_profile)
+  except KeyError as e:
+    raise RequestError(str(e.args[0]))
+  try:
+    pts = [Point(float(x), float(y)) for x, y in sign['corners']]
+  except (KeyError, TypeError, ValueError):
+    raise RequestError('"corners" must be 4 [x, y] points')
+  if len(pts) != 4:
+    raise RequestError('"corners" must be 4 [x, y] points')
+  if not all(np.isfinite([p.x, p.y]).all() for p in pts):
+    raise RequestError('"corners" must be finite numbers')
+  return profile, [[p.x, p.y] for p in Quadrilateral.rearrange_pts(pts)]
+
+def finite_or_none(values):
+  """
+  List of the values with None (json null) for nan and inf, which json.dumps would
+  write as NaN and Infinity, invalid json
+  """
+  return [float(v) if np.isfinite(v) else None for v in values]
+
+def solve_group(profile, vertices_2D):
+  """
+  Solve the signs of one profile of a micro-batch with the batch solver, so that a
+  sign gets the same pose whatever it is batched with
+  Returns a result dict per sign. A sign whose corners cannot give a pose (see
+  pnp_batch.quad_reasons_batch) gets an "error" with the reason and null results
+  """
+  batch = QuadrilateralBatch(np.zeros(len(vertices_2D), dtype=str), np.array(vertices_2D, dtype=np.float64),
+                             profile=profile)
+  results = []
+  for i in range(len(batch)):
+    result = {'profile': profile.name, 'vertices_2D': vertices_2D[i], 'R_vec': finite_or_none(batch.R_vecs[i]),
+              'T_vec': finite_or_none(batch.T_vecs[i]), 'distance': finite_or_none([batch.distances[i]])[0],
+              'projection_error': finite_or_none(batch.proj_errors[i])}
+    if batch.reasons[i] != pnp_batch.QUAD_OK:
+      result.update({'R_vec': None, 'T_vec': None, 'distance': None, 'projection_error': None,
+                     'error': pnp_batch.QUAD_REASONS[int(batch.reasons[i])]})
+    results.append(result)
+  return results
+
+def solve_micro_batch(items):
+  """
+  items: (profile, ordered corners) of every sign of the micro-batch
+  Returns the results in the same order
+  """
+  groups = collections.OrderedDict()
+  for k, (profile, vertices_2D) in enumerate(items):
+    groups.setdefault(profile.name, (profile, [], []))
+    groups[profile.name][1].append(k)
+    groups[profile.name][2].append(vertices_2D)
+  results = [None]*len(items)
+  for profile, indices, vertices_2D in groups.values():
+    for k, result in zip(indices, solve_group(profile, vertices_2D)):
+      results[k] = result
+  return results
+
+class MicroBatcher(object):
+  def __init__(self, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+    """
+    Collect the signs of concurrent requests and solve them together as one
+    QuadrilateralBatch per profile, on a thread so that requests keep being read meanwhile
+    """
+    self.max_batch = max_batch
+    self.max_wait = max_wait
+    self.queue = asyncio.Queue()
+    self.counters = {'signs': 0, 'batches': 0, 'max_batch_size': 0, 'solve_seconds': 0.0}
+
+  async def submit(self, signs):
+    """
+    signs: (profile, ordered corners) of all the signs of a request, which are queued
+    together and solved in the same micro-batch
+    Returns their results in the same order
+    """
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((signs, future))
+    return await future
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      requests = [await self.queue.get()]
+      size = len(requests[0][0])
+      deadline = loop.time() + self.max_wait
+      while size < self.max_batch:
+        timeout = deadline - loop.time()
+        if timeout <= 0 and self.queue.empty():
+          break
+        try:
+          requests.append(await asyncio.wait_for(self.queue.get(), max(timeout, 0)))
+        except asyncio.TimeoutError:
+          break
+        size += len(requests[-1][0])
+      items = [sign for signs, _ in requests for sign in signs]
+      start = time.perf_counter()
+      try:
+        results = await loop.run_in_executor(None, solve_micro_batch, items)
+      except Exception as e:
+        for _, future in requests:
+          if not future.done():
+            future.set_exception(e)
+        continue
+      self.counters['solve_seconds'] += time.perf_counter() - start
+      self.counters['signs'] += len(items)
+      self.counters['batches'] += 1
+      self.counters['max_batch_size'] = max(self.counters['max_batch_size'], len(items))
+      k = 0
+      for signs, future in requests:
+        if not future.done():
+          future.set_result(results[k:k + len(signs)])
+        k += len(signs)
+
+class DistanceService(object):
+  def __init__(self, default_profile=None, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+    """
+    HTTP/1.1 service: POST /distance with one sign {"corners", "profile", "id"} or
+    {"signs": [...]}, GET /stats for the counters, GET /health
+    """
+    self.default_profile = default_profile or conf.model
+    self.batcher = MicroBatcher(max_batch, max_wait)
+    self.start_time = time.time()
+    self.counters = {'requests': 0, 'errors': 0, 'connections': 0}
+    self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+  async def solve(self, body):
+    try:
+      request = json.loads(body)
+    except ValueError:
+      raise RequestError('invalid json')
+    if not isinstance(request, dict):
+      raise RequestError('expected a json object')
+    signs = request['signs'] if 'signs' in request else [request]
+    if not isinstance(signs, list):
+      raise RequestError('"signs" must be a list')
+    parsed = [parse_sign(sign, request.get('profile') or self.default_profile) for sign in signs]
+    if not parsed:
+      raise RequestError('"signs" is empty')
+    results = await self.batcher.submit(parsed)
+    for sign, result in zip(signs, results):
+      if 'id' in sign:
+        result['id'] = sign['id']
+    return results[0] if 'signs' not in request else {'results': results}
+
+  def stats(self):
+    uptime = time.time() - self.start_time
+    latencies = np.array(self.latencies)*1000
+    batcher = self.batcher.counters
+    return {
+      'uptime_seconds': uptime,
+      'requests': self.counters['requests'],
+      'errors': self.counters['errors'],
+      'connections': self.counters['connections'],
+      'signs': batcher['signs'],
+      'batches': batcher['batches'],
+      'mean_batch_size': batcher['signs']/batcher['batches'] if batcher['batches'] else None,
+      'max_batch_size': batcher['max_batch_size'],
+      'solve_seconds': batcher['solve_seconds'],
+      'signs_per_second': batcher['signs']/uptime if uptime > 0 else None,
+      'latency_ms': {'mean': float(np.mean(latencies)), 'p50': float(np.percentile(latencies, 50)),
+                     'p95': float(np.percentile(latencies, 95)), 'p99': float(np.percentile(latencies, 99)),
+                     'max': float(np.max(latencies))} if len(latencies) else None,
+    }
+
+  async def handle(self, method, path, body):
+    """
+    Returns the HTTP status and the json response of a request
+    """
+    if method == 'GET' and path == '/stats':
+      return 200, self.stats()
+    if method == 'GET' and path == '/health':
+      return 200, {'status': 'ok', 'profiles': profiles.profile_names()}
+    if path != '/distance':
+      return 404, {'error': 'not found'}
+    if method != 'POST':
+      return 405, {'error': 'use POST'}
+    start = time.perf_counter()
+    self.counters['requests'] += 1
+    try:
+      response = await self.solve(body)
+    except RequestError as e:
+      self.counters['errors'] += 1
+      return 400, {'error': str(e)}
+    self.latencies.append(time.perf_counter() - start)
+    return 200, response
+
+  async def serve_connection(self, reader, writer):
+    self.counters['connections'] += 1
+    try:
+      while True:
+        request = await read_request(reader)
+        if request is None:
+          break
+        if request == 413:
+          self.counters['errors'] += 1
+          # The body was not read, so the connection cannot be reused
+          write_response(writer, 413, {'error': 'request body over ' + str(MAX_BODY) + ' bytes'}, False)
+          await writer.drain()
+          break
+        method, path, headers, body = request
+        try:
+          status, response = await self.handle(method, path, body)
+        except Exception as e:
+          self.counters['errors'] += 1
+          status, response = 500, {'error': str(e)}
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        write_response(writer, status, response, keep_alive)
+        await writer.drain()
+        if not keep_alive:
+          break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+  async def serve(self, host='127.0.0.1', port=8765, unix=None):
+    batcher = asyncio.ensure_future(self.batcher.run())
+    if unix is not None:
+      server = await asyncio.start_unix_server(self.serve_connection, unix)
+    else:
+      server = await asyncio.start_server(self.serve_connection, host, port)
+    print('Serving on ' + (unix or host + ':' + str(port)))
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      batcher.cancel()
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+async def read_request(reader):
+  """
+  Read one HTTP/1.1 request. Returns (method, path, headers, body), None when the
+  connection is closed, or 413 when the body is larger than MAX_BODY
+  """
+  line = await reader.readline()
+  if not line:
+    return None
+  method, path, _ = line.decode('latin-1').split(' ', 2)
+  headers = await read_headers(reader)
+  length = int(headers.get('content-length', 0))
+  if length > MAX_BODY:
+    return 413
+  body = await reader.readexactly(length) if length else b''
+  return method, path, headers, body
+
+async def read_headers(reader):
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      return headers
+    name, _, value = line.decode('latin-1').partition(':')
+    headers[name.strip().lower()] = value.strip()
+
+def write_response(writer, status, response, keep_alive=True):
+  body = json.dumps(response).encode()
+  writer.write(('HTTP/1.1 ' + str(status) + ' ' + STATUS.get(status, '') + '\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: ' + str(len(body)) + '\r\n'
+                'Connection: ' + ('keep-alive' if keep_alive else 'close') + '\r\n\r\n').encode() + body)
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--unix', default=None, help='listen on this Unix socket instead of --host and --port')
+  parser.add_argument('--profile', default=conf.model, choices=profiles.profile_names(),
+                      help='camera profile of the signs sent without "profile"')
+  parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help='most signs solved together')
+  parser.add_argument('--max-wait', type=float, default=MAX_WAIT * 1000,
+                      help='milliseconds a sign waits for others to be solved with')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  service = DistanceService(args.profile, args.max_batch, args.max_wait/1000)
+  try:
+    asyncio.run(service.serve(args.host, args.port, args.unix))
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
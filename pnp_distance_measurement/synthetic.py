@@ -0,0 +1,91 @@
+import numpy as np
+import pnp_batch
+import profiles
+
+def random_poses(n, rng, min_distance=1.0, max_distance=10.0, max_angle=np.radians(45)):
+  """
+  n random poses of a sign facing the camera: the sign center is at a random depth and
+  direction inside a 30 degree cone, turned by up to max_angle around the vertical and
+  horizontal axes and rolled by up to 10 degrees
+  Returns the Nx3 R vectors and T vectors
+  """
+  depth = rng.uniform(min_distance, max_distance, n)
+  direction = rng.uniform(-np.tan(np.radians(15)), np.tan(np.radians(15)), (n, 2))
+  T_vecs = np.column_stack([direction*depth[:, None], depth])
+  # The sign normal (z of the sign) points away from the camera when facing it, like
+  # the poses solvePnP finds for the labeled signs (y of the sign is up, y of the camera down)
+  yaw = rng.uniform(-max_angle, max_angle, n)
+  pitch = rng.uniform(-max_angle, max_angle, n)
+  roll = rng.uniform(-np.radians(10), np.radians(10), n)
+  flip = pnp_batch.rodrigues_batch(np.tile([np.pi, 0, 0], (n, 1)))
+  turn = np.matmul(pnp_batch.rodrigues_batch(np.column_stack([pitch, np.zeros(n), np.zeros(n)])),
+                   pnp_batch.rodrigues_batch(np.column_stack([np.zeros(n), yaw, np.zeros(n)])))
+  turn = np.matmul(pnp_batch.rodrigues_batch(np.column_stack([np.zeros(n), np.zeros(n), roll])), turn)
+  R_vecs = pnp_batch.rotation_to_rodrigues_batch(np.matmul(turn, flip))
+  return R_vecs, T_vecs
+
+def generate(n, profile=None, noise=0.5, seed=0, shuffle_corners=True, **pose_kwargs):
+  """
+  n synthetic labeled signs seen by a camera profile: random poses projected with the
+  profile's camera matrix and distortion, plus gaussian corner noise of `noise` pixels.
+  Signs that don't fit in the image are drawn again
+  shuffle_corners: give the corners in random order, like the labels, instead of A B C D
+  Returns a dict of ids, corners (Nx4x2), the true R_vecs, T_vecs (Nx3) and the true
+  horizontal distances
+  """
+  if profile is None or isinstance(profile, str):
+    profile = profiles.get_profile(profile or 'groundtruth_1920x1440_iPhone8')
+  rng = np.random.RandomState(seed)
+  w, h = profile.IMG_SIZE
+  R_vecs, T_vecs, corners = np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 4, 2))
+  while len(corners) < n:
+    R, T = random_poses(max(2*(n - len(corners)), 16), rng, **pose_kwargs)
+    C = pnp_batch.project_2D_batch(R, T, profile.DEFAULT_VERTICES_3D, profile.K, profile.DIST_COEFFS)
+    C += rng.normal(0, noise, C.shape)
+    inside = np.all((C[..., 0] >= 0) & (C[..., 0] < w) & (C[..., 1] >= 0) & (C[..., 1] < h), axis=1)
+    R_vecs = np.concatenate([R_vecs, R[inside]])[:n]
+    T_vecs = np.concatenate([T_vecs, T[inside]])[:n]
+    corners = np.concatenate([corners, C[inside]])[:n]
+  if shuffle_corners:
+    order = np.argsort(rng.uniform(size=(n, 4)), axis=1)
+    corners = np.take_along_axis(corners, order[:, :, None], axis=1)
+  return {
+    'ids': np.array([profile.name + '_' + str(i) + '.jpg' for i in range(n)]),
+    'corners': corners,
+    'R_vecs': R_vecs,
+    'T_vecs': T_vecs,
+    'distances': pnp_batch.find_horizontal_distance_batch(R_vecs, T_vecs),
+    'profile': profile,
+  }
+
+def generate_track(n_frames, profile=None, n_tracks=1, fps=30.0, speed=1.0, noise=0.5, seed=0):
+  """
+  Synthetic detector output for a video: n_tracks signs seen by a camera walking
+  towards them at `speed` per second, with a slow sway of the sign orientations.
+  A sign is not detected in the frames where it is outside the image
+  Returns a dict of the profile and, for every frame, a list of (track id, corners
+  (4x2, in random order), true horizontal distance)
+  """
+  if profile is None or isinstance(profile, str):
+    profile = profiles.get_profile(profile or 'groundtruth_1920x1440_iPhone8')
+  rng = np.random.RandomState(seed)
+  w, h = profile.IMG_SIZE
+  R_start, T_start = random_poses(n_tracks, rng, min_distance=6.0, max_distance=10.0,
+                                  max_angle=np.radians(30))
+  phase = rng.uniform(0, 2*np.pi, n_tracks)
+  frames = []
+  for f in range(n_frames):
+    t = f/fps
+    T_vecs = T_start.copy()
+    T_vecs[:, 2] = np.maximum(T_start[:, 2] - speed*t, 1.0)
+    sway = np.column_stack([np.zeros(n_tracks), np.radians(5)*np.sin(t + phase), np.zeros(n_tracks)])
+    R_vecs = pnp_batch.rotation_to_rodrigues_batch(np.matmul(pnp_batch.rodrigues_batch(sway),
+                                                             pnp_batch.rodrigues_batch(R_start)))
+    C = pnp_batch.project_2D_batch(R_vecs, T_vecs, profile.DEFAULT_VERTICES_3D, profile.K, profile.DIST_COEFFS)
+    C += rng.normal(0, noise, C.shape)
+    inside = np.all((C[..., 0] >= 0) & (C[..., 0] < w) & (C[..., 1] >= 0) & (C[..., 1] < h), axis=1)
+    distances = pnp_batch.find_horizontal_distance_batch(R_vecs, T_vecs)
+    order = np.argsort(rng.uniform(size=(n_tracks, 4)), axis=1)
+    C = np.take_along_axis(C, order[:, :, None], axis=1)
+    frames.append([(k, C[k], distances[k]) for k in range(n_tracks) if inside[k]])
+  return {'frames': frames, 'profile': profile, 'fps': fps}
@@ -0,0 +1,19 @@
+import os, sys
+import subprocess
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def run_main(tmp_path, name, profile, *args):
+  output = str(tmp_path / (name + '.json'))
+  result = subprocess.run([sys.executable, 'main.py', '--profile', profile, '--output', output] + list(args),
+                          cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+  with open(output, 'rb') as f:
+    return f.read(), result.stdout
+
+@pytest.mark.parametrize('profile', ['groundtruth_1920x1440_iPhone8', 'main_360x640'])
+def test_workers_match_serial_run(tmp_path, profile):
+  serial = run_main(tmp_path, 'serial', profile)
+  pooled = run_main(tmp_path, 'pooled', profile, '--workers', '2', '--chunk-size', '100')
+  assert pooled[0] == serial[0]
+  assert pooled[1] == serial[1]
@@ -0,0 +1,273 @@
+import argparse
+import time
+import cv2
+import numpy as np
+import conf
+import profiles
+import synthetic
+from pnp import Point, Quadrilateral
+from json_stream import iter_records, RecordWriter
+
+# A warm-started pose whose corners reproject further than this (pixels, on average)
+# is solved again without the guess
+MAX_REPROJECTION_ERROR = 4.0
+# Tracks not detected for this many frames are dropped
+MAX_MISSED = 5
+
+class Track(object):
+  def __init__(self, track_id):
+    """
+    Pose and distance of one sign over the frames
+    """
+    self.id = track_id
+    self.R_vec = None
+    self.T_vec = None
+    self.distance = None
+    self.smoothed_distance = None
+    self.last_frame = None
+    self.frames = 0
+
+class PoseTracker(object):
+  def __init__(self, smoothing=0.0, warm_start=True, max_missed=MAX_MISSED,
+               max_reprojection_error=MAX_REPROJECTION_ERROR):
+    """
+    Solve the signs of a stream of frames with the camera of conf, keeping the pose of
+    every track to start the solve of its next detection from
+    smoothing: weight of the previous smoothed distance in the exponential moving
+    average of the distance (0: no smoothing)
+    warm_start: pass the previous pose of the track to solvePnP (useExtrinsicGuess)
+    """
+    self.smoothing = smoothing
+    self.warm_start = warm_start
+    self.max_missed = max_missed
+    self.max_reprojection_error = max_reprojection_error
+    self.tracks = {}
+    self.counts = {'detections': 0, 'warm_started': 0, 'cold_started': 0, 'rejected_guesses': 0,
+                   'failed': 0, 'dropped_tracks': 0}
+
+  def reprojection_error(self, quadrilateral, R_vec, T_vec):
+    pts_2D, _ = cv2.projectPoints(conf.DEFAULT_VERTICES_3D, R_vec, T_vec, conf.K, conf.DIST_COEFFS)
+    return float(np.mean(np.abs(np.reshape(pts_2D, (-1, 2)) - quadrilateral.vertices_2D)))
+
+  def solve(self, quadrilateral, track):
+    """
+    Pose of a detection, from the pose of its track when there is a recent one
+    Returns R_vec, T_vec and whether it was warm started
+    """
+    if self.warm_start and track.R_vec is not None:
+      R_vec, T_vec = quadrilateral.find_R_t(quadrilateral.vertices_2D, (track.R_vec, track.T_vec))
+      if np.all(np.isfinite(T_vec)) and T_vec[2] > 0 and \
+         self.reprojection_error(quadrilateral, R_vec, T_vec) <= self.max_reprojection_error:
+        return R_vec, T_vec, True
+      self.counts['rejected_guesses'] += 1
+    R_vec, T_vec = quadrilateral.find_R_t(quadrilateral.vertices_2D)
+    return R_vec, T_vec, False
+
+  def update(self, frame, detections):
+    """
+    Solve the detections of one frame
+    detections: (track id, 4 corners in any order) of every sign of the frame
+    Returns one result dict per detection
+    """
+    results = []
+    for track_id, corners in detections:
+      track = self.tracks.get(track_id)
+      if track is None:
+        track = self.tracks[track_id] = Track(track_id)
+      quadrilateral = Quadrilateral(str(track_id), [Point(x, y) for x, y in corners], solve=False)
+      R_vec, T_vec, warm = self.solve(quadrilateral, track)
+      self.counts['detections'] += 1
+      self.counts['warm_started' if warm else 'cold_started'] += 1
+      if not np.all(np.isfinite(T_vec)):
+        self.counts['failed'] += 1
+        track.R_vec = track.T_vec = None
+        continue
+      quadrilateral.set_pose(R_vec, T_vec)
+      track.R_vec, track.T_vec = R_vec, T_vec
+      track.distance = quadrilateral.distance
+      if track.smoothed_distance is None or not self.smoothing:
+        track.smoothed_distance = track.distance
+      else:
+        track.smoothed_distance = self.smoothing*track.smoothed_distance + (1 - self.smoothing)*track.distance
+      track.last_frame = frame
+      track.frames += 1
+      results.append({'frame': frame, 'track': track_id, 'vertices_2D': quadrilateral.vertices_2D,
+                      'R_vec': quadrilateral.R_vec, 'T_vec': quadrilateral.T_vec,
+                      'distance': track.distance, 'smoothed_distance': track.smoothed_distance,
+                      'warm_started': warm})
+    for track_id in [k for k, track in self.tracks.items()
+                     if track.last_frame is None or frame - track.last_frame > self.max_missed]:
+      del self.tracks[track_id]
+      self.counts['dropped_tracks'] += 1
+    return results
+
+def iter_frames(detections_file):
+  """
+  Group the records of a detections .json/.jsonl file by frame. Records are
+  {"frame", "corners" (4 [x, y]), optional "track" and "distance" (ground truth)}
+  sorted by frame; a record without "track" is its own track
+  Yields (frame, [(track id, corners, true distance or None)]), including the frames
+  without detections
+  """
+  frame, detections = 0, []
+  for i, record in enumerate(iter_records(detections_file)):
+    while record['frame'] > frame:
+      yield frame, detections
+      frame, detections = frame + 1, []
+    detections.append((record.get('track', 'record_' + str(i)), record['corners'], record.get('distance')))
+  yield frame, detections
+
+def write_synthetic(prefix, n_frames, profile, n_tracks=1, fps=30.0, noise=0.5, seed=0):
+  """
+  Write a synthetic recording: <prefix>.avi with the signs drawn on a gray background and
+  <prefix>.jsonl with their corners and true distances, as a detector would give them
+  """
+  data = synthetic.generate_track(n_frames, profile, n_tracks, fps, noise=noise, seed=seed)
+  w, h = profile.IMG_SIZE
+  video = cv2.VideoWriter(prefix + '.avi', cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+  try:
+    with RecordWriter(prefix + '.jsonl') as writer:
+      for frame, detections in enumerate(data['frames']):
+        img = np.full((h, w, 3), 96, np.uint8)
+        for track_id, corners, distance in detections:
+          hull = cv2.convexHull(np.float32(corners))
+          cv2.fillConvexPoly(img, np.int32(np.round(hull)), (255, 255, 255))
+          writer.write({'frame': frame, 'track': int(track_id), 'corners': corners.tolist(),
+                        'distance': float(distance)})
+        video.write(img)
+  finally:
+    video.release()
+  return prefix + '.avi', prefix + '.jsonl'
+
+def latency_stats(latencies):
+  latencies = np.array(latencies)*1000
+  if len(latencies) == 0:
+    return {'mean_ms': None, 'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+  return {'mean_ms': float(np.mean(latencies)), 'p50_ms': float(np.percentile(latencies, 50)),
+          'p95_ms': float(np.percentile(latencies, 95)), 'max_ms': float(np.max(latencies))}
+
+def frames_of_video(frames, capture=None):
+  """
+  The frames, followed by empty frames until the end of the video when it is longer
+  than the detections
+  """
+  frame = -1
+  for frame, detections in frames:
+    yield frame, detections
+  if capture is not None:
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    for frame in range(frame + 1, count):
+      yield frame, []
+
+def run(tracker, frames, video=None, output=None, fps=None):
+  """
+  Feed the frames to the tracker, reading the matching video frame first when there is a
+  video, and time every frame
+  frames: iterable of (frame, [(track id, corners, true distance or None)])
+  Returns the report: tracker counts, solve and total (decode + solve) latency per frame,
+  frames over the frame budget (1/fps) and the distance errors when the truth is known
+  """
+  capture = None if video is None else cv2.VideoCapture(video)
+  if capture is not None and not capture.isOpened():
+    raise IOError('Could not open ' + video)
+  if fps is None:
+    fps = capture.get(cv2.CAP_PROP_FPS) if capture is not None else 0
+  writer = None if output is None else RecordWriter(output)
+  solve_latencies, total_latencies, errors, smoothed_errors = [], [], [], []
+  n_frames = unread = 0
+  try:
+    for frame, detections in frames_of_video(frames, capture):
+      start = time.perf_counter()
+      if capture is not None:
+        ok, img = capture.read()
+        unread += not ok
+      solve_start = time.perf_counter()
+      results = tracker.update(frame, [(track_id, corners) for track_id, corners, _ in detections])
+      end = time.perf_counter()
+      solve_latencies.append(end - solve_start)
+      total_latencies.append(end - start)
+      n_frames += 1
+      truth = {track_id: distance for track_id, _, distance in detections}
+      for result in results:
+        if truth.get(result['track']) is not None:
+          errors.append(abs(result['distance'] - truth[result['track']]))
+          smoothed_errors.append(abs(result['smoothed_distance'] - truth[result['track']]))
+        if writer is not None:
+          result['latency_ms'] = 1000*(end - start)
+          writer.write(result)
+  finally:
+    if writer is not None:
+      writer.close()
+    if capture is not None:
+      capture.release()
+
+  budget = 1.0/fps if fps else None
+  report = {'frames': n_frames, 'unread_video_frames': unread, 'fps': fps,
+            'counts': dict(tracker.counts),
+            'solve_latency': latency_stats(solve_latencies),
+            'frame_latency': latency_stats(total_latencies),
+            'frames_over_budget': None if budget is None else int(sum(t > budget for t in total_latencies))}
+  if errors:
+    report['distance_error'] = {'mean': float(np.mean(errors)), 'max': float(np.max(errors)),
+                                'smoothed_mean': float(np.mean(smoothed_errors)),
+                                'smoothed_max': float(np.max(smoothed_errors))}
+  return report
+
+def print_report(report):
+  print('***********************************************************************')
+  print('Frames: ' + str(report['frames']) + ', detections: ' + str(report['counts']['detections']))
+  print('Warm started: ' + str(report['counts']['warm_started']) +
+        ', cold started: ' + str(report['counts']['cold_started']) +
+        ', rejected guesses: ' + str(report['counts']['rejected_guesses']) +
+        ', failed: ' + str(report['counts']['failed']))
+  for name in ('solve_latency', 'frame_latency'):
+    latency = report[name]
+    if latency['mean_ms'] is not None:
+      print('%s (ms): mean %.3f, p50 %.3f, p95 %.3f, max %.3f' %
+            (name, latency['mean_ms'], latency['p50_ms'], latency['p95_ms'], latency['max_ms']))
+  if report['frames_over_budget'] is not None:
+    print('Frames over the %.1f fps budget: %d' % (report['fps'], report['frames_over_budget']))
+  if 'distance_error' in report:
+    error = report['distance_error']
+    print('Distance error: mean %.4f, max %.4f (smoothed: mean %.4f, max %.4f)' %
+          (error['mean'], error['max'], error['smoothed_mean'], error['smoothed_max']))
+  print('***********************************************************************')
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--detections', default=None,
+                      help='.json/.jsonl of the detected corners: {"frame", "corners", "track", '
+                           'optional "distance"} records sorted by frame')
+  parser.add_argument('--video', default=None,
+                      help='video file the detections come from, decoded along with them')
+  parser.add_argument('--profile', default=conf.model, choices=profiles.profile_names(),
+                      help='camera profile of the video')
+  parser.add_argument('--output', default=None, help='write the pose and distance of every detection to this file')
+  parser.add_argument('--smoothing', type=float, default=0.0,
+                      help='exponential smoothing of the distance of a track, in [0, 1)')
+  parser.add_argument('--cold', action='store_true',
+                      help='solve every frame from scratch instead of from the previous pose')
+  parser.add_argument('--fps', type=float, default=None,
+                      help='frame rate of the latency budget (default: the frame rate of the video)')
+  parser.add_argument('--synthetic', default=None,
+                      help='write a synthetic recording <prefix>.avi and <prefix>.jsonl and track it')
+  parser.add_argument('--frames', type=int, default=300, help='frames of the synthetic recording')
+  parser.add_argument('--tracks', type=int, default=2, help='signs of the synthetic recording')
+  parser.add_argument('--noise', type=float, default=0.5, help='corner noise of the synthetic recording, in pixels')
+  parser.add_argument('--seed', type=int, default=0)
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  conf.use_profile(args.profile)
+  if args.synthetic is not None:
+    args.video, args.detections = write_synthetic(args.synthetic, args.frames, conf.PROFILE, args.tracks,
+                                                  args.fps or 30.0, args.noise, args.seed)
+  if args.detections is None:
+    raise SystemExit('--detections or --synthetic is needed')
+  tracker = PoseTracker(smoothing=args.smoothing, warm_start=not args.cold)
+  report = run(tracker, iter_frames(args.detections), args.video, args.output, args.fps)
+  print_report(report)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,415 @@
+import argparse
+import time
+import warnings
+from multiprocessing import Pool
+import numpy as np
+import conf
+import profiles
+import pnp_batch
+import synthetic
+from pnp import QuadrilateralBatch
+from main import Processing
+from json_stream import iter_records, RecordWriter
+
+# Corner perturbations: 'truncation' for labels cut to whole pixels by int() (the true
+# corner is up to one pixel right and below), 'rounding' for labels rounded to the
+# nearest pixel, 'gaussian' for noisy corners (e.g. from the masks), with sigma pixels
+NOISE_MODELS = ('truncation', 'rounding', 'gaussian')
+PERCENTILES = (2.5, 50, 97.5)
+# Levenberg-Marquardt of every sample: at most MAX_ITERATIONS steps, until the gradient
+# is TOLERANCE of the residuals (see _stationary), or the damping grows over MAX_DAMPING
+# without lowering the cost. The samples that do not converge are solved again from
+# scratch like --exact. About 17 us per sample and core on synthetic signs, 25 us on the
+# groundtruth labels: 1000 signs x 100k samples take 30-40 core-minutes
+MAX_ITERATIONS = 30
+TOLERANCE = 1e-6
+MAX_DAMPING = 1e8
+# Samples solved together: the vectors of a chunk stay in the CPU cache
+ROWS_PER_CHUNK = 1 << 14
+# A sample is solved again from the other minimum of the reprojection error unless its
+# cost is below the lowest that minimum can reach, allowing SLACK times the norm of its
+# perturbation (see sample_poses)
+SLACK = 2.0
+
+def perturbations(rng, shape, noise='truncation', sigma=1.0):
+  """
+  Random corner offsets in pixels
+  """
+  if noise == 'truncation':
+    return rng.uniform(0.0, 1.0, shape)
+  if noise == 'rounding':
+    return rng.uniform(-0.5, 0.5, shape)
+  if noise == 'gaussian':
+    return rng.normal(0.0, sigma, shape)
+  raise ValueError('Unknown noise model: ' + str(noise))
+
+def _cholesky_solve(A, b):
+  """
+  Solve the 6x6 symmetric positive definite systems A x = b of every sample, with A a
+  6x6xN array and b a 6xN array. Written over the sample axis, which is much faster
+  than np.linalg.solve on millions of tiny systems. Singular systems give NaN
+  """
+  m = len(b)
+  L = {}
+  with np.errstate(invalid='ignore', divide='ignore'):
+    for j in range(m):
+      d = A[j, j] - sum(L[j, k]*L[j, k] for k in range(j))
+      L[j, j] = np.sqrt(np.where(d > 0, d, np.nan))
+      for i in range(j + 1, m):
+        L[i, j] = (A[i, j] - sum(L[i, k]*L[j, k] for k in range(j)))/L[j, j]
+    y = []
+    for i in range(m):
+      y.append((b[i] - sum(L[i, k]*y[k] for k in range(i)))/L[i, i])
+    x = [None]*m
+    for i in reversed(range(m)):
+      x[i] = (y[i] - sum(L[k, i]*x[k] for k in range(i + 1, m)))/L[i, i]
+  return x
+
+def _linearize(R, T, targets, vertices_3D, K):
+  """
+  Reprojection cost (sum of squared pixel residuals) of planar signs through a
+  distortion-free camera, and its normal equations, for many samples at once. The arrays
+  have the sample axis last: R: 3x3xN rotation matrices, T: 3xN, targets: 4x2xN pixels.
+  The rotation is parametrized by a small rotation on the left, so no Rodrigues
+  derivatives are needed
+  Returns the N costs, the 6x6xN J^T J and the 6xN J^T r
+  """
+  fx, s, cx, fy, cy = K[0, 0], K[0, 1], K[0, 2], K[1, 1], K[1, 2]
+  J = np.empty((len(vertices_3D), 2, 6, T.shape[1]))
+  residuals = np.empty((len(vertices_3D), 2, T.shape[1]))
+  for k, (X, Y, _) in enumerate(vertices_3D):
+    # Sign point in camera coordinates, relative to the sign center (q) and absolute (c)
+    q = [X*R[i, 0] + Y*R[i, 1] for i in range(3)]
+    c = [q[i] + T[i] for i in range(3)]
+    inv_z = 1/c[2]
+    x, y = c[0]*inv_z, c[1]*inv_z
+    residuals[k, 0] = fx*x + s*y + cx - targets[k, 0]
+    residuals[k, 1] = fy*y + cy - targets[k, 1]
+    for row, a in enumerate([(fx*inv_z, s*inv_z, -(fx*x + s*y)*inv_z), (0.0, fy*inv_z, -fy*y*inv_z)]):
+      # d/d(rotation) of a . c is q x a, d/dT is a
+      J[k, row, 0] = q[1]*a[2] - q[2]*a[1]
+      J[k, row, 1] = q[2]*a[0] - q[0]*a[2]
+      J[k, row, 2] = q[0]*a[1] - q[1]*a[0]
+      J[k, row, 3], J[k, row, 4], J[k, row, 5] = a
+  J = J.reshape(-1, 6, T.shape[1])
+  residuals = residuals.reshape(-1, T.shape[1])
+  return (np.sum(residuals**2, axis=0), np.einsum('kin,kjn->ijn', J, J),
+          np.einsum('kin,kn->in', J, residuals))
+
+def _update(R, T, delta):
+  return _rotate(R, [-d for d in delta[:3]]), T - np.stack(delta[3:])
+
+def levenberg_marquardt(R, T, targets, vertices_3D, K, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+  """
+  Damped Gauss-Newton (Levenberg-Marquardt) of every sample (see _linearize), each with
+  its own damping. A step is only taken if it lowers the cost of its sample. A sample
+  converges at a minimum (see _stationary), and gives up when the damping grows over
+  MAX_DAMPING without a lower cost. The samples still moving are kept packed together,
+  and the others are written back as they stop
+  Returns the new R and T, their costs and whether every sample converged (samples
+  starting from a NaN pose do not)
+  """
+  R, T = R.copy(), T.copy()
+  cost, JtJ, Jtr = _linearize(R, T, targets, vertices_3D, K)
+  converged = np.zeros(len(cost), dtype=bool)
+  moving = np.isfinite(cost)
+  converged[moving] = _stationary(cost[moving], JtJ[:, :, moving], Jtr[:, moving], tolerance)
+  index = np.flatnonzero(moving & ~converged)
+  r, t, c, A0, g, tg = R[:, :, index], T[:, index], cost[index], JtJ[:, :, index], Jtr[:, index], targets[:, :, index]
+  damping = np.full(len(index), 1e-3)
+  for _ in range(max_iterations):
+    if len(index) == 0:
+      break
+    A = A0.copy()
+    for j in range(6):
+      A[j, j] += damping*A0[j, j]
+    new_r, new_t = _update(r, t, _cholesky_solve(A, g))
+    new_c, new_A, new_g = _linearize(new_r, new_t, tg, vertices_3D, K)
+    better = new_c <= c
+    r, t = np.where(better, new_r, r), np.where(better, new_t, t)
+    c, A0, g = np.where(better, new_c, c), np.where(better, new_A, A0), np.where(better, new_g, g)
+    damping *= np.where(better, 0.1, 10.0)
+    done = _stationary(c, A0, g, tolerance)
+    converged[index[done]] = True
+    # The samples that no damping improves any more and are not at a minimum give up
+    stop = done | (damping > MAX_DAMPING)
+    if np.any(stop):
+      R[:, :, index[stop]], T[:, index[stop]], cost[index[stop]] = r[:, :, stop], t[:, stop], c[stop]
+      keep = ~stop
+      index, damping = index[keep], damping[keep]
+      r, t, c, A0, g, tg = r[:, :, keep], t[:, keep], c[keep], A0[:, :, keep], g[:, keep], tg[:, :, keep]
+  R[:, :, index], T[:, index], cost[index] = r, t, c
+  return R, T, cost, converged
+
+def _stationary(cost, JtJ, Jtr, tolerance):
+  """
+  Whether the samples are at a minimum of their cost: the residuals are zero, or the
+  cosine between the residuals and every column of the Jacobian is below tolerance
+  """
+  with np.errstate(invalid='ignore', divide='ignore'):
+    cosines = np.abs(Jtr)/np.sqrt(np.einsum('iin->in', JtJ)*cost)
+  return (cost < 1e-24) | np.all(cosines < tolerance, axis=0)
+
+def _rotate(R, w):
+  """
+  Rotation matrices (3x3xN) turned by the rotation vectors w (3 N-vectors): exp([w]x) R,
+  with exp([w]x) = I + a [w]x + b (w w^T - |w|^2 I) as in rodrigues_batch
+  """
+  theta2 = w[0]*w[0] + w[1]*w[1] + w[2]*w[2]
+  theta = np.sqrt(theta2)
+  small = theta < 1e-6
+  safe_theta = np.where(small, 1.0, theta)
+  a = np.where(small, 1 - theta2/6, np.sin(safe_theta)/safe_theta)
+  b = np.where(small, 0.5 - theta2/24, (1 - np.cos(safe_theta))/safe_theta**2)
+  diagonal = 1 - b*theta2
+  W = [[None, -w[2], w[1]], [w[2], None, -w[0]], [-w[1], w[0], None]]
+  dR = [[(diagonal if i == j else a*W[i][j]) + b*w[i]*w[j] for j in range(3)] for i in range(3)]
+  return np.stack([np.stack([dR[i][0]*R[0, k] + dR[i][1]*R[1, k] + dR[i][2]*R[2, k] for k in range(3)])
+                   for i in range(3)])
+
+def mirrored_pose(R, T):
+  """
+  The other pose of a planar sign that projects almost the same (the sign tilted the
+  other way with respect to the line of sight), as a start for Levenberg-Marquardt:
+  the sign axes are reflected through the plane normal to T
+  R: 3x3xN, T: 3xN
+  """
+  t = T/np.sqrt(np.sum(T**2, axis=0))
+  reflect = lambda v: v - 2*np.sum(v*t, axis=0)*t
+  return np.stack([reflect(R[:, 0]), reflect(R[:, 1]), -reflect(R[:, 2])], axis=1), T.copy()
+
+def _keep_lower(result, other):
+  """
+  Per sample, the levenberg_marquardt result (R, T, cost, converged) of lower cost
+  """
+  R, T, cost, converged = result
+  lower = (other[2] < cost) | (~np.isfinite(cost) & np.isfinite(other[2]))
+  R[:, :, lower], T[:, lower], cost[lower], converged[lower] = \
+    other[0][:, :, lower], other[1][:, lower], other[2][lower], other[3][lower]
+  return R, T, cost, converged
+
+def _take(result, index):
+  R, T, cost, converged = result
+  return R[:, :, index], T[:, index], cost[index], converged[index]
+
+def _put(result, index, other):
+  result[0][:, :, index], result[1][:, index], result[2][index], result[3][index] = other
+
+def sample_poses(R_vecs, T_vecs, corners, normalized, vertices_3D, K, max_iterations=MAX_ITERATIONS, slack=SLACK):
+  """
+  Poses of the perturbed corners of every sign, found by Levenberg-Marquardt. The
+  reprojection error of a planar sign has two minima (see mirrored_pose), and the
+  perturbation can make either one the lower. Both are found for the unperturbed
+  corners, and every sample starts from the lower one. Only the samples that could
+  still be at the wrong one are solved again from the mirrored pose of their result:
+  those whose cost is not clearly below the lowest the other minimum can reach with
+  their perturbation (to first order, the square root of its cost moves by at most the
+  norm of the perturbation; slack allows for the nonlinearity), the samples of signs
+  whose minima did not both converge, and those that did not converge. The closed-form
+  homography pose is a third start for the samples that still did not converge
+  R_vecs, T_vecs: Nx3 poses of the unperturbed corners, corners: Nx4x2 unperturbed
+  corners, normalized: NxSx4x2 perturbed corners (both undistorted normalized coordinates)
+  Returns the rotation matrices (3x3xNS), T vectors (3xNS), costs and convergence (NS)
+  of the samples
+  """
+  n, n_samples = normalized.shape[:2]
+  normalized = normalized.reshape(n*n_samples, 4, 2)
+  targets = np.ascontiguousarray(pnp_batch.undistorted_pixels_batch(normalized, K).transpose(1, 2, 0))
+  nominal_targets = np.ascontiguousarray(pnp_batch.undistorted_pixels_batch(corners, K).transpose(1, 2, 0))
+  nominal = levenberg_marquardt(np.ascontiguousarray(pnp_batch.rodrigues_batch(R_vecs).transpose(1, 2, 0)),
+                                np.ascontiguousarray(T_vecs.T), nominal_targets, vertices_3D, K, max_iterations)
+  mirrored = levenberg_marquardt(*mirrored_pose(nominal[0], nominal[1]), nominal_targets, vertices_3D, K,
+                                 max_iterations)
+  lower = mirrored[2] < nominal[2]
+  R, T = np.where(lower, mirrored[0], nominal[0]), np.where(lower, mirrored[1], nominal[1])
+  # Without both minima of the sign, all of its samples are solved again
+  other_cost = np.where(nominal[3] & mirrored[3], np.where(lower, nominal[2], mirrored[2]), np.nan)
+  result = levenberg_marquardt(np.repeat(R, n_samples, axis=2), np.repeat(T, n_samples, axis=1), targets,
+                               vertices_3D, K, max_iterations)
+  perturbation = np.sqrt(np.sum((targets - np.repeat(nominal_targets, n_samples, axis=2))**2, axis=(0, 1)))
+  reach = np.repeat(np.sqrt(other_cost), n_samples) - slack*perturbation
+  # NaN costs (and a NaN other minimum) compare False, so they are solved again too
+  retry = np.flatnonzero(~(result[3] & (np.sqrt(result[2]) < reach)))
+  if len(retry):
+    current = _take(result, retry)
+    _put(result, retry, _keep_lower(current, levenberg_marquardt(
+      *mirrored_pose(current[0], current[1]), np.ascontiguousarray(targets[:, :, retry]), vertices_3D, K,
+      max_iterations)))
+  retry = np.flatnonzero(~result[3])
+  if len(retry):
+    R, T = pnp_batch.homography_pose_batch(normalized[retry], vertices_3D)
+    _put(result, retry, _keep_lower(_take(result, retry), levenberg_marquardt(
+      np.ascontiguousarray(R.transpose(1, 2, 0)), np.ascontiguousarray(T.T),
+      np.ascontiguousarray(targets[:, :, retry]), vertices_3D, K, max_iterations)))
+  return result
+
+def exact_poses(normalized, vertices_3D, K, max_iterations=MAX_ITERATIONS):
+  """
+  Poses of Mx4x2 normalized corners solved from scratch: Levenberg-Marquardt from the
+  result of pnp_batch.find_R_t_undistorted_batch (which can stop short of a minimum) and
+  from the mirrored pose of that result, keeping the lower cost
+  Returns the rotation matrices (3x3xM), T vectors (3xM) and costs (M)
+  """
+  targets = np.ascontiguousarray(pnp_batch.undistorted_pixels_batch(normalized, K).transpose(1, 2, 0))
+  R_vecs, T_vecs = pnp_batch.find_R_t_undistorted_batch(normalized, K, vertices_3D)
+  R = np.ascontiguousarray(pnp_batch.rodrigues_batch(R_vecs).transpose(1, 2, 0))
+  T = np.ascontiguousarray(T_vecs.T)
+  result = levenberg_marquardt(R, T, targets, vertices_3D, K, max_iterations)
+  mirrored = levenberg_marquardt(*mirrored_pose(result[0], result[1]), targets, vertices_3D, K, max_iterations)
+  return _keep_lower(result, mirrored)[:3]
+
+def sample_distances(vertices_2D, n_samples=1000, profile=None, noise='truncation', sigma=1.0, seed=0,
+                     max_iterations=MAX_ITERATIONS, exact=False):
+  """
+  Horizontal distances of n_samples random perturbations of the corners of every sign
+  vertices_2D: Nx4x2 ordered corners
+  exact: solve every sample from scratch with exact_poses instead (slower, to check
+  the Levenberg-Marquardt samples)
+  The samples are solved in the pixels of the undistorted image, like --undistort-once
+  Returns the N nominal distances, the NxS sampled distances (NaN where no pose was
+  found) and the NxS samples whose Levenberg-Marquardt did not converge and were solved
+  from scratch
+  """
+  profile = conf.PROFILE if profile is None else profile
+  K, vertices_3D = profile.K.astype(np.float64), profile.DEFAULT_VERTICES_3D.astype(np.float64)
+  vertices_2D = np.asarray(vertices_2D, dtype=np.float64).reshape(-1, 4, 2)
+  rng = np.random.RandomState(seed)
+  nominal_normalized = pnp_batch.normalize_2D_batch(vertices_2D, K, profile.DIST_COEFFS, profile.K_INV)
+  nominal_R, nominal_T = pnp_batch.find_R_t_undistorted_batch(nominal_normalized, K, vertices_3D)
+  nominal = pnp_batch.find_horizontal_distance_batch(nominal_R, nominal_T)
+  distances = np.full((len(vertices_2D), n_samples), np.nan)
+  unconverged = np.zeros((len(vertices_2D), n_samples), dtype=bool)
+  signs_per_chunk = max(1, ROWS_PER_CHUNK//max(n_samples, 1))
+  for i in range(0, len(vertices_2D), signs_per_chunk):
+    corners = vertices_2D[i:i + signs_per_chunk]
+    n = len(corners)
+    perturbed = corners[:, None] + perturbations(rng, (n, n_samples, 4, 2), noise, sigma)
+    normalized = pnp_batch.normalize_2D_batch(perturbed, K, profile.DIST_COEFFS, profile.K_INV)
+    if exact:
+      R, T, _ = exact_poses(normalized.reshape(-1, 4, 2), vertices_3D, K, max_iterations)
+      # Horizontal distance: -T . (third column of R), as in find_horizontal_distance_batch
+      distances[i:i + n] = -np.sum(T*R[:, 2], axis=0).reshape(n, n_samples)
+    else:
+      R, T, cost, converged = sample_poses(nominal_R[i:i + n], nominal_T[i:i + n], nominal_normalized[i:i + n],
+                                           normalized, vertices_3D, K, max_iterations)
+      # Horizontal distance: -T . (third column of R), as in find_horizontal_distance_batch
+      sampled = -np.sum(T*R[:, 2], axis=0)
+      retry = np.flatnonzero(~converged)
+      if len(retry):
+        # The samples that did not converge are solved from scratch, keeping the lower cost
+        exact_R, exact_T, exact_cost = exact_poses(normalized.reshape(-1, 4, 2)[retry], vertices_3D, K,
+                                                   max_iterations)
+        lower = (exact_cost < cost[retry]) | (~np.isfinite(cost[retry]) & np.isfinite(exact_cost))
+        sampled[retry[lower]] = -np.sum(exact_T*exact_R[:, 2], axis=0)[lower]
+      distances[i:i + n] = sampled.reshape(n, n_samples)
+      unconverged[i:i + n] = ~converged.reshape(n, n_samples)
+  return nominal, distances, unconverged
+
+def summarize(nominal, distances, percentiles=PERCENTILES, unconverged=None):
+  """
+  Per-sign distance mean, standard deviation and percentiles of the samples, the number
+  of samples without a pose (failed, left out of the statistics) and of samples whose
+  Levenberg-Marquardt did not converge (unconverged, solved again from scratch)
+  """
+  if unconverged is None:
+    unconverged = np.zeros(distances.shape, dtype=bool)
+  with warnings.catch_warnings():
+    # Signs without a pose have only NaN samples, and NaN statistics
+    warnings.simplefilter('ignore', RuntimeWarning)
+    return {'distance': nominal,
+            'failed': np.sum(np.isnan(distances), axis=1),
+            'unconverged': np.sum(unconverged, axis=1),
+            'mean': np.nanmean(distances, axis=1) if distances.size else np.zeros(len(nominal)),
+            'std': np.nanstd(distances, axis=1) if distances.size else np.zeros(len(nominal)),
+            'percentiles': np.nanpercentile(distances, percentiles, axis=1).T if distances.size
+                           else np.zeros((len(nominal), len(percentiles)))}
+
+def uncertainty_chunk(vertices_2D, profile_name, n_samples, noise, sigma, seed, percentiles, exact=False):
+  """
+  Worker: summary of the samples of a chunk of signs
+  """
+  nominal, distances, unconverged = sample_distances(vertices_2D, n_samples, profiles.get_profile(profile_name),
+                                                     noise, sigma, seed, exact=exact)
+  return summarize(nominal, distances, percentiles, unconverged)
+
+def estimate(batch, n_samples=1000, noise='truncation', sigma=1.0, seed=0, percentiles=PERCENTILES,
+             workers=1, chunk_size=4096, exact=False):
+  """
+  Distance uncertainty of every sign of a QuadrilateralBatch, on a pool of worker
+  processes. Every chunk has its own seed, so the results depend on chunk_size but not
+  on the number of workers
+  """
+  chunks = [(batch.vertices_2D[i:i + chunk_size], batch.profile.name, n_samples, noise, sigma,
+             seed + i//chunk_size, percentiles, exact) for i in range(0, len(batch), chunk_size)]
+  if workers <= 1 or len(chunks) <= 1:
+    results = [uncertainty_chunk(*chunk) for chunk in chunks]
+  else:
+    pool = Pool(workers)
+    try:
+      results = pool.starmap(uncertainty_chunk, chunks)
+    finally:
+      pool.close()
+      pool.join()
+  if not results:
+    return summarize(np.zeros(0), np.zeros((0, n_samples)), percentiles)
+  return {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+
+def records(batch, summary, percentiles=PERCENTILES):
+  for i in range(len(batch)):
+    record = {'id': str(batch.ids[i]), 'distance': float(summary['distance'][i]),
+              'mean': float(summary['mean'][i]), 'std': float(summary['std'][i]),
+              'failed': int(summary['failed'][i]), 'unconverged': int(summary['unconverged'][i])}
+    for p, value in zip(percentiles, summary['percentiles'][i]):
+      record['p' + ('%g' % p)] = float(value)
+    yield record
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--profile', default=conf.model, choices=profiles.profile_names(),
+                      help='camera profile whose JSON_INPUT is processed')
+  parser.add_argument('--input', default=None, help='labels to process instead of the JSON_INPUT of the profile')
+  parser.add_argument('--synthetic', type=int, default=None,
+                      help='process this many synthetic signs instead of labels (for timing)')
+  parser.add_argument('--samples', type=int, default=1000, help='perturbations of every sign')
+  parser.add_argument('--noise', default='truncation', choices=NOISE_MODELS)
+  parser.add_argument('--sigma', type=float, default=1.0, help='pixels, for --noise gaussian')
+  parser.add_argument('--percentiles', default=','.join('%g' % p for p in PERCENTILES))
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int, default=1)
+  parser.add_argument('--chunk-size', type=int, default=4096)
+  parser.add_argument('--exact', action='store_true',
+                      help='solve every sample from scratch instead of from the unperturbed pose (slow)')
+  parser.add_argument('--output', default=None,
+                      help='write the distance, mean, std and percentiles of every sign to this .json/.jsonl file')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  conf.use_profile(args.profile)
+  percentiles = tuple(float(p) for p in args.percentiles.split(','))
+  if args.synthetic is not None:
+    data = synthetic.generate(args.synthetic, conf.PROFILE, shuffle_corners=False, seed=args.seed)
+    batch = QuadrilateralBatch(data['ids'], data['corners'], profile=conf.PROFILE)
+  else:
+    batch = Processing().create_quadrilateral_batch(iter_records(args.input or conf.JSON_INPUT), conf.JSON_FLAG)
+  start = time.perf_counter()
+  summary = estimate(batch, args.samples, args.noise, args.sigma, args.seed, percentiles, args.workers,
+                     args.chunk_size, args.exact)
+  seconds = time.perf_counter() - start
+  if args.output is not None:
+    with RecordWriter(args.output) as writer:
+      writer.write_all(records(batch, summary, percentiles))
+  print('***********************************************************************')
+  print('Signs: ' + str(len(batch)) + ', samples per sign: ' + str(args.samples) + ', noise: ' + args.noise)
+  print('Time: %.2f s (%.3f us per sample)' % (seconds, 1e6*seconds/max(len(batch)*args.samples, 1)))
+  print('Samples without a pose: ' + str(int(np.sum(summary['failed']))) + ', not converged (solved from '
+        'scratch): ' + str(int(np.sum(summary['unconverged']))))
+  std = summary['std'][np.isfinite(summary['std'])]
+  if len(std):
+    relative = std/np.abs(summary['distance'][np.isfinite(summary['std'])])
+    print('Distance std: median %.4f, max %.4f (relative: median %.4f, max %.4f)' %
+          (np.median(std), np.max(std), np.median(relative), np.max(relative)))
+  print('***********************************************************************')
+
+if __name__ == '__main__':
+  main()
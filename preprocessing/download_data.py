@@ -1,33 +1,256 @@
+import argparse
+import hashlib
+import html
+import http.client
 import json
+import os, re, sys
+import threading
 from multiprocessing.dummy import Pool as ThreadPool
-import gdown
+from urllib.parse import urlsplit, urljoin
 
-IMG_PATH = './data/exit_sign/'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pnp_distance_measurement'))
+from json_stream import iter_records, RecordWriter
 
-def get_list(data):
-  success, failed = [], []
-  for i in range(len(data)):
-    id = data[i]['External ID']
-    img_url = data[i]['Labeled Data']
+JSON_INPUT = '../data/json/quadrilateral-raw-1807.json'
+IMG_PATH = '../data/exit_sign_1787/'
+MASK_PATH = '../data/exit_sign_1787_masks/'
+LABEL = 'EXIT_sign'
+# Size and sha1 of every completed download, used to skip it on the next run
+MANIFEST = 'downloads.jsonl'
+FAILURES = 'download_failures.json'
+CHUNK_SIZE = 1 << 16
+MAX_REDIRECTS = 5
+# Largest HTML page read when looking for the confirm link of a Google Drive download
+MAX_PAGE_SIZE = 1 << 20
+
+def get_list(data, label=LABEL, img_path=IMG_PATH, mask_path=MASK_PATH):
+  """
+  Download jobs (id, kind, url, file name) of the images and their masks, and the
+  records without a mask as failures
+  """
+  jobs, failed = [], []
+  for record in data:
+    id = record['External ID']
+    jobs.append((id, 'image', record['Labeled Data'], img_path + id))
     try:
-      label_url = data[i]['Masks']['EXIT_sign']
-      success.append((id, img_url, label_url))
+      mask_url = record['Masks'][label]
     except:
-      failed.append((id, img_url))
-  return success, failed
+      failed.append({'id': id, 'kind': 'mask', 'url': None, 'error': 'no mask url'})
+      continue
+    jobs.append((id, 'mask', mask_url, mask_path + os.path.splitext(id)[0] + '.png'))
+  return jobs, failed
+
+class ConnectionPool(object):
+  def __init__(self, timeout=60):
+    """
+    One keep-alive connection per thread and per (scheme, host, port), so that every
+    worker thread reuses its connections instead of opening one per file
+    """
+    self.timeout = timeout
+    self.local = threading.local()
+
+  def request(self, method, url, headers=None):
+    """
+    Send a request, following redirects. Returns the response, whose body must be
+    read before the next request of the same thread
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+      parts = urlsplit(url)
+      path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+      response = self._send(parts, method, path, headers or {})
+      if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+        response.read()
+        url = urljoin(url, response.getheader('Location'))
+        if response.status == 303:
+          method = 'GET'
+        continue
+      return response
+    raise IOError('Too many redirects: ' + url)
+
+  def _send(self, parts, method, path, headers):
+    key = (parts.scheme, parts.hostname, parts.port)
+    connections = self.local.__dict__.setdefault('connections', {})
+    for attempt in range(2):
+      connection = connections.get(key)
+      if connection is None:
+        cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        connection = connections[key] = cls(parts.hostname, parts.port, timeout=self.timeout)
+      try:
+        connection.request(method, path, headers=headers)
+        return connection.getresponse()
+      except (http.client.HTTPException, ConnectionError):
+        # The server closed the kept-alive connection: reconnect once
+        connection.close()
+        del connections[key]
+        if attempt:
+          raise
+
+def file_sha1(file_name):
+  h = hashlib.sha1()
+  with open(file_name, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def is_complete(file_name, entry, verify_hash=False):
+  """
+  Whether a downloaded file matches its manifest entry (size, and sha1 if asked to)
+  """
+  if entry is None or not os.path.exists(file_name) or os.path.getsize(file_name) != entry['size']:
+    return False
+  return not verify_hash or file_sha1(file_name) == entry['sha1']
+
+def is_html(response):
+  return (response.getheader('Content-Type') or '').split(';')[0].strip().lower() == 'text/html'
+
+def confirm_url(url, page):
+  """
+  URL of the file behind the "can't scan this file for viruses" page Google Drive
+  serves instead of large files: the action of its download form with its hidden
+  fields, or its confirm link. Returns None for any other page
+  """
+  form = re.search(r'<form[^>]*id="download-form"[^>]*action="([^"]+)"(.*?)</form>', page, re.S)
+  if form:
+    fields = re.findall(r'<input[^>]*type="hidden"[^>]*name="([^"]+)"[^>]*value="([^"]*)"', form.group(2))
+    query = '&'.join(name + '=' + html.unescape(value) for name, value in fields)
+    return urljoin(url, html.unescape(form.group(1))) + ('?' + query if query else '')
+  link = re.search(r'href="([^"]*confirm=[^"]+)"', page)
+  if link:
+    return urljoin(url, html.unescape(link.group(1)))
+  return None
+
+def download(pool, url, file_name):
+  """
+  Download url to file_name through a .part file, resuming a previous partial download
+  when the server supports range requests. An HTML page (a Google Drive virus scan
+  warning, a login page) is not a download: the confirm link of a warning is followed
+  once, any other page is an error. Returns the size of the file
+  """
+  part_name = file_name + '.part'
+  offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+  headers = {'Range': 'bytes=' + str(offset) + '-'} if offset else {}
+  response = pool.request('GET', url, headers)
+  if response.status in (200, 206) and is_html(response):
+    page = response.read(MAX_PAGE_SIZE).decode('utf-8', 'replace')
+    response.read()
+    confirmed = confirm_url(url, page)
+    if confirmed is None:
+      raise IOError('HTML page instead of a file: ' + url)
+    # The warning cookie of older pages goes along with the confirm token
+    cookies = [c.split(';')[0] for c in response.headers.get_all('Set-Cookie') or []]
+    if cookies:
+      headers = dict(headers, Cookie='; '.join(cookies))
+    response = pool.request('GET', confirmed, headers)
+    if response.status in (200, 206) and is_html(response):
+      response.read()
+      raise IOError('HTML page instead of a file: ' + confirmed)
+  if response.status == 416 and offset:
+    # The partial file is already the whole file
+    response.read()
+  elif response.status in (200, 206):
+    if response.status == 200:
+      offset = 0
+    length = response.getheader('Content-Length')
+    expected = None if length is None else offset + int(length)
+    with open(part_name, 'ab' if offset else 'wb') as f:
+      for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+        f.write(chunk)
+    if expected is not None and os.path.getsize(part_name) != expected:
+      raise IOError('Incomplete download: ' + str(os.path.getsize(part_name)) + ' of ' + str(expected) + ' bytes')
+  else:
+    response.read()
+    raise IOError('HTTP ' + str(response.status) + ' ' + response.reason)
+  os.replace(part_name, file_name)
+  return os.path.getsize(file_name)
+
+def download_all(jobs, workers=8, manifest=None, verify_hash=False, timeout=60):
+  """
+  Download the jobs on a bounded pool of threads with pooled connections, skipping the
+  files of the manifest that are already complete
+  manifest: {file name: {'size', 'sha1'}} of previous runs
+  Yields (job, status, manifest entry or error message) as the jobs finish, where
+  status is 'skipped' (complete in the manifest), 'present' (already there, with the
+  size announced by the server), 'downloaded' or 'failed'
+  """
+  manifest = manifest or {}
+  pool = ConnectionPool(timeout)
+
+  def run(job):
+    id, kind, url, file_name = job
+    if is_complete(file_name, manifest.get(file_name), verify_hash):
+      return job, 'skipped', manifest[file_name]
+    try:
+      if file_name not in manifest and os.path.exists(file_name):
+        # Downloaded before there was a manifest: keep it if the size is right
+        response = pool.request('HEAD', url)
+        response.read()
+        length = response.getheader('Content-Length')
+        if (response.status == 200 and not is_html(response) and length is not None and
+            int(length) == os.path.getsize(file_name)):
+          return job, 'present', {'file': file_name, 'size': int(length), 'sha1': file_sha1(file_name)}
+      directory = os.path.dirname(file_name)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+      size = download(pool, url, file_name)
+      return job, 'downloaded', {'file': file_name, 'size': size, 'sha1': file_sha1(file_name)}
+    except Exception as e:
+      return job, 'failed', str(e)
+
+  threads = ThreadPool(workers)
+  try:
+    for result in threads.imap_unordered(run, jobs):
+      yield result
+  finally:
+    threads.close()
+    threads.join()
 
-def get_url(id, img_url):
-  gdown.download(img_url, IMG_PATH + id, quiet=False) 
+def read_manifest(manifest_file):
+  """
+  {file name: last manifest entry of the file}
+  """
+  if not os.path.exists(manifest_file):
+    return {}
+  return {entry['file']: entry for entry in iter_records(manifest_file)}
 
-with open('./data/quadrilateral-raw-1807.json') as f:
-  data = json.load(f)
-success, failed = get_list(data)
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--input', default=JSON_INPUT, help='labelbox export json')
+  parser.add_argument('--img-path', default=IMG_PATH)
+  parser.add_argument('--mask-path', default=MASK_PATH)
+  parser.add_argument('--no-masks', action='store_true', help='only download the images')
+  parser.add_argument('--workers', type=int, default=8, help='concurrent downloads')
+  parser.add_argument('--manifest', default=MANIFEST,
+                      help='.jsonl of the completed downloads (size and sha1), appended to by every run')
+  parser.add_argument('--verify-hash', action='store_true',
+                      help='also compare the sha1 of the files already downloaded before skipping them')
+  parser.add_argument('--failures', default=FAILURES, help='json list of the failed downloads')
+  parser.add_argument('--timeout', type=float, default=60, help='seconds')
+  return parser.parse_args()
 
-print('Success count ' + str(len(success)))
-print('Failure count ' + str(len(failed)))
+if __name__ == '__main__':
+  args = parse_args()
+  jobs, failed = get_list(iter_records(args.input), LABEL, args.img_path, args.mask_path)
+  if args.no_masks:
+    jobs = [job for job in jobs if job[1] == 'image']
+    failed = []
+  print('Files to download ' + str(len(jobs)))
+  print('Records without a mask ' + str(len(failed)))
 
-for i in range(0, len(success)):
-  (id, img_url, label_url) = success[i]
-  get_url(id, img_url)
-  print(str(i) + ' ' + id)
+  manifest = read_manifest(args.manifest)
+  counts = {'skipped': 0, 'present': 0, 'downloaded': 0, 'failed': 0}
+  # Completed downloads are appended as they finish, so an interrupted run loses nothing
+  with open(args.manifest, 'a') as manifest_file:
+    for i, (job, status, result) in enumerate(download_all(jobs, args.workers, manifest, args.verify_hash, args.timeout)):
+      id, kind, url, file_name = job
+      counts[status] += 1
+      if status == 'failed':
+        failed.append({'id': id, 'kind': kind, 'url': url, 'error': result})
+      elif status != 'skipped':
+        manifest_file.write(json.dumps(result, sort_keys=True) + '\n')
+        manifest_file.flush()
+      print(str(i) + ' ' + status + ' ' + kind + ' ' + id)
 
+  with RecordWriter(args.failures) as writer:
+    writer.write_all(failed)
+  print(counts)
+  print('Failure count ' + str(len(failed)) + ', see ' + args.failures)
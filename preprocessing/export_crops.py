@@ -0,0 +1,224 @@
+import argparse
+import collections
+import hashlib
+import json
+import os, sys
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pnp_distance_measurement'))
+from json_stream import iter_records
+from export_results import read_columns
+import profiles
+
+INPUT_JSON = '../data/json/street-results-1008x756.json'
+OUTPUT = '../data/crops/street-1008x756'
+PROFILE = 'street_1008x756_iPhone8s'
+INDEX = 'index.json'
+CROP_SIZE = 128
+# Context around the sign on each side, as a fraction of the longest side of its bounding box
+PADDING = 0.25
+# The crops and the done flags are flushed to disk every FLUSH_EVERY images, so that
+# an interrupted export only redoes the images after the last flush
+FLUSH_EVERY = 256
+
+def crop_boxes(corners, padding=PADDING):
+  """
+  Square box (x0, y0, side) in pixels of the image around every sign of an Nx4x2
+  corner array, centered on its bounding box
+  """
+  low, high = corners.min(axis=1), corners.max(axis=1)
+  side = np.ceil(np.max(high - low, axis=1)*(1 + 2*padding)).astype(np.int64) + 1
+  center = (low + high)/2
+  x0y0 = np.floor(center - side[:, None]/2).astype(np.int64)
+  return np.column_stack([x0y0, side]).astype(np.int32)
+
+def crop(img, box, size):
+  """
+  size x size crop of the box (x0, y0, side) of an image, black where the box is
+  outside of the image
+  """
+  x0, y0, side = [int(v) for v in box]
+  h, w = img.shape[:2]
+  cx0, cy0, cx1, cy1 = max(x0, 0), max(y0, 0), min(x0 + side, w), min(y0 + side, h)
+  if cx1 <= cx0 or cy1 <= cy0:
+    return np.zeros((size, size) + img.shape[2:], dtype=img.dtype)
+  roi = cv2.copyMakeBorder(img[cy0:cy1, cx0:cx1], cy0 - y0, y0 + side - cy1, cx0 - x0, x0 + side - cx1,
+                           cv2.BORDER_CONSTANT, value=0)
+  interpolation = cv2.INTER_AREA if side > size else cv2.INTER_LINEAR
+  return cv2.resize(roi, (size, size), interpolation=interpolation)
+
+class CropDataset(object):
+  def __init__(self, path):
+    """
+    Read side of an export: every array is memory-mapped, so a sample is a view into
+    the files, without copying or decoding a JPEG
+    crops: NxSxSx3 uint8 (BGR), corners: Nx4x2 in crop pixels, distances: N,
+    boxes: Nx3 (x0, y0, side) of the crops in the images, done: N (1 once written)
+    """
+    with open(os.path.join(path, INDEX)) as f:
+      self.index = json.load(f)
+    self.ids = self.index['ids']
+    self.arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                   for name in self.index['arrays']}
+    self.crops = self.arrays['crops']
+    self.corners = self.arrays['corners']
+    self.distances = self.arrays['distances']
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, i):
+    return self.crops[i], self.corners[i], self.distances[i]
+
+  def batches(self, batch_size, shuffle=False, seed=0):
+    """
+    Yield (crops, corners, distances) of batch_size written samples. Consecutive
+    samples are slices of the files (no copy); shuffled ones are gathered
+    """
+    indices = np.flatnonzero(self.arrays['done'])
+    if shuffle:
+      indices = np.random.RandomState(seed).permutation(indices)
+    for start in range(0, len(indices), batch_size):
+      chunk = indices[start:start + batch_size]
+      if not shuffle and len(chunk) and chunk[-1] - chunk[0] == len(chunk) - 1:
+        chunk = slice(chunk[0], chunk[-1] + 1)
+      yield self.crops[chunk], self.corners[chunk], self.distances[chunk]
+
+def results_hash(columns):
+  """
+  Hash of the corners and distances of the results, which the arrays are written from
+  """
+  h = hashlib.sha1()
+  for name in ('corners', 'distance', 'real_distance'):
+    if name in columns:
+      h.update(name.encode())
+      h.update(np.ascontiguousarray(columns[name], dtype=np.float64).tobytes())
+  return h.hexdigest()
+
+def write_labels(arrays, columns, size, padding):
+  """
+  Write everything that does not need the images: the boxes, the corners in crop
+  pixels and the distances
+  Returns the boxes
+  """
+  boxes = crop_boxes(columns['corners'].astype(np.float64), padding)
+  arrays['boxes'][:] = boxes
+  arrays['corners'][:] = (columns['corners'] - boxes[:, None, :2])*(size/boxes[:, 2])[:, None, None]
+  arrays['distances'][:] = columns['distance']
+  if 'real_distances' in arrays:
+    arrays['real_distances'][:] = columns['real_distance']
+  return boxes
+
+def open_store(path, columns, size, padding, img_path, overwrite=False):
+  """
+  Create the arrays and the index of an export, or open those of an earlier run of
+  the same images and crop settings to resume it. When the results changed since (e.g.
+  main.py was run again with --refine-corners), their corners, distances and boxes are
+  written again and the signs whose box moved are cropped again
+  Returns the dict of arrays (writable memory maps)
+  """
+  n = len(columns['filename'])
+  ids = columns['filename'].tolist()
+  index = {'count': n, 'crop_size': size, 'padding': padding, 'img_path': img_path, 'ids': ids,
+           'arrays': ['crops', 'corners', 'distances', 'boxes', 'done'], 'results': results_hash(columns)}
+  if 'real_distance' in columns:
+    index['arrays'].append('real_distances')
+  index_file = os.path.join(path, INDEX)
+  if os.path.exists(index_file) and not overwrite:
+    with open(index_file) as f:
+      existing = json.load(f)
+    if dict(existing, results=None) != dict(index, results=None):
+      raise SystemExit(path + ' holds another export (other images, crop size or padding); '
+                       'use --overwrite to replace it')
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r+') for name in index['arrays']}
+    if existing.get('results') != index['results']:
+      # The moved crops are marked to redo before anything else is written, so that an
+      # interruption cannot leave them done
+      moved = np.any(crop_boxes(columns['corners'].astype(np.float64), padding) != arrays['boxes'], axis=1)
+      arrays['done'][moved] = 0
+      arrays['done'].flush()
+      write_labels(arrays, columns, size, padding)
+      for values in arrays.values():
+        values.flush()
+      with open(index_file, 'w') as f:
+        json.dump(index, f)
+    return arrays
+
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  shapes = {'crops': ((n, size, size, 3), np.uint8), 'corners': ((n, 4, 2), np.float32),
+            'distances': ((n,), np.float64), 'boxes': ((n, 3), np.int32), 'done': ((n,), np.uint8),
+            'real_distances': ((n,), np.float64)}
+  arrays = {name: np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                            dtype=shapes[name][1], shape=shapes[name][0])
+            for name in index['arrays']}
+  write_labels(arrays, columns, size, padding)
+  for values in arrays.values():
+    values.flush()
+  # The index is written last: a store without it is started again
+  with open(index_file, 'w') as f:
+    json.dump(index, f)
+  return arrays
+
+def export(arrays, ids, img_path, size, workers=4):
+  """
+  Write the crops that are not done yet, one image per task on a pool of threads (all
+  the signs of an image share its decode), straight into the memory-mapped crops
+  Returns the counts of written and already done signs and of missing images
+  """
+  done = arrays['done']
+  images = collections.OrderedDict()
+  for i, id in enumerate(ids):
+    if not done[i]:
+      images.setdefault(id, []).append(i)
+
+  def export_one(item):
+    id, indices = item
+    img = cv2.imread(img_path + id, cv2.IMREAD_COLOR)
+    if img is None:
+      return indices, False
+    for i in indices:
+      arrays['crops'][i] = crop(img, arrays['boxes'][i], size)
+    return indices, True
+
+  counts = {'written': 0, 'done': len(ids) - sum(len(indices) for indices in images.values()), 'missing': 0}
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+    for k, (indices, ok) in enumerate(executor.map(export_one, images.items())):
+      if not ok:
+        counts['missing'] += 1
+        continue
+      done[indices] = 1
+      counts['written'] += len(indices)
+      if (k + 1) % FLUSH_EVERY == 0:
+        # The crops reach the disk before the flags that mark them done
+        arrays['crops'].flush()
+        done.flush()
+  arrays['crops'].flush()
+  done.flush()
+  return counts
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--input', default=INPUT_JSON, help='results .json or .jsonl written by main.py')
+  parser.add_argument('--output', default=OUTPUT, help='folder of the .npy arrays and ' + INDEX)
+  parser.add_argument('--profile', default=PROFILE, choices=profiles.profile_names(),
+                      help='camera profile whose IMG_PATH holds the images')
+  parser.add_argument('--img-path', default=None, help='folder of the images (default: the IMG_PATH of --profile)')
+  parser.add_argument('--size', type=int, default=CROP_SIZE, help='side of the square crops in pixels')
+  parser.add_argument('--padding', type=float, default=PADDING,
+                      help='context around the sign, as a fraction of its longest side')
+  parser.add_argument('--workers', type=int, default=4, help='threads decoding the images')
+  parser.add_argument('--overwrite', action='store_true', help='start again instead of resuming another export')
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parse_args()
+  img_path = args.img_path or profiles.get_profile(args.profile).IMG_PATH
+  columns = read_columns(iter_records(args.input))
+  arrays = open_store(args.output, columns, args.size, args.padding, img_path, args.overwrite)
+  counts = export(arrays, columns['filename'].tolist(), img_path, args.size, args.workers)
+  print(args.output)
+  print(str(counts['written']) + ' crops written, ' + str(counts['done']) + ' already done, ' +
+        str(counts['missing']) + ' images missing')
@@ -0,0 +1,120 @@
+import argparse
+import csv
+import os, sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pnp_distance_measurement'))
+from json_stream import iter_records
+
+# INPUT_JSON = '../data/json/quadrilateral-results-1787.json'
+# OUTPUT = '../data/csv/quadrilateral-1787'
+# INPUT_JSON = '../data/json/groundtruth-results-830.json'
+# OUTPUT = '../data/csv/groundtruth-830'
+# INPUT_JSON = '../data/json/street-results-4032x3024.json'
+# OUTPUT = '../data/csv/street-4032x3024'
+INPUT_JSON = '../data/json/street-results-1008x756.json'
+OUTPUT = '../data/csv/street-1008x756'
+CLASS = 'Exit_sign'
+# Columns of the csv written by the former json_to_csv.py, in its order
+CSV_COLUMNS = ['class', 'distance', 'filename', 'height', 'width', 'xmax', 'xmin', 'ymax', 'ymin']
+
+def read_columns(records):
+  """
+  Columns of a stream of results records (see json_stream.iter_records):
+  filename, width, height (N), corners (Nx4x2), bounding box xmin ymin xmax ymax (N),
+  R_vec, T_vec (Nx3), distance and real_distance (N, groundtruth only)
+  """
+  ids, img_sizes, vertices_2D, R_vecs, T_vecs, distances, real_distances = [], [], [], [], [], [], []
+  for record in records:
+    ids.append(record['id'])
+    img_sizes.append(record['img_size'])
+    vertices_2D.append(record['vertices_2D'])
+    R_vecs.append(record['R_vec'])
+    T_vecs.append(record['T_vec'])
+    distances.append(record['distance'])
+    if 'real_distance' in record:
+      real_distances.append(record['real_distance'])
+
+  n = len(ids)
+  img_sizes = np.array(img_sizes, dtype=np.int64).reshape(n, 2)
+  corners = np.array(vertices_2D).reshape(n, 4, 2)
+  columns = {
+    'filename': np.array(ids, dtype=str),
+    'width': img_sizes[:, 0],
+    'height': img_sizes[:, 1],
+    'corners': corners,
+    'xmin': corners[:, :, 0].min(axis=1),
+    'ymin': corners[:, :, 1].min(axis=1),
+    'xmax': corners[:, :, 0].max(axis=1),
+    'ymax': corners[:, :, 1].max(axis=1),
+    'R_vec': np.array(R_vecs, dtype=np.float64).reshape(n, 3),
+    'T_vec': np.array(T_vecs, dtype=np.float64).reshape(n, 3),
+    'distance': np.array(distances, dtype=np.float64),
+  }
+  if n and len(real_distances) == n:
+    columns['real_distance'] = np.array(real_distances)
+  return columns
+
+def write_csv(columns, output):
+  """
+  The bounding box csv of json_to_csv.py (the Tensorflow Object Detection input)
+  """
+  n = len(columns['filename'])
+  values = [[CLASS]*n if name == 'class' else columns[name].tolist() for name in CSV_COLUMNS]
+  with open(output, 'w', newline='') as f:
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(CSV_COLUMNS)
+    writer.writerows(zip(*values))
+
+def write_npz(columns, output):
+  np.savez(output, **columns)
+
+def write_npy(columns, output):
+  """
+  One .npy file per column in the output folder, for np.load(..., mmap_mode='r')
+  """
+  if not os.path.isdir(output):
+    os.makedirs(output)
+  for name, values in columns.items():
+    np.save(os.path.join(output, name + '.npy'), values)
+
+def write_parquet(columns, output):
+  """
+  Needs pyarrow. The corners and vectors are stored as fixed size list columns
+  """
+  try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+  except ImportError:
+    raise SystemExit('Writing parquet needs pyarrow (pip install pyarrow)')
+  arrays = {}
+  for name, values in columns.items():
+    if values.ndim == 1:
+      arrays[name] = pa.array(values)
+    else:
+      flat = pa.array(values.reshape(-1))
+      width = int(np.prod(values.shape[1:]))
+      arrays[name] = pa.FixedSizeListArray.from_arrays(flat, width)
+  pq.write_table(pa.table(arrays), output)
+
+WRITERS = {'csv': (write_csv, '.csv'), 'npz': (write_npz, '.npz'),
+           'npy': (write_npy, ''), 'parquet': (write_parquet, '.parquet')}
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--input', default=INPUT_JSON, help='results .json or .jsonl written by main.py')
+  parser.add_argument('--output', default=OUTPUT,
+                      help='output path without extension: PREFIX.csv, PREFIX.npz, PREFIX.parquet, '
+                           'PREFIX/ (one .npy per column)')
+  parser.add_argument('--format', action='append', choices=sorted(WRITERS), default=None,
+                      help='repeat for several outputs (default: csv)')
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parse_args()
+  columns = read_columns(iter_records(args.input))
+  for fmt in args.format or ['csv']:
+    write, extension = WRITERS[fmt]
+    write(columns, args.output + extension)
+    print(args.output + extension)
+  print(len(columns['filename']))
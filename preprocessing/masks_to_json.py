@@ -1,6 +1,10 @@
-import cv2, json
-import os, fnmatch
+import argparse, cv2
+import os, sys, fnmatch, time
 import numpy as np
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pnp_distance_measurement'))
+from json_stream import RecordWriter
 
 MASK_PATH = '../data/groundtruth_exit_sign_cleaned_830/masks/'
 JSON_OUTPUT = '../data/json/groundtruth-830.json'
@@ -40,11 +44,11 @@ def visualize_corners(corners, img):
 
 def write_to_json(arr, json_file_name):
   """
-  Write the quadrilateral array to a json output file
+  Write the quadrilateral array to a json output file, one object at a time
+  (a json array, or JSON Lines if the file name ends with .jsonl)
   """
-  with open(json_file_name, "w") as outfile: 
-    json_obj = json.dumps(arr, default=lambda x: x.__dict__, indent=4, sort_keys=True)
-    outfile.write(json_obj)
+  with RecordWriter(json_file_name) as writer:
+    writer.write_all(arr)
 
 class Quadrilateral(object):
   def __init__(self, mask_id, vertices_2D):
@@ -56,16 +60,136 @@ class Quadrilateral(object):
     self.img_id = '_'.join(img_arr) + '.jpg'
     self.vertices_2D = vertices_2D
 
-if __name__ == '__main__':
-  file_list = get_file_list(MASK_PATH)
-  quadrilateral_arr = []
-  for i, filename in enumerate(file_list):
-    img = cv2.imread(MASK_PATH + filename)
-    corners = extract_corner(img)
-  # visualize_corners(corners, img)
-    if len(corners) == 4:
-      quadrilateral_arr.append(Quadrilateral(filename, corners))
-      print(str(i) + ' ' + filename)
-  print(len(quadrilateral_arr))
-  write_to_json(sorted(quadrilateral_arr, key=lambda x:x.mask_id), JSON_OUTPUT)
+def fit_quadrilateral(contour):
+  """
+  The 4 corners of a convex quadrilateral contour: the polygon is simplified down to
+  4 vertices, then each corner is the intersection of the lines fitted to its 2 sides
+  Returns the 4x2 float corners, or None if the contour isn't a quadrilateral
+  """
+  hull = cv2.convexHull(contour)
+  perimeter = cv2.arcLength(hull, True)
+  approx = None
+  for epsilon in (0.01, 0.02, 0.03, 0.05, 0.08):
+    approx = cv2.approxPolyDP(hull, epsilon*perimeter, True)
+    if len(approx) <= 4:
+      break
+  if approx is None or len(approx) != 4:
+    return None
+  approx = approx.reshape(4, 2).astype(np.float64)
+
+  # Points of the contour on each side, away from the corners
+  pts = contour.reshape(-1, 2).astype(np.float64)
+  lines = []
+  for k in range(4):
+    p, q = approx[k], approx[(k + 1) % 4]
+    d = q - p
+    length = np.hypot(d[0], d[1])
+    if length < 2:
+      return None
+    t = np.dot(pts - p, d)/length**2
+    dist = np.abs(d[0]*(pts[:, 1] - p[1]) - d[1]*(pts[:, 0] - p[0]))/length
+    side = pts[(t > 0.1) & (t < 0.9) & (dist < max(2.0, 0.02*length))]
+    if len(side) < 2:
+      side = np.array([p, q])
+    vx, vy, x0, y0 = cv2.fitLine(np.float32(side), cv2.DIST_L2, 0, 0.01, 0.01).ravel()
+    lines.append((np.array([vx, vy], np.float64), np.array([x0, y0], np.float64)))
+
+  corners = np.empty((4, 2))
+  for k in range(4):
+    (d1, p1), (d2, p2) = lines[k - 1], lines[k]
+    det = d1[0]*(-d2[1]) + d2[0]*d1[1]
+    if abs(det) < 1e-9:
+      return None
+    s = ((p2[0] - p1[0])*(-d2[1]) + d2[0]*(p2[1] - p1[1]))/det
+    corners[k] = p1 + s*d1
+  return corners
+
+def extract_quadrilateral(gray, min_area=100):
+  """
+  Extract the 4 corners of a binary mask from the contour of its largest region,
+  working only inside the bounding box of the mask
+  Returns (corners, None) or (None, rejection reason)
+  """
+  pts = cv2.findNonZero(np.uint8(gray > 127))
+  if pts is None:
+    return None, 'empty mask'
+  x, y, w, h = cv2.boundingRect(pts)
+  # One pixel of background around the crop so that the contour is closed
+  x0, y0 = max(x - 1, 0), max(y - 1, 0)
+  crop = np.uint8(gray[y0:y + h + 1, x0:x + w + 1] > 127)
+  contours = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+  areas = [cv2.contourArea(c) for c in contours]
+  largest = int(np.argmax(areas))
+  if areas[largest] < min_area:
+    return None, 'region too small'
+  if len(areas) > 1 and sorted(areas)[-2] > 0.1*areas[largest]:
+    return None, 'several regions'
+  corners = fit_quadrilateral(contours[largest])
+  if corners is None:
+    return None, 'not a quadrilateral'
+  if not np.all(np.isfinite(corners)) or cv2.contourArea(np.float32(corners)) < min_area:
+    return None, 'degenerate quadrilateral'
+  # Round or ragged regions can still be simplified to 4 vertices
+  if abs(cv2.contourArea(np.float32(corners)) - areas[largest]) > 0.1*areas[largest]:
+    return None, 'not a quadrilateral'
+  corners += (x0, y0)
+  return np.int32(corners).tolist(), None
 
+def process_mask(args):
+  """
+  Worker: extract the corners of one mask file
+  Returns (file name, corners or None, rejection reason or None, seconds)
+  """
+  mask_path, filename, engine = args
+  start = time.time()
+  if engine == 'harris':
+    img = cv2.imread(mask_path + filename)
+    corners = None if img is None else extract_corner(img)
+    reason = 'unreadable' if img is None else \
+             (None if len(corners) == 4 else str(len(corners)) + ' corners found')
+  else:
+    gray = cv2.imread(mask_path + filename, cv2.IMREAD_GRAYSCALE)
+    corners, reason = (None, 'unreadable') if gray is None else extract_quadrilateral(gray)
+  return filename, None if reason else corners, reason, time.time() - start
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--masks', default=MASK_PATH, help='folder of the png masks')
+  parser.add_argument('--output', default=JSON_OUTPUT, help='.json (array) or .jsonl output')
+  parser.add_argument('--engine', choices=['contour', 'harris'], default='contour',
+                      help='contour: quadrilateral fitted to the contour of the mask (grayscale, '
+                           'bounding box only). harris: the original Harris corner detector')
+  parser.add_argument('--workers', type=int, default=None, help='processes (default: all cores)')
+  parser.add_argument('--report', default=None,
+                      help='write the status, rejection reason and time of every mask to this .json/.jsonl file')
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parse_args()
+  # Masks are processed in mask_id order so that every result can be written as soon as it is found
+  file_list = sorted(get_file_list(args.masks))
+  tasks = [(args.masks, filename, args.engine) for filename in file_list]
+  rejected = {}
+  total_time = 0.0
+  report = RecordWriter(args.report) if args.report else None
+  pool = Pool(args.workers)
+  try:
+    with RecordWriter(args.output) as writer:
+      for i, (filename, corners, reason, seconds) in enumerate(pool.imap(process_mask, tasks, chunksize=16)):
+        total_time += seconds
+        if report is not None:
+          report.write({'mask_id': filename, 'accepted': reason is None, 'reason': reason, 'seconds': seconds})
+        if reason is not None:
+          rejected[reason] = rejected.get(reason, 0) + 1
+          print(str(i) + ' ' + filename + ' rejected: ' + reason)
+          continue
+        writer.write(Quadrilateral(filename, corners))
+        print(str(i) + ' ' + filename)
+      print(writer.count)
+  finally:
+    pool.close()
+    pool.join()
+    if report is not None:
+      report.close()
+  print('Rejected: ' + str(rejected))
+  print('Average time per mask: ' + str(total_time/max(len(file_list), 1)) + ' s')
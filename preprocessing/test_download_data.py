@@ -0,0 +1,100 @@
+import os, sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import download_data
+
+DATA = bytes(range(256))*1000
+WARNING_PAGE = ('<html><body>Google Drive can\'t scan this file for viruses.'
+                '<form id="download-form" action="/download" method="get">'
+                '<input type="submit" value="Download anyway"/>'
+                '<input type="hidden" name="id" value="abc"><input type="hidden" name="confirm" value="t">'
+                '</form></body></html>')
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.server.requests.append((self.path, self.headers.get('Range')))
+    if self.path == '/old':
+      self.reply(302, b'', {'Location': '/file'})
+    elif self.path in ('/file', '/download?id=abc&confirm=t'):
+      start = 0
+      if self.headers.get('Range'):
+        start = int(self.headers['Range'].split('=')[1].split('-')[0])
+        self.reply(206, DATA[start:], {'Content-Range': 'bytes %d-%d/%d' % (start, len(DATA) - 1, len(DATA))})
+      else:
+        self.reply(200, DATA)
+    elif self.path == '/warning':
+      self.reply(200, WARNING_PAGE.encode(), {'Content-Type': 'text/html; charset=utf-8'})
+    elif self.path == '/login':
+      self.reply(200, b'<html>Sign in</html>', {'Content-Type': 'text/html'})
+    else:
+      self.reply(404, b'not found')
+
+  def reply(self, status, body, headers=None):
+    self.send_response(status)
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    if 'Content-Type' not in (headers or {}):
+      self.send_header('Content-Type', 'application/octet-stream')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def server():
+  server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  server.requests = []
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+def url(server, path):
+  return 'http://127.0.0.1:' + str(server.server_address[1]) + path
+
+def read(file_name):
+  with open(file_name, 'rb') as f:
+    return f.read()
+
+def test_resume(server, tmp_path):
+  file_name = str(tmp_path / 'a.jpg')
+  with open(file_name + '.part', 'wb') as f:
+    f.write(DATA[:1000])
+  size = download_data.download(download_data.ConnectionPool(5), url(server, '/file'), file_name)
+  assert size == len(DATA) and read(file_name) == DATA
+  assert server.requests == [('/file', 'bytes=1000-')]
+  assert not os.path.exists(file_name + '.part')
+
+def test_redirect(server, tmp_path):
+  file_name = str(tmp_path / 'a.jpg')
+  download_data.download(download_data.ConnectionPool(5), url(server, '/old'), file_name)
+  assert read(file_name) == DATA
+  assert [path for path, _ in server.requests] == ['/old', '/file']
+
+def test_not_found(server, tmp_path):
+  file_name = str(tmp_path / 'a.jpg')
+  job = ('a.jpg', 'image', url(server, '/missing'), file_name)
+  (_, status, error), = download_data.download_all([job], workers=1, timeout=5)
+  assert status == 'failed' and error.startswith('HTTP 404')
+  assert not os.path.exists(file_name)
+
+def test_drive_warning(server, tmp_path):
+  file_name = str(tmp_path / 'a.jpg')
+  download_data.download(download_data.ConnectionPool(5), url(server, '/warning'), file_name)
+  assert read(file_name) == DATA
+  assert [path for path, _ in server.requests] == ['/warning', '/download?id=abc&confirm=t']
+
+def test_html_page(server, tmp_path):
+  file_name = str(tmp_path / 'a.jpg')
+  job = ('a.jpg', 'image', url(server, '/login'), file_name)
+  (_, status, error), = download_data.download_all([job], workers=1, timeout=5)
+  assert status == 'failed' and error.startswith('HTML page')
+  assert not os.path.exists(file_name)